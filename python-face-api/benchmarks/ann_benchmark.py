@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Recall/latency benchmark: IVF index vs exact gallery search
+
+Builds a synthetic campus-scale gallery (or loads real embeddings from a .npy
+file), then compares the IVF index against exact matching for several nprobe
+values:
+
+    python benchmarks/ann_benchmark.py --students 50000 --nprobe 1 4 8 16 32
+
+recall@1 is the fraction of queries recognized by exact search whose best
+IVF match is the same student; agreement is the fraction with the same
+recognized/unknown decision and identity at ARCFACE_THRESHOLD. Unclustered
+random embeddings are the worst case for IVF; run with --embeddings on
+exported gallery vectors for numbers that reflect real ArcFace galleries.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import ARCFACE_THRESHOLD, IVFIndex, build_ann_index, match_embeddings  # noqa: E402
+
+
+def normalize_rows(x: np.ndarray) -> np.ndarray:
+    return (x / np.linalg.norm(x, axis=1, keepdims=True)).astype(np.float32)
+
+
+def synthetic_gallery(students: int, clusters: int, spread: float, dim: int, rng) -> np.ndarray:
+    """Students scattered around `clusters` centres (cohorts/demographics)"""
+    centres = normalize_rows(rng.standard_normal((clusters, dim)))
+    members = rng.integers(0, clusters, students)
+    offsets = normalize_rows(rng.standard_normal((students, dim))) * spread
+    return normalize_rows(centres[members] + offsets)
+
+
+def make_queries(gallery: np.ndarray, count: int, noise: float, unknown: float, rng) -> np.ndarray:
+    """Noisy captures of enrolled students plus a share of unknown faces"""
+    dim = gallery.shape[1]
+    rows = gallery[rng.integers(0, len(gallery), count)]
+    queries = normalize_rows(rows + normalize_rows(rng.standard_normal((count, dim))) * noise)
+    strangers = rng.random(count) < unknown
+    queries[strangers] = normalize_rows(rng.standard_normal((int(strangers.sum()), dim)))
+    return queries
+
+
+def timed(fn, queries: np.ndarray, batch: int):
+    """Run fn over the queries in frame-sized batches; returns (idx, scores, per-batch ms)"""
+    idx, scores, latencies = [], [], []
+    for start in range(0, len(queries), batch):
+        t0 = time.perf_counter()
+        i, s = fn(queries[start:start + batch])
+        latencies.append((time.perf_counter() - t0) * 1000)
+        idx.append(i)
+        scores.append(s)
+    return np.vstack(idx), np.vstack(scores), np.array(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=50000)
+    parser.add_argument("--embeddings", help=".npy file of (N, 512) gallery embeddings instead of synthetic ones")
+    parser.add_argument("--clusters", type=int, default=500, help="synthetic cluster centres")
+    parser.add_argument("--spread", type=float, default=0.8, help="synthetic within-cluster spread")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--noise", type=float, default=0.6, help="capture noise (0.6 ~ cosine 0.86 to the enrolled row)")
+    parser.add_argument("--unknown", type=float, default=0.2, help="fraction of queries from unenrolled faces")
+    parser.add_argument("--faces-per-frame", type=int, default=4)
+    parser.add_argument("--nlist", type=int, default=0)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    if args.embeddings:
+        gallery = normalize_rows(np.load(args.embeddings))
+    else:
+        gallery = synthetic_gallery(args.students, args.clusters, args.spread, 512, rng)
+    queries = make_queries(gallery, args.queries, args.noise, args.unknown, rng)
+    print(f"📊 Gallery: {gallery.shape[0]} x {gallery.shape[1]}, {len(queries)} queries, {args.faces_per_frame} faces/frame")
+
+    t0 = time.perf_counter()
+    index = IVFIndex.train(gallery, args.nlist)
+    print(f"🗂️ IVF build: {index.nlist} lists in {(time.perf_counter() - t0) * 1000:.0f}ms")
+
+    # Incremental update: replace 1% of the rows, as a sync batch would
+    changed = rng.choice(len(gallery), max(1, len(gallery) // 100), replace=False)
+    keep = np.setdiff1d(np.arange(len(gallery)), changed)
+    updated = np.vstack([gallery[keep], gallery[changed]])
+    t0 = time.perf_counter()
+    build_ann_index(updated, index, keep)
+    print(f"♻️ Incremental update ({len(changed)} rows): {(time.perf_counter() - t0) * 1000:.1f}ms")
+
+    exact_idx, exact_scores, exact_ms = timed(lambda q: match_embeddings(q, gallery, args.top_k), queries, args.faces_per_frame)
+    exact_known = exact_scores[:, 0] >= ARCFACE_THRESHOLD
+    print(f"🎯 Exact search recognizes {exact_known.mean():.1%} of queries at threshold {ARCFACE_THRESHOLD}")
+    print(f"\n{'search':<12}{'recall@1':>10}{'agreement':>11}{'p50 ms':>9}{'p95 ms':>9}{'speedup':>9}")
+    print(f"{'exact':<12}{1.0:>10.3f}{1.0:>11.3f}{np.percentile(exact_ms, 50):>9.2f}{np.percentile(exact_ms, 95):>9.2f}{1.0:>8.1f}x")
+
+    for nprobe in args.nprobe:
+        idx, scores, ms = timed(lambda q: index.search(q, gallery, args.top_k, nprobe), queries, args.faces_per_frame)
+        recall = np.mean(idx[exact_known, 0] == exact_idx[exact_known, 0])
+        known = scores[:, 0] >= ARCFACE_THRESHOLD
+        agreement = np.mean((known == exact_known) & (~known | (idx[:, 0] == exact_idx[:, 0])))
+        speedup = np.median(exact_ms) / np.median(ms)
+        print(f"{'ivf/' + str(nprobe):<12}{recall:>10.3f}{agreement:>11.3f}{np.percentile(ms, 50):>9.2f}{np.percentile(ms, 95):>9.2f}{speedup:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Latency vs recall of face detection at several detector resolutions
+
+    python benchmarks/detection_scales.py photos/*.jpg --sides 320 480 640 960
+    python benchmarks/detection_scales.py photos/*.jpg --pyramid --embed
+
+Each image is first detected at full resolution, which is the reference.
+Then every --sides value runs the same detector on a copy whose longer side
+is at most that many pixels. Crops are always aligned from the full-resolution
+frame, as the API does with DETECTION_MAX_SIDE. recall is the share of
+reference faces found again (IoU >= 0.5). With --embed, the ArcFace
+embedding of each matched crop is compared with the reference crop's.
+Values close to 1.0 mean recognition accuracy is unaffected.
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import box_iou, detect_faces_scaled, get_embedding, load_deepface, load_image, normalize_embedding  # noqa: E402
+
+
+def embed(faces):
+    out = []
+    for roi, _ in faces:
+        emb = get_embedding(roi)
+        out.append(normalize_embedding(emb) if emb is not None else None)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="+", help="image files or glob patterns")
+    parser.add_argument("--sides", type=int, nargs="+", default=[320, 480, 640, 960, 1280])
+    parser.add_argument("--pyramid", action="store_true", help="retry at 2x while a level finds nothing")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per image and side")
+    parser.add_argument("--embed", action="store_true", help="compare ArcFace embeddings of the crops")
+    args = parser.parse_args()
+
+    paths = sorted({p for pattern in args.images for p in (glob.glob(pattern) or [pattern])})
+    frames = []
+    for path in paths:
+        with open(path, "rb") as f:
+            rgb = load_image(f.read())
+        if rgb is None:
+            print(f"⚠️ Skipping {path}: not an image")
+            continue
+        frames.append((path, rgb))
+    if not frames:
+        sys.exit("❌ No readable images")
+    if not load_deepface():
+        print("⚠️ DeepFace not available: measuring the Haar cascade fallback only")
+
+    def run(rgb, side):
+        best = None
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            faces = detect_faces_scaled(rgb, side, args.pyramid)
+            elapsed = (time.perf_counter() - t0) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        return faces, best
+
+    references = []
+    full_ms = []
+    for _, rgb in frames:
+        faces, ms = run(rgb, 0)
+        references.append((faces, embed(faces) if args.embed else None))
+        full_ms.append(ms)
+    total_ref = sum(len(faces) for faces, _ in references)
+    sizes = [f"{rgb.shape[1]}x{rgb.shape[0]}" for _, rgb in frames]
+    print(f"📊 {len(frames)} image(s) ({', '.join(sorted(set(sizes)))}), {total_ref} reference face(s)")
+
+    header = f"{'max side':<10}{'mean ms':>9}{'speedup':>9}{'recall':>8}"
+    if args.embed:
+        header += f"{'emb sim':>9}"
+    print("\n" + header)
+    print(f"{'full':<10}{np.mean(full_ms):>9.1f}{1.0:>8.1f}x{1.0:>8.3f}" + (f"{1.0:>9.3f}" if args.embed else ""))
+
+    for side in args.sides:
+        latencies, found, sims = [], 0, []
+        for (_, rgb), (ref_faces, ref_embs) in zip(frames, references):
+            faces, ms = run(rgb, side)
+            latencies.append(ms)
+            embs = embed(faces) if args.embed else None
+            for r, (_, ref_box) in enumerate(ref_faces):
+                ious = [box_iou(ref_box, box) for _, box in faces]
+                if ious and max(ious) >= 0.5:
+                    found += 1
+                    match = int(np.argmax(ious))
+                    if args.embed and ref_embs[r] is not None and embs[match] is not None:
+                        sims.append(float(ref_embs[r] @ embs[match]))
+        recall = found / total_ref if total_ref else 1.0
+        line = f"{side:<10}{np.mean(latencies):>9.1f}{np.mean(full_ms) / np.mean(latencies):>8.1f}x{recall:>8.3f}"
+        if args.embed:
+            line += f"{np.mean(sims) if sims else float('nan'):>9.3f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
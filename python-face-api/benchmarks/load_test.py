@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Load generator replaying the live-attendance client against a running API
+
+    uvicorn main:app --port 8000 &
+    python benchmarks/load_test.py --classrooms 10 --duration 60 --output results/load.json
+    python benchmarks/load_test.py --frames recorded/*.jpg --transport raw --session --compare results/load.json
+
+Each simulated classroom does what the live-attendance page does. It first
+loads its roster with /load-students, then POSTs one frame to /recognize
+every --interval seconds. Frames are JPEG (quality 0.65) data URLs in JSON.
+Like the page's setInterval, requests are fired on schedule without waiting
+for the previous answer (open loop), so an overloaded server shows up as
+growing latency and 503s instead of a slower request rate. Each request
+gets its own thread, so a slow server never holds back the schedule; how
+late requests left the client anyway (client_queue) is reported
+separately from the server latency. Every classroom
+gets its own gallery (loadtest-<n>) unless --shared-gallery is set.
+
+--transport raw sends JPEG bodies instead, and --session adds a session_id
+per classroom (face tracking and duplicate-frame suppression). --still
+repeats one frame per classroom, like a room where nobody moves.
+The JSON report has latency percentiles and throughput of successful
+requests, status counts and cache hits. --compare works as in
+pipeline_benchmark.py. Throughput depends on the offered load, so compare
+only runs made with the same options.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipeline_benchmark import data_url, environment, load_frames, summarize, write_report  # noqa: E402
+
+
+def post(url: str, body: bytes, content_type: str, timeout: float):
+    """(status, parsed JSON or None, latency ms); status 0 is a connection error or timeout"""
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": content_type}, method="POST")
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            payload = response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        payload, status = e.read(), e.code
+    except Exception:
+        return 0, None, (time.perf_counter() - started) * 1000.0
+    latency = (time.perf_counter() - started) * 1000.0
+    try:
+        return status, json.loads(payload), latency
+    except ValueError:
+        return status, None, latency
+
+
+def server_info(base_url: str, timeout: float) -> dict:
+    try:
+        with urllib.request.urlopen(f"{base_url}/health", timeout=timeout) as response:
+            return json.loads(response.read())
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def load_roster(base_url: str, gallery_id: str, students: int, rng, timeout: float):
+    embeddings = rng.standard_normal((students, 512)).astype(np.float32)
+    roster = [{"studentId": f"lt{i}", "name": f"Student {i}", "faceEmbeddings": emb.tolist()} for i, emb in enumerate(embeddings)]
+    body = json.dumps({"students": roster, "gallery_id": gallery_id}).encode()
+    status, _, latency = post(f"{base_url}/load-students", body, "application/json", timeout)
+    if status != 200:
+        raise SystemExit(f"❌ /load-students for '{gallery_id}' failed with status {status}")
+    return latency
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--classrooms", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of frames after the rosters are loaded")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between frames per classroom (page: 1s)")
+    parser.add_argument("--students", type=int, default=60, help="roster size per classroom")
+    parser.add_argument("--shared-gallery", action="store_true")
+    parser.add_argument("--transport", choices=["json", "raw"], default="json")
+    parser.add_argument("--session", action="store_true", help="send a session_id per classroom")
+    parser.add_argument("--still", action="store_true", help="repeat one frame per classroom")
+    parser.add_argument("--frames", nargs="*", help="recorded frames (image files or glob patterns)")
+    parser.add_argument("--synthetic-frames", type=int, default=8)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--faces", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="earlier JSON report to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    args = parser.parse_args()
+
+    base_url = args.url.rstrip("/")
+    rng = np.random.default_rng(args.seed)
+    frames = load_frames(args.frames, args.synthetic_frames, args.width, args.height, args.faces, rng)
+    bodies = [data_url(jpeg).encode() for jpeg in frames] if args.transport == "json" else frames
+
+    gallery_ids = ["loadtest"] if args.shared_gallery else [f"loadtest-{c}" for c in range(args.classrooms)]
+    load_ms = [load_roster(base_url, gallery_id, args.students, rng, args.timeout) for gallery_id in gallery_ids]
+    print(f"📚 Loaded {len(gallery_ids)} roster(s) of {args.students} students", file=sys.stderr)
+
+    samples = []
+    samples_lock = threading.Lock()
+    in_flight = [0, 0]  # now, peak
+
+    def send(classroom: int, frame_no: int, due: float):
+        # How late the request leaves the client (scheduler and thread start-up)
+        queue_ms = max(0.0, time.perf_counter() - due) * 1000.0
+        with samples_lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight[1], in_flight[0])
+        gallery_id = gallery_ids[0 if args.shared_gallery else classroom]
+        frame = bodies[classroom % len(bodies)] if args.still else bodies[(classroom + frame_no) % len(bodies)]
+        session = f"loadtest-{classroom}" if args.session else None
+        if args.transport == "json":
+            body = b'{"image": "' + frame + b'", "gallery_id": ' + json.dumps(gallery_id).encode()
+            body += (b', "session_id": ' + json.dumps(session).encode() if session else b"") + b"}"
+            url, content_type = f"{base_url}/recognize", "application/json"
+        else:
+            query = f"gallery_id={gallery_id}" + (f"&session_id={session}" if session else "")
+            url, body, content_type = f"{base_url}/recognize?{query}", frame, "image/jpeg"
+        status, result, latency = post(url, body, content_type, args.timeout)
+        with samples_lock:
+            in_flight[0] -= 1
+            samples.append((status, latency, result or {}, queue_ms))
+
+    # One open-loop schedule per classroom, started at random offsets; a
+    # thread per request, since a bounded pool would cap requests in flight
+    # and quietly lower the offered rate once the server slows down
+    offsets = [random.Random(args.seed + c).uniform(0, args.interval) for c in range(args.classrooms)]
+    schedule = sorted((offset + n * args.interval, c, n) for c, offset in enumerate(offsets)
+                      for n in range(int((args.duration - offset) / args.interval) + 1))
+    threads = []
+    started = time.perf_counter()
+    for at, classroom, frame_no in schedule:
+        delay = at - (time.perf_counter() - started)
+        if delay > 0:
+            time.sleep(delay)
+        thread = threading.Thread(target=send, args=(classroom, frame_no, started + at), daemon=True)
+        thread.start()
+        threads.append(thread)
+    sent_s = time.perf_counter() - started
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    ok = [latency for status, latency, _, _ in samples if status == 200]
+    statuses = {}
+    for status, _, _, _ in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    cached = sum(1 for status, _, result, _ in samples if status == 200 and result.get("cached"))
+    faces = [len(result.get("faces", [])) for status, _, result, _ in samples if status == 200]
+    client_queue = summarize([queue_ms for _, _, _, queue_ms in samples]) if samples else {}
+    client_queue.pop("throughput_per_s", None)
+
+    results = {}
+    if ok:
+        results["recognize"] = summarize(ok) | {"throughput_per_s": round(len(ok) / elapsed, 2)}
+    results["load_students"] = summarize(load_ms)
+    report = {
+        "benchmark": "load",
+        "environment": environment(),
+        "server": server_info(base_url, args.timeout),
+        "config": vars(args) | {"frames": len(frames), "frame_source": "recorded" if args.frames else "synthetic"},
+        "requests": {
+            "sent": len(samples),
+            "offered_per_s": round(args.classrooms / args.interval, 2),
+            "sent_per_s": round(len(samples) / sent_s, 2) if sent_s > 0 else None,
+            "elapsed_s": round(elapsed, 2),
+            "max_in_flight": in_flight[1],
+            "client_queue": client_queue,
+            "status_counts": statuses,
+            "error_rate": round(1 - len(ok) / len(samples), 4) if samples else None,
+            "cached": cached,
+            "faces_per_frame": round(float(np.mean(faces)), 2) if faces else 0.0
+        },
+        "results": results
+    }
+    print(f"🚦 {len(samples)} requests, {len(ok)} OK, statuses {statuses}, peak {in_flight[1]} in flight", file=sys.stderr)
+    if client_queue and client_queue["p95_ms"] > 0.1 * args.interval * 1000.0:
+        print(f"⚠️ Client-side queueing p95 {client_queue['p95_ms']:.0f}ms: the load generator could not keep the schedule", file=sys.stderr)
+    write_report(report, args.output, args.compare, args.tolerance)
+
+
+if __name__ == "__main__":
+    main_cli()
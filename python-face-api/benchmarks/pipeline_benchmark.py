@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Per-stage benchmark of the recognition pipeline with JSON output
+
+    python benchmarks/pipeline_benchmark.py --output results/pipeline.json
+    python benchmarks/pipeline_benchmark.py --frames recorded/*.jpg --gallery-sizes 1000 50000
+    python benchmarks/pipeline_benchmark.py --compare results/pipeline.json
+
+Times each stage on its own: decode_base64 (JPEG data URLs like the
+live-attendance page sends), decode_image_bytes at each --decode-scales,
+detect_faces (and detect_faces_tiled at each --tile-sizes), get_embedding
+(one crop), get_embeddings (a --batch of crops) and matching (exact, plus
+IVF with --nprobe) against synthetic galleries of each --gallery-sizes. Synthetic frames are drawn procedurally. RetinaFace
+may find no faces in them, but the detection cost is representative. Use
+--frames with recorded classroom frames to benchmark realistic detection.
+
+Every result has the run count, mean/p50/p95/p99/max in ms and throughput
+per second. --compare loads an earlier JSON run and exits with status 1 if
+any p95 grew, or any throughput dropped, by more than --tolerance.
+"""
+
+import argparse
+import base64
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ann_benchmark import make_queries, synthetic_gallery  # noqa: E402
+import main  # noqa: E402
+
+
+def synthetic_frame(width: int, height: int, faces: int, rng) -> np.ndarray:
+    """Classroom-like RGB frame: textured background plus face-like ellipses"""
+    frame = cv2.GaussianBlur((rng.random((height, width, 3)) * 255).astype(np.uint8), (0, 0), 3)
+    size = max(24, min(width, height) // 6)
+    for i in range(faces):
+        cx = int((i + 0.5) * width / faces)
+        cy = int(height * rng.uniform(0.3, 0.6))
+        cv2.ellipse(frame, (cx, cy), (size // 2, int(size * 0.65)), 0, 0, 360, (224, 172, 140), -1)
+        for dx in (-size // 5, size // 5):
+            cv2.circle(frame, (cx + dx, cy - size // 8), max(2, size // 14), (40, 30, 30), -1)
+        cv2.ellipse(frame, (cx, cy + size // 4), (size // 5, max(2, size // 16)), 0, 0, 180, (120, 60, 60), -1)
+    return frame
+
+
+def encode_jpeg(rgb: np.ndarray, quality: int = 65) -> bytes:
+    ok, buf = cv2.imencode(".jpg", cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buf.tobytes()
+
+
+def data_url(jpeg: bytes) -> str:
+    return "data:image/jpeg;base64," + base64.b64encode(jpeg).decode()
+
+
+def load_frames(patterns, count: int, width: int, height: int, faces: int, rng) -> list:
+    """JPEG bytes of recorded frames (glob patterns) or `count` synthetic frames"""
+    paths = sorted(p for pattern in patterns or [] for p in glob.glob(pattern))
+    if patterns and not paths:
+        raise SystemExit(f"❌ No frames match {patterns}")
+    if paths:
+        return [open(p, "rb").read() for p in paths]
+    return [encode_jpeg(synthetic_frame(width, height, faces, rng)) for _ in range(count)]
+
+
+def summarize(latencies_ms, items_per_run: int = 1) -> dict:
+    """Latency percentiles (ms) and throughput (items/s) of a list of runs"""
+    ms = np.asarray(latencies_ms, dtype=np.float64)
+    return {
+        "runs": int(ms.size),
+        "mean_ms": round(float(ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "max_ms": round(float(ms.max()), 3),
+        "throughput_per_s": round(items_per_run * 1000.0 / float(ms.mean()), 2) if ms.mean() > 0 else None
+    }
+
+
+def environment() -> dict:
+    """What the numbers depend on: code version, libraries, hardware and tuning env vars"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    prefixes = ("DETECTION", "CASCADE", "DECODE", "EMBEDDING", "INFERENCE", "ONNX", "ANN_", "GALLERY_", "FRAME_", "TRACK")
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "api_version": main.app.version,
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "deepface_available": main.DEEPFACE_AVAILABLE,
+        "inference_backend": main.get_inference_backend().name,
+        "env": {k: v for k, v in os.environ.items() if k.startswith(prefixes)}
+    }
+
+
+def compare(results: dict, baseline_path: str, tolerance: float) -> list:
+    """Regressions of results against an earlier JSON run: p95 up or throughput down by more than tolerance"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    regressions = []
+    for name, current in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        if current["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95_ms']:.2f} -> {current['p95_ms']:.2f}ms")
+        if before.get("throughput_per_s") and current.get("throughput_per_s") is not None \
+                and current["throughput_per_s"] < before["throughput_per_s"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {before['throughput_per_s']:.1f} -> {current['throughput_per_s']:.1f}/s")
+    return regressions
+
+
+def write_report(report: dict, output: str, baseline: str, tolerance: float):
+    """Print/save a JSON report and apply --compare; exits 1 on regressions"""
+    text = json.dumps(report, indent=2)
+    if output:
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w") as f:
+            f.write(text + "\n")
+        print(f"💾 Results written to {output}")
+    else:
+        print(text)
+    if baseline:
+        regressions = compare(report["results"], baseline, tolerance)
+        for line in regressions:
+            print(f"❌ Regression {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"✅ No regressions beyond {tolerance:.0%} against {baseline}")
+
+
+def bench(fn, inputs, iterations: int, warmup: int) -> list:
+    """Latencies (ms) of fn over inputs, cycling through them"""
+    for i in range(warmup):
+        fn(inputs[i % len(inputs)])
+    latencies = []
+    for i in range(iterations):
+        item = inputs[i % len(inputs)]
+        started = time.perf_counter()
+        fn(item)
+        latencies.append((time.perf_counter() - started) * 1000.0)
+    return latencies
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", nargs="*", help="recorded frames (image files or glob patterns)")
+    parser.add_argument("--synthetic-frames", type=int, default=8)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--faces", type=int, default=4, help="faces per synthetic frame and queries per match")
+    parser.add_argument("--decode-scales", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--tile-sizes", type=int, nargs="*", default=[], help="also time tiled detection at these tile sizes")
+    parser.add_argument("--batch", type=int, default=8, help="crops per get_embeddings call")
+    parser.add_argument("--gallery-sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--precisions", nargs="+", default=["float32"], choices=main.SUPPORTED_PRECISIONS)
+    parser.add_argument("--nprobe", type=int, default=0, help="also time IVF search with this nprobe")
+    parser.add_argument("--iterations", type=int, default=30)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--skip", nargs="*", default=[], choices=["decode", "detect", "embed", "match"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="earlier JSON report to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    frames = load_frames(args.frames, args.synthetic_frames, args.width, args.height, args.faces, rng)
+    rgb_frames = [main.load_image(jpeg) for jpeg in frames]
+    results = {}
+
+    def record(name: str, latencies: list, items_per_run: int = 1):
+        results[name] = summarize(latencies, items_per_run)
+        print(f"⏱️ {name:<32} p50 {results[name]['p50_ms']:>9.2f}ms  p95 {results[name]['p95_ms']:>9.2f}ms", file=sys.stderr)
+
+    if "decode" not in args.skip:
+        urls = [data_url(jpeg) for jpeg in frames]
+        record("decode_base64", bench(main.decode_base64, urls, args.iterations, args.warmup))
+        for scale in args.decode_scales:
+            record(f"decode_image_bytes/scale{scale}", bench(lambda b: main.decode_image_bytes(b, scale), frames, args.iterations, args.warmup))
+
+    if "detect" not in args.skip or "embed" not in args.skip:
+        main.load_deepface()
+
+    if "detect" not in args.skip:
+        record("detect_faces", bench(main.detect_faces, rgb_frames, args.iterations, args.warmup))
+        for tile_size in args.tile_sizes:
+            record(f"detect_faces_tiled/tile{tile_size}", bench(lambda rgb: main.detect_faces_tiled(rgb, tile_size, main.DETECTION_TILE_OVERLAP), rgb_frames, args.iterations, args.warmup))
+
+    if "embed" not in args.skip:
+        crops = [cv2.resize(rgb[: rgb.shape[0] // 2, : rgb.shape[1] // 3], (224, 224)) for rgb in rgb_frames]
+        record("get_embedding", bench(main.get_embedding, crops, args.iterations, args.warmup))
+        batches = [[crops[(i + j) % len(crops)] for j in range(args.batch)] for i in range(len(crops))]
+        record(f"get_embeddings/batch{args.batch}", bench(main.get_embeddings, batches, args.iterations, args.warmup), args.batch)
+
+    if "match" not in args.skip:
+        for size in args.gallery_sizes:
+            gallery = synthetic_gallery(size, max(1, min(500, size // 20)), 0.8, 512, rng)
+            queries = make_queries(gallery, args.faces * 16, 0.6, 0.2, rng)
+            query_sets = [queries[i:i + args.faces] for i in range(0, len(queries), args.faces)]
+            for precision in args.precisions:
+                stored = main.quantize_gallery(gallery, precision)
+                record(f"match/{size}/{precision}", bench(lambda q: main.match_embeddings(q, stored, main.RECOGNITION_TOP_K), query_sets, args.iterations, args.warmup), args.faces)
+                if args.nprobe > 0 and size >= 1000:
+                    index = main.IVFIndex.train(gallery, main.ANN_NLIST)
+                    record(f"match_ivf/{size}/{precision}/nprobe{args.nprobe}", bench(lambda q: index.search(q, stored, main.RECOGNITION_TOP_K, args.nprobe), query_sets, args.iterations, args.warmup), args.faces)
+
+    report = {
+        "benchmark": "pipeline",
+        "environment": environment(),
+        "config": vars(args) | {"frames": len(frames), "frame_source": "recorded" if args.frames else "synthetic"},
+        "results": results
+    }
+    write_report(report, args.output, args.compare, args.tolerance)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Accuracy/memory/latency check of float16 and int8 galleries against float32
+
+    python benchmarks/quantization_benchmark.py --students 50000
+
+For each precision it reports gallery bytes, the largest similarity error
+against the float32 scores (and the bound the server reports as
+quantization_error), how many recognized/unknown decisions at
+ARCFACE_THRESHOLD differ from float32, and frame matching latency with its
+ratio to float32. Exits with status 1 if a quantized gallery matches more
+than --max-slowdown times slower than float32 (they should be faster: less
+memory to stream). Use --embeddings with exported gallery vectors to check a
+real roster.
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ann_benchmark import make_queries, normalize_rows, synthetic_gallery, timed  # noqa: E402
+from main import ARCFACE_THRESHOLD, gallery_scores, match_embeddings, quantize_gallery  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=50000)
+    parser.add_argument("--embeddings", help=".npy file of (N, 512) gallery embeddings instead of synthetic ones")
+    parser.add_argument("--clusters", type=int, default=500)
+    parser.add_argument("--spread", type=float, default=0.8)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--noise", type=float, default=1.0, help="capture noise (1.0 puts many queries near the threshold)")
+    parser.add_argument("--unknown", type=float, default=0.2)
+    parser.add_argument("--faces-per-frame", type=int, default=4)
+    parser.add_argument("--max-slowdown", type=float, default=1.0, help="allowed quantized/float32 p50 ratio")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    if args.embeddings:
+        gallery = normalize_rows(np.load(args.embeddings))
+    else:
+        gallery = synthetic_gallery(args.students, args.clusters, args.spread, 512, rng)
+    queries = make_queries(gallery, args.queries, args.noise, args.unknown, rng)
+    print(f"📊 Gallery: {gallery.shape[0]} x {gallery.shape[1]}, {len(queries)} queries, threshold {ARCFACE_THRESHOLD}")
+
+    exact = gallery_scores(queries, gallery)
+    exact_idx, exact_top, _ = timed(lambda q: match_embeddings(q, gallery, 1), queries, args.faces_per_frame)
+    exact_known = exact_top[:, 0] >= ARCFACE_THRESHOLD
+    near = np.abs(exact_top[:, 0] - ARCFACE_THRESHOLD) < 0.02
+    print(f"🎯 float32 recognizes {exact_known.mean():.1%}; {near.sum()} queries within 0.02 of the threshold")
+
+    print(f"\n{'precision':<10}{'MB':>9}{'max err':>10}{'bound':>9}{'flips':>7}{'id diff':>9}{'p50 ms':>9}{'vs f32':>8}")
+    float32_ms = None
+    regressions = []
+    for precision in ("float32", "float16", "int8"):
+        stored = quantize_gallery(gallery, precision)
+        error = float(np.abs(gallery_scores(queries, stored) - exact).max())
+        bound = getattr(stored, "error", 0.0)
+        idx, top, ms = timed(lambda q: match_embeddings(q, stored, 1), queries, args.faces_per_frame)
+        known = top[:, 0] >= ARCFACE_THRESHOLD
+        flips = int((known != exact_known).sum())
+        id_diff = int((known & exact_known & (idx[:, 0] != exact_idx[:, 0])).sum())
+        p50 = float(np.percentile(ms, 50))
+        float32_ms = float32_ms or p50
+        ratio = p50 / float32_ms
+        if ratio > args.max_slowdown:
+            regressions.append(f"{precision} matching {ratio:.2f}x float32 ({p50:.2f} vs {float32_ms:.2f}ms)")
+        print(f"{precision:<10}{stored.nbytes / 1e6:>9.1f}{error:>10.5f}{bound:>9.4f}{flips:>7}{id_diff:>9}{p50:>9.2f}{ratio:>7.2f}x")
+
+    for line in regressions:
+        print(f"❌ Regression: {line}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Export DeepFace's ArcFace model to ONNX for INFERENCE_BACKEND=onnx
+
+    pip install onnxruntime tf2onnx
+    python export_onnx.py --output models/arcface.onnx --check
+    python export_onnx.py --parity --images "enrolment/*.jpg"
+
+--check embeds random aligned crops with both batched DeepFace ArcFace
+and the exported model (float32 and, with --int8, dynamically quantized
+weights) and reports the cosine similarity between them.
+
+--parity (no export) compares the opt-in embedding paths (batched DeepFace,
+EMBEDDING_BATCHING=1, and the ONNX model if --output exists) with the
+per-crop DeepFace.represent call that existing galleries were enrolled
+with, which runs DeepFace's detector on the crop once more. Pass real
+aligned face crops with --images; random crops say little here. If the
+minimum cosine is below --min-parity, re-enrol the students (/train) before
+turning either on, or recognition scores will drift against the stored
+galleries.
+"""
+
+import argparse
+import glob
+import os
+
+import cv2
+import numpy as np
+
+import main
+
+
+def export_arcface(output: str):
+    import tensorflow as tf
+    import tf2onnx
+
+    client = main.get_arcface_model()
+    h, w = client.input_shape
+    spec = (tf.TensorSpec((None, h, w, 3), tf.float32, name="input"),)
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    tf2onnx.convert.from_keras(client.model, input_signature=spec, opset=13, output_path=output)
+    print(f"✅ ArcFace exported to {output} (input NHWC {h}x{w})")
+
+
+def cosine(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return np.sum(a * b, axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+
+
+def load_crops(patterns, count: int) -> list:
+    """224x224 RGB crops from image files, or `count` random ones"""
+    paths = sorted(p for pattern in patterns or [] for p in glob.glob(pattern))
+    if patterns and not paths:
+        raise SystemExit(f"❌ No images match {patterns}")
+    if paths:
+        return [cv2.resize(cv2.cvtColor(cv2.imread(p), cv2.COLOR_BGR2RGB), (224, 224)) for p in paths]
+    rng = np.random.default_rng(0)
+    return [(rng.random((224, 224, 3)) * 255).astype(np.uint8) for _ in range(count)]
+
+
+def report(label: str, reference: np.ndarray, reference_valid: np.ndarray, embeddings: np.ndarray, valid: np.ndarray) -> float:
+    both = reference_valid & valid
+    if not both.any():
+        raise SystemExit("❌ No crop was embedded by both paths")
+    similarity = cosine(reference[both], embeddings[both])
+    skipped = f", {int((~both).sum())} failed crop(s) skipped" if not both.all() else ""
+    print(f"🎯 {label}: cosine min {similarity.min():.5f}, mean {similarity.mean():.5f}{skipped}")
+    return float(similarity.min())
+
+
+def check(output: str, int8: bool, rois: list):
+    reference, reference_valid = main.DeepFaceBackend(batched=True).embed(rois)
+    for quantized in ([False, True] if int8 else [False]):
+        backend = main.OnnxBackend(output, int8=quantized)
+        if not backend.load():
+            raise SystemExit(f"❌ Could not load {output}: {backend.error}")
+        report(f"{'int8' if quantized else 'float32'} vs DeepFace", reference, reference_valid, *backend.embed(rois))
+
+
+def parity(output: str, rois: list, min_parity: float) -> bool:
+    enrolled, enrolled_valid = main.stack_embeddings([main.get_embedding_deepface(roi) for roi in rois])
+    worst = report("batched DeepFace vs enrolment path", enrolled, enrolled_valid, *main.DeepFaceBackend(batched=True).embed(rois))
+    if os.path.exists(output):
+        backend = main.OnnxBackend(output, int8=main.ONNX_INT8)
+        if backend.load():
+            worst = min(worst, report("ONNX vs enrolment path", enrolled, enrolled_valid, *backend.embed(rois)))
+        else:
+            print(f"⚠️ Skipping {output}: {backend.error}")
+    if worst < min_parity:
+        print(f"❌ Embeddings differ from the enrolment path (min cosine {worst:.4f} < {min_parity}); re-enrol students before switching")
+        return False
+    print(f"✅ Embeddings match the enrolment path (min cosine {worst:.4f})")
+    return True
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default=main.ARCFACE_ONNX_MODEL)
+    parser.add_argument("--check", action="store_true", help="compare against the DeepFace backend")
+    parser.add_argument("--int8", action="store_true", help="also check int8 weights")
+    parser.add_argument("--parity", action="store_true", help="only compare with the enrolment path, no export")
+    parser.add_argument("--min-parity", type=float, default=0.99)
+    parser.add_argument("--images", nargs="*", help="aligned face crops (files or glob patterns)")
+    parser.add_argument("--crops", type=int, default=16)
+    args = parser.parse_args()
+
+    if not main.load_deepface():
+        raise SystemExit("❌ DeepFace is required to export ArcFace")
+    rois = load_crops(args.images, args.crops)
+    if args.parity:
+        raise SystemExit(0 if parity(args.output, rois, args.min_parity) else 1)
+    export_arcface(args.output)
+    if args.check:
+        check(args.output, args.int8, rois)
+
+
+if __name__ == "__main__":
+    main_cli()
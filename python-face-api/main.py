@@ -3,21 +3,48 @@
 Production-ready with 99%+ accuracy using DeepFace and ArcFace model
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 from contextlib import asynccontextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+import asyncio
+import queue
+import multiprocessing
+import time
 import cv2
 import numpy as np
 import base64
 import io
 from PIL import Image
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple, Union
 import logging
 from datetime import datetime
 import os
 import threading
 import json
+import uuid
+import bisect
+import re
+import shutil
+import struct
+import mmap
+import tempfile
+import zipfile
+from contextlib import contextmanager, nullcontext
+from abc import ABC, abstractmethod
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process gallery sharing
+    fcntl = None
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field, replace
+from urllib.parse import quote, unquote
+
+# Reference point for the startup-time breakdown logged from lifespan()
+_PROCESS_T0 = time.perf_counter()
 
 
 # ============================================================================
@@ -34,26 +61,64 @@ logger = logging.getLogger(__name__)
 # DEEPFACE & MODEL SETUP
 # ============================================================================
 
-DEEPFACE_AVAILABLE = False
+# DeepFace/TensorFlow and the Haar cascade are loaded on first use (or by the
+# warm-up started from lifespan), never at module import. None = not tried yet.
+DEEPFACE_AVAILABLE: Optional[bool] = None
 DEEPFACE_ERROR = None
+DeepFace = None
 
-try:
-    from deepface import DeepFace
-    DEEPFACE_AVAILABLE = True
-    logger.info("✅ DeepFace imported successfully")
-except ImportError as e:
-    DEEPFACE_ERROR = str(e)
-    logger.warning(f"⚠️ DeepFace import failed: {e}")
-    try:
-        import face_recognition
-        logger.info("✅ face_recognition (dlib) available as fallback")
-    except ImportError:
-        logger.warning("⚠️ No advanced ML library available")
+_deepface_lock = threading.Lock()
+_face_cascade = None
+_cascade_lock = threading.Lock()
+
+# Seconds spent in each cold-start step, filled in as they happen
+startup_timings: dict = {}
+
+
+def load_deepface() -> bool:
+    """Import DeepFace (once, thread-safe) and report whether it is usable"""
+    global DEEPFACE_AVAILABLE, DEEPFACE_ERROR, DeepFace
+    
+    if DEEPFACE_AVAILABLE is not None:
+        return DEEPFACE_AVAILABLE
+    
+    with _deepface_lock:
+        if DEEPFACE_AVAILABLE is not None:
+            return DEEPFACE_AVAILABLE
+        
+        started = time.perf_counter()
+        try:
+            from deepface import DeepFace as _DeepFace
+            DeepFace = _DeepFace
+            DEEPFACE_AVAILABLE = True
+            logger.info("✅ DeepFace imported successfully")
+        except ImportError as e:
+            DEEPFACE_ERROR = str(e)
+            DEEPFACE_AVAILABLE = False
+            logger.warning(f"⚠️ DeepFace import failed: {e}")
+            try:
+                import face_recognition
+                logger.info("✅ face_recognition (dlib) available as fallback")
+            except ImportError:
+                logger.warning("⚠️ No advanced ML library available")
+        startup_timings["import_deepface"] = time.perf_counter() - started
+    
+    return DEEPFACE_AVAILABLE
 
-# Load OpenCV cascade for fallback face detection
-cascade_path = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
-face_cascade = cv2.CascadeClassifier(cascade_path)
-logger.info(f"✅ OpenCV Haar Cascade loaded from: {cascade_path}")
+
+def get_face_cascade() -> cv2.CascadeClassifier:
+    """Load (once) the OpenCV cascade used for fallback face detection"""
+    global _face_cascade
+    
+    if _face_cascade is None:
+        with _cascade_lock:
+            if _face_cascade is None:
+                started = time.perf_counter()
+                cascade_path = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+                _face_cascade = cv2.CascadeClassifier(cascade_path)
+                startup_timings["haar_cascade"] = time.perf_counter() - started
+                logger.info(f"✅ OpenCV Haar Cascade loaded from: {cascade_path}")
+    return _face_cascade
 
 # ============================================================================
 # CONFIGURATION
@@ -66,37 +131,1469 @@ ARCFACE_THRESHOLD = 0.68
 # Model dimensions for validation
 EXPECTED_EMBEDDING_DIMS = [512]  # ArcFace produces 512-d embeddings
 
+# Number of ranked candidates returned per face by /recognize
+RECOGNITION_TOP_K = 3
+
+# Inference pool: "thread" shares one model instance across workers, "process"
+# gives every worker its own model replica (INFERENCE_WORKERS replicas)
+INFERENCE_EXECUTOR = os.getenv("INFERENCE_EXECUTOR", "thread")
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "2"))
+# Jobs allowed to wait behind the running ones before requests are rejected
+INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "8"))
+# Retry-After (seconds) sent with 503 responses when the queue is full
+INFERENCE_RETRY_AFTER = int(os.getenv("INFERENCE_RETRY_AFTER", "1"))
+
+# Default reduced-resolution decode factor for /recognize and /test-detection
+# (1, 2, 4 or 8); boxes are always reported in full-resolution coordinates
+DECODE_SCALE = int(os.getenv("DECODE_SCALE", "1"))
+SUPPORTED_DECODE_SCALES = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+
+# Face detection mode: "full" runs RetinaFace on the whole frame (Haar cascade
+# fallback); "cascade" runs a cheap proposal pass (downscaled Haar, motion mask,
+# tracked boxes) and RetinaFace only on the proposed crops; "tiled" runs it on
+# overlapping full-resolution tiles for wide shots with small faces
+DETECTION_MODE = os.getenv("DETECTION_MODE", "full")
+SUPPORTED_DETECTION_MODES = ("full", "cascade", "tiled")
+# Per-endpoint defaults (RECOGNIZE_/TRAIN_/TEST_DETECTION_MODE); requests may
+# also pass `detection`
+ENDPOINT_DETECTION_MODES = {
+    endpoint: os.getenv(f"{endpoint.upper()}_DETECTION_MODE", DETECTION_MODE)
+    for endpoint in ("recognize", "train", "test")
+}
+# Width of the grayscale copy the proposal pass works on
+CASCADE_PROPOSAL_WIDTH = int(os.getenv("CASCADE_PROPOSAL_WIDTH", "640"))
+# Proposal boxes are grown by this fraction of their size on each side before
+# RetinaFace runs on the crop
+CASCADE_CROP_MARGIN = float(os.getenv("CASCADE_CROP_MARGIN", "0.5"))
+# Pixel change (0-255) that counts as motion between consecutive session frames
+CASCADE_MOTION_THRESHOLD = int(os.getenv("CASCADE_MOTION_THRESHOLD", "25"))
+# Moving blobs smaller than this fraction of the frame are ignored
+CASCADE_MOTION_MIN_AREA = float(os.getenv("CASCADE_MOTION_MIN_AREA", "0.002"))
+# Without a previous frame to compare against, fall back to full-frame
+# RetinaFace (no Haar or whole-image fallback) when the proposal pass finds nothing
+CASCADE_FULL_FALLBACK = os.getenv("CASCADE_FULL_FALLBACK", "1") == "1"
+# A tracked session skips static frames with no proposals, but every Nth
+# static frame in a row still gets a full RetinaFace pass so a still face
+# the Haar pass misses is found eventually
+CASCADE_STATIC_REFRESH_FRAMES = int(os.getenv("CASCADE_STATIC_REFRESH_FRAMES", "10"))
+
+# Resolution-aware detection: the detector sees a copy whose longer side is at
+# most DETECTION_MAX_SIDE px (0 = the decoded frame as is); boxes and eye
+# landmarks are mapped back and face crops are aligned from the full frame.
+# With DETECTION_PYRAMID a level that finds no face is retried at twice the
+# size, up to full resolution. Per request via `detect_max_side` / `detect_pyramid`
+DETECTION_MAX_SIDE = int(os.getenv("DETECTION_MAX_SIDE", "0"))
+DETECTION_PYRAMID = os.getenv("DETECTION_PYRAMID", "0") == "1"
+
+# Tiled detection: RetinaFace runs on DETECTION_TILE_SIZE px tiles that overlap
+# by DETECTION_TILE_OVERLAP of a tile, plus one whole-frame pass at tile size
+# for faces too large for the overlap. Per request via `detect_tile_size` /
+# `detect_tile_overlap`
+DETECTION_TILE_SIZE = int(os.getenv("DETECTION_TILE_SIZE", "960"))
+DETECTION_TILE_OVERLAP = float(os.getenv("DETECTION_TILE_OVERLAP", "0.2"))
+# Tiles of one frame detected in parallel (per inference worker process)
+DETECTION_TILE_WORKERS = int(os.getenv("DETECTION_TILE_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Boxes from different tiles covering more than this fraction of the smaller
+# one are the same face; the most complete box is kept
+DETECTION_TILE_NMS_OVERLAP = float(os.getenv("DETECTION_TILE_NMS_OVERLAP", "0.5"))
+
+# Adaptive quality for /recognize: when the p95 of recent request latencies
+# exceeds LATENCY_SLO_MS (0 = off) or the inference queue backs up, step down
+# one quality level (see QUALITY_LEVELS); step back up once p95 is below
+# QUALITY_RECOVER_RATIO of the budget with an empty queue
+LATENCY_SLO_MS = float(os.getenv("LATENCY_SLO_MS", "0"))
+# Requests in the latency window, and how many are needed before acting on it
+QUALITY_WINDOW = int(os.getenv("QUALITY_WINDOW", "40"))
+QUALITY_MIN_SAMPLES = int(os.getenv("QUALITY_MIN_SAMPLES", "10"))
+# Queue depth that counts as overload regardless of latency
+QUALITY_QUEUE_HIGH = int(os.getenv("QUALITY_QUEUE_HIGH", str(max(1, INFERENCE_QUEUE_SIZE // 2))))
+QUALITY_RECOVER_RATIO = float(os.getenv("QUALITY_RECOVER_RATIO", "0.6"))
+# Minimum time at a level before the next step
+QUALITY_COOLDOWN_SECONDS = float(os.getenv("QUALITY_COOLDOWN_SECONDS", "5"))
+# Lowest level allowed (3 permits the Haar cascade instead of RetinaFace)
+QUALITY_MAX_LEVEL = int(os.getenv("QUALITY_MAX_LEVEL", "3"))
+# Detector input cap (longer side, px) at the reduced levels
+QUALITY_REDUCED_SIDE = int(os.getenv("QUALITY_REDUCED_SIDE", "640"))
+
+# Startup mode: "background" serves immediately and imports/warms the models in
+# a background thread (/ready turns 200 when done), "eager" warms before the
+# server accepts traffic, "lazy" defers everything to the first request
+STARTUP_MODE = os.getenv("STARTUP_MODE", "background")
+# Warm-up attempts before giving up (/ready then stays 503 with the error)
+WARMUP_ATTEMPTS = int(os.getenv("WARMUP_ATTEMPTS", "3"))
+WARMUP_RETRY_SECONDS = float(os.getenv("WARMUP_RETRY_SECONDS", "5"))
+
+# Inference backend: "deepface" (reference, DeepFace on TensorFlow/Keras) or
+# "onnx" (ONNX Runtime on CPU, calling exported models directly on aligned
+# crops). onnx needs the optional onnxruntime package; if it cannot load, the
+# error is logged and reported in /status, the deepface backend serves requests
+# and /ready stays 503
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "deepface")
+# ArcFace exported to ONNX (e.g. with export_onnx.py); NHWC or NCHW input
+ARCFACE_ONNX_MODEL = os.getenv("ARCFACE_ONNX_MODEL", "models/arcface.onnx")
+# Optional RetinaFace export with the Pytorch_Retinaface outputs (loc, conf,
+# landms); without it the onnx backend detects through DeepFace
+RETINAFACE_ONNX_MODEL = os.getenv("RETINAFACE_ONNX_MODEL", "")
+RETINAFACE_CONFIDENCE = float(os.getenv("RETINAFACE_CONFIDENCE", "0.9"))
+# Use dynamically int8-quantized weights (<model>.int8.onnx, created on first use)
+ONNX_INT8 = os.getenv("ONNX_INT8", "0") == "1"
+# ONNX Runtime thread pools (0 = runtime default)
+ONNX_INTRA_OP_THREADS = int(os.getenv("ONNX_INTRA_OP_THREADS", "0"))
+ONNX_INTER_OP_THREADS = int(os.getenv("ONNX_INTER_OP_THREADS", "0"))
+
+# Micro-batching of ArcFace forward passes across faces and concurrent requests.
+# Off by default: the batched path skips DeepFace.represent's detector pass on
+# the crop, so its embeddings drift from galleries enrolled per crop. Turn it
+# on after export_onnx.py --parity passes, or re-enrol the students first
+EMBEDDING_BATCHING = os.getenv("EMBEDDING_BATCHING", "0") == "1"
+EMBEDDING_MAX_BATCH = int(os.getenv("EMBEDDING_MAX_BATCH", "32"))
+# How long the first crop in a batch may wait for company before it runs
+EMBEDDING_MAX_WAIT_MS = float(os.getenv("EMBEDDING_MAX_WAIT_MS", "5"))
+
+# Cross-frame face tracking for live sessions (/recognize with a session_id,
+# /ws/recognize): tracked faces reuse their identity instead of re-embedding
+FACE_TRACKING = os.getenv("FACE_TRACKING", "1") == "1"
+# Minimum box overlap (IoU) for a detection to continue an existing track
+TRACK_MATCH_IOU = float(os.getenv("TRACK_MATCH_IOU", "0.3"))
+# Below this IoU against the box it was last embedded at, a face has "moved"
+TRACK_MOVE_IOU = float(os.getenv("TRACK_MOVE_IOU", "0.6"))
+# Re-embed a recognized track after this many frames (unknown tracks 5x as often)
+TRACK_REFRESH_FRAMES = int(os.getenv("TRACK_REFRESH_FRAMES", "15"))
+# Tracks unseen for this many frames are dropped
+TRACK_MAX_MISSED = int(os.getenv("TRACK_MAX_MISSED", "5"))
+# Idle live sessions (and their per-session state) expire after this long
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "900"))
+
+# Duplicate-frame suppression for live sessions: a frame whose downsampled
+# grayscale thumbnail is within FRAME_DEDUP_THRESHOLD (largest per-cell
+# difference, 0-255) of the frame behind the session's last result gets that
+# result back (marked cached) without detection, embedding or matching
+FRAME_DEDUP = os.getenv("FRAME_DEDUP", "1") == "1"
+FRAME_DEDUP_THRESHOLD = float(os.getenv("FRAME_DEDUP_THRESHOLD", "8"))
+# A cached result is reused for at most this long before the frame is recomputed
+FRAME_CACHE_MAX_AGE_MS = float(os.getenv("FRAME_CACHE_MAX_AGE_MS", "2000"))
+FRAME_THUMBNAIL_SIZE = 32
+
+# /train: images are decoded, detected and embedded concurrently on the
+# inference pool (up to TRAIN_CONCURRENCY in flight, embeddings micro-batched)
+TRAIN_MAX_IMAGES = 50
+TRAIN_CONCURRENCY = int(os.getenv("TRAIN_CONCURRENCY", str(max(2, INFERENCE_WORKERS))))
+# Early stop (per request via `early_stop` / `target_faces`): finish once this
+# many good-quality faces agree with their mean embedding
+TRAIN_EARLY_STOP = os.getenv("TRAIN_EARLY_STOP", "0") == "1"
+TRAIN_TARGET_FACES = int(os.getenv("TRAIN_TARGET_FACES", "10"))
+# Good quality: face box at least this many pixels on its short side and a
+# Laplacian-variance sharpness of at least TRAIN_MIN_SHARPNESS
+TRAIN_MIN_FACE_SIZE = int(os.getenv("TRAIN_MIN_FACE_SIZE", "64"))
+TRAIN_MIN_SHARPNESS = float(os.getenv("TRAIN_MIN_SHARPNESS", "40"))
+# Minimum cosine similarity to the mean embedding for a face to count as consistent
+TRAIN_CONSISTENCY = float(os.getenv("TRAIN_CONSISTENCY", "0.75"))
+# /train/bulk: students trained at once (each with TRAIN_CONCURRENCY images in
+# flight), and the most students / uploaded files accepted per job
+BULK_TRAIN_CONCURRENCY = int(os.getenv("BULK_TRAIN_CONCURRENCY", "2"))
+BULK_TRAIN_MAX_STUDENTS = int(os.getenv("BULK_TRAIN_MAX_STUDENTS", "500"))
+BULK_TRAIN_MAX_FILES = int(os.getenv("BULK_TRAIN_MAX_FILES", "20000"))
+# Attempts per student when the inference queue is full before reporting it as failed
+BULK_TRAIN_RETRIES = int(os.getenv("BULK_TRAIN_RETRIES", "3"))
+# Largest zip upload accepted, and largest image inside it (uncompressed);
+# bigger members are listed as ignored
+BULK_TRAIN_MAX_UPLOAD_MB = float(os.getenv("BULK_TRAIN_MAX_UPLOAD_MB", "1024"))
+BULK_TRAIN_MAX_IMAGE_MB = float(os.getenv("BULK_TRAIN_MAX_IMAGE_MB", "20"))
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+# Offline attendance from recorded video (/attendance/video, video_attendance.py):
+# frames sampled per second of video, frames in flight on the inference pool,
+# and sightings needed before a student counts as present
+VIDEO_SAMPLE_FPS = float(os.getenv("VIDEO_SAMPLE_FPS", "1.0"))
+VIDEO_CONCURRENCY = int(os.getenv("VIDEO_CONCURRENCY", str(max(2, INFERENCE_WORKERS))))
+VIDEO_MIN_SIGHTINGS = int(os.getenv("VIDEO_MIN_SIGHTINGS", "2"))
+# Longest side of sampled frames (0 = native resolution)
+VIDEO_MAX_SIDE = int(os.getenv("VIDEO_MAX_SIDE", "1280"))
+
+# Named galleries: /load-students and /recognize take a gallery_id (class or
+# session id) so concurrent lectures keep separate rosters
+DEFAULT_GALLERY = "default"
+# Least recently used galleries are evicted while their matrices exceed this
+GALLERY_MEMORY_BUDGET_MB = float(os.getenv("GALLERY_MEMORY_BUDGET_MB", "512"))
+# Galleries not used for this long are evicted
+GALLERY_TTL_SECONDS = int(os.getenv("GALLERY_TTL_SECONDS", "14400"))
+# Per-gallery change log kept for delta sync; older clients need a full reload
+GALLERY_CHANGELOG_SIZE = int(os.getenv("GALLERY_CHANGELOG_SIZE", "1000"))
+# Directory for persistent gallery snapshots (float32 .npy matrix + JSON index),
+# memory-mapped back at startup; empty disables persistence
+GALLERY_SNAPSHOT_DIR = os.getenv("GALLERY_SNAPSHOT_DIR", "")
+# Share galleries between uvicorn worker processes: every worker maps the same
+# snapshot files (zero-copy, one copy in the page cache), writers take turns
+# under a file lock and bump a shared version counter that readers check on
+# each request. Without GALLERY_SNAPSHOT_DIR the files go to /dev/shm.
+GALLERY_SHARED = os.getenv("GALLERY_SHARED", "0") == "1"
+if GALLERY_SHARED and not GALLERY_SNAPSHOT_DIR:
+    GALLERY_SNAPSHOT_DIR = "/dev/shm/face-api-galleries" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "face-api-galleries")
+
+# Approximate nearest-neighbour (IVF) index for campus-scale galleries: "auto"
+# indexes galleries with at least ANN_MIN_GALLERY students, "off" disables it
+ANN_INDEX = os.getenv("ANN_INDEX", "auto")
+ANN_MIN_GALLERY = int(os.getenv("ANN_MIN_GALLERY", "10000"))
+# Number of inverted lists (0 = sqrt(N)); more lists = smaller, faster probes
+ANN_NLIST = int(os.getenv("ANN_NLIST", "0"))
+# Lists scanned per query (recall/latency knob, per request via `nprobe`; 0 = exact)
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "8"))
+# Retrain the centroids once the gallery has grown/shrunk by this factor
+# since training; smaller changes only assign the new rows to existing lists
+ANN_RETRAIN_FACTOR = float(os.getenv("ANN_RETRAIN_FACTOR", "2.0"))
+ANN_TRAIN_ITERATIONS = 10
+
+# Gallery storage precision: "float32", "float16" (half the memory) or "int8"
+# (a quarter, plus one float32 scale per row); per gallery via /load-students
+GALLERY_PRECISION = os.getenv("GALLERY_PRECISION", "float32")
+SUPPORTED_PRECISIONS = ("float32", "float16", "int8")
+# Rows converted at a time when scoring a quantized gallery; their float32
+# copy (rows x 2 KB) should fit in the L2 cache
+QUANT_BLOCK_ROWS = int(os.getenv("QUANT_BLOCK_ROWS", "256"))
+# Warn when quantization can move a similarity by more than this
+QUANT_MAX_ERROR = float(os.getenv("QUANT_MAX_ERROR", "0.02"))
+
 # ============================================================================
-# GLOBAL STATE
+# ANN INDEX
 # ============================================================================
 
-known_face_encodings: List[np.ndarray] = []
-known_face_names: List[str] = []
-known_face_ids: List[str] = []
-lock = threading.Lock()
+class IVFIndex:
+    """Inverted-file index over an L2-normalized gallery matrix.
+
+    Spherical k-means centroids partition the gallery rows into nlist lists.
+    A query scans only the rows of its `nprobe` closest lists, and that
+    shortlist is scored exactly against the full gallery rows, so the
+    similarities compared with ARCFACE_THRESHOLD are the same as in exact
+    search; only a true match outside the probed lists can be missed.
+    Instances are immutable: updated() returns a new index for a new snapshot.
+    """
+
+    def __init__(self, centroids: np.ndarray, assignments: np.ndarray, trained_size: int):
+        self.centroids = centroids
+        self.assignments = assignments
+        self.trained_size = trained_size
+        # CSR layout: rows of list l are order[offsets[l]:offsets[l + 1]]
+        self.order = np.argsort(assignments, kind="stable").astype(np.int32)
+        self.offsets = np.searchsorted(assignments[self.order], np.arange(len(centroids) + 1))
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.centroids.nbytes + self.assignments.nbytes + self.order.nbytes + self.offsets.nbytes)
+
+    @staticmethod
+    def _assign(rows: np.ndarray, centroids: np.ndarray, block: int = 8192) -> np.ndarray:
+        """Closest centroid per row, in blocks to bound the (rows, nlist) score matrix"""
+        out = np.empty(len(rows), dtype=np.int32)
+        for start in range(0, len(rows), block):
+            out[start:start + block] = np.argmax(rows[start:start + block] @ centroids.T, axis=1)
+        return out
+
+    @classmethod
+    def train(cls, encodings: np.ndarray, nlist: int = 0, iterations: int = ANN_TRAIN_ITERATIONS, seed: int = 0) -> "IVFIndex":
+        """Train centroids on a sample of the gallery and assign every row"""
+        n = len(encodings)
+        nlist = min(n, nlist or max(1, int(round(np.sqrt(n)))))
+        rng = np.random.default_rng(seed)
+        sample = encodings[np.sort(rng.choice(n, min(n, nlist * 64), replace=False))]
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        
+        for _ in range(iterations):
+            assign = cls._assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            # Re-seed empty lists from random sample rows
+            empty = np.bincount(assign, minlength=nlist) == 0
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+        
+        centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        return cls(centroids, cls._assign(encodings, centroids), n)
+
+    def updated(self, keep: np.ndarray, new_rows: np.ndarray) -> "IVFIndex":
+        """Index for a gallery made of rows `keep` of this one followed by `new_rows`"""
+        assignments = np.concatenate([self.assignments[keep], self._assign(new_rows, self.centroids)])
+        return IVFIndex(self.centroids, assignments, self.trained_size)
+
+    def search(self, queries: np.ndarray, gallery: np.ndarray, top_k: int, nprobe: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Same contract as match_embeddings(), scanning only the nprobe closest lists"""
+        nprobe = max(1, min(nprobe, self.nlist))
+        k = max(1, min(top_k, len(gallery)))
+        centroid_scores = queries @ self.centroids.T
+        probes = np.argpartition(-centroid_scores, nprobe - 1, axis=1)[:, :nprobe]
+        
+        top_idx = np.empty((len(queries), k), dtype=np.int64)
+        top_scores = np.empty((len(queries), k), dtype=np.float32)
+        for q, lists in enumerate(probes):
+            shortlist = np.concatenate([self.order[self.offsets[l]:self.offsets[l + 1]] for l in lists])
+            if len(shortlist) < k:
+                # Too few rows in the probed lists: score this query exactly
+                shortlist = np.arange(len(gallery))
+            idx, scores = match_embeddings(queries[q:q + 1], gallery[shortlist], k)
+            top_idx[q] = shortlist[idx[0]]
+            top_scores[q] = scores[0]
+        return top_idx, top_scores
+
+
+def build_ann_index(encodings: np.ndarray, previous: Optional[IVFIndex] = None, keep: Optional[np.ndarray] = None) -> Optional[IVFIndex]:
+    """IVF index for a gallery matrix, or None when exact search is used.
+
+    With the previous snapshot's index and the rows of it that were kept
+    (followed in `encodings` by the new rows) the centroids are reused and
+    only the new rows are assigned, until the size drifts past
+    ANN_RETRAIN_FACTOR from the size the centroids were trained on.
+    """
+    n = len(encodings)
+    if ANN_INDEX != "auto" or n < ANN_MIN_GALLERY:
+        return None
+    
+    if previous is not None and keep is not None:
+        growth = n / previous.trained_size
+        if 1.0 / ANN_RETRAIN_FACTOR <= growth <= ANN_RETRAIN_FACTOR:
+            return previous.updated(keep, encodings[len(keep):])
+    
+    started = time.perf_counter()
+    index = IVFIndex.train(encodings, ANN_NLIST)
+    logger.info(f"🗂️ Built IVF index: {n} rows in {index.nlist} lists ({(time.perf_counter() - started) * 1000:.0f}ms)")
+    return index
 
 
 # ============================================================================
-# DATA MODELS
+# QUANTIZED GALLERY STORAGE
 # ============================================================================
 
-class TrainingRequest(BaseModel):
-    student_id: str
-    images: List[str]
+class QuantizedMatrix:
+    """Compact (N, D) gallery matrix: float16 rows, or int8 rows with a scale each.
 
+    int8 rows are symmetric per-row quantized (row ~= codes * scale). scores()
+    streams the codes at their compact size (see there). `error` is the
+    largest row reconstruction error (L2); since queries are unit vectors it
+    bounds how far any similarity can drift from the float32 value. int8
+    scoring also rounds the queries to int8, which adds a drift of the same
+    order.
+    """
 
-class RecognitionRequest(BaseModel):
-    image: str
+    def __init__(self, codes: np.ndarray, scales: Optional[np.ndarray], precision: str, error: float = 0.0):
+        self.codes = codes
+        self.scales = scales
+        self.precision = precision
+        self.error = error
 
+    @classmethod
+    def quantize(cls, matrix: np.ndarray, precision: str) -> "QuantizedMatrix":
+        matrix = np.asarray(matrix, dtype=np.float32)
+        if precision == "float16":
+            codes = matrix.astype(np.float16)
+            scales = None
+            restored = codes.astype(np.float32)
+        else:
+            scales = np.maximum(np.abs(matrix).max(axis=1), 1e-12).astype(np.float32) / 127.0 if len(matrix) else np.empty(0, dtype=np.float32)
+            codes = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8) if len(matrix) else np.empty(matrix.shape, dtype=np.int8)
+            restored = codes.astype(np.float32) * scales[:, None]
+        error = float(np.linalg.norm(restored - matrix, axis=1).max()) if len(matrix) else 0.0
+        codes.setflags(write=False)
+        return cls(codes, scales, precision, error)
 
-class StudentData(BaseModel):
-    studentId: str
-    name: str
-    faceEmbeddings: List[float]
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.codes.shape
 
+    @property
+    def nbytes(self) -> int:
+        return int(self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0))
 
-class LiveRecognitionRequest(BaseModel):
-    students: List[StudentData]
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, rows) -> "QuantizedMatrix":
+        return QuantizedMatrix(self.codes[rows], self.scales[rows] if self.scales is not None else None, self.precision, self.error)
+
+    def to_float(self) -> np.ndarray:
+        restored = self.codes.astype(np.float32)
+        if self.scales is not None:
+            restored *= self.scales[:, None]
+        return restored
+
+    def quantize_queries(self, queries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """int8 codes of the queries (held as float32 for BLAS) and their per-query scales"""
+        scales = np.maximum(np.abs(queries).max(axis=1), 1e-12).astype(np.float32) / 127.0
+        return np.rint(queries / scales[:, None]).astype(np.float32), scales
+
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        """queries @ rows.T, shape (F, N).
+
+        Converts QUANT_BLOCK_ROWS rows at a time into a float32 buffer small
+        enough to stay in cache while BLAS reads it, so the gallery is read
+        from memory at its compact size. int8: the queries are quantized too
+        and the integer code products are accumulated, then both scales are
+        applied once. Every partial sum is an integer below 127 * 127 * 512 <
+        2**24, so the float32 BLAS accumulation is exact (the int32 result).
+        float16 blocks go through OpenCV's vectorized half conversion.
+        """
+        rows = len(self.codes)
+        out = np.empty((len(queries), rows), dtype=np.float32)
+        if self.scales is not None:
+            queries, query_scales = self.quantize_queries(queries)
+        buffer = np.empty((min(QUANT_BLOCK_ROWS, rows), self.codes.shape[1]), dtype=np.float32)
+        for start in range(0, rows, QUANT_BLOCK_ROWS):
+            codes = self.codes[start:start + QUANT_BLOCK_ROWS]
+            if self.precision == "float16" and _convert_fp16 is not None:
+                block = _convert_fp16(np.ascontiguousarray(codes).view(np.int16))
+            else:
+                block = buffer[:len(codes)]
+                np.copyto(block, codes)
+            np.matmul(queries, block.T, out=out[:, start:start + len(codes)])
+        if self.scales is not None:
+            out *= query_scales[:, None]
+            out *= self.scales
+        return out
+
+
+# float16 -> float32 with F16C where OpenCV has it (NumPy converts element by element)
+_convert_fp16 = getattr(cv2, "convertFp16", None)
+
+
+GalleryMatrix = Union[np.ndarray, QuantizedMatrix]
+
+
+def quantize_gallery(matrix: np.ndarray, precision: str) -> GalleryMatrix:
+    """Store a normalized float32 gallery matrix at the given precision"""
+    if precision == "float32":
+        return matrix
+    return QuantizedMatrix.quantize(matrix, precision)
+
+
+def gallery_floats(matrix: GalleryMatrix) -> np.ndarray:
+    """float32 rows of a gallery matrix (dequantized if needed)"""
+    if isinstance(matrix, QuantizedMatrix):
+        return matrix.to_float()
+    return np.asarray(matrix, dtype=np.float32)
+
+
+def gallery_scores(queries: np.ndarray, matrix: GalleryMatrix) -> np.ndarray:
+    """Cosine similarities (F, N) of normalized queries against a gallery matrix"""
+    if isinstance(matrix, QuantizedMatrix):
+        return matrix.scores(queries)
+    return queries @ matrix.T
+
+
+# ============================================================================
+# METRICS
+# ============================================================================
+
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _series(name: str, label_names: Tuple[str, ...], labels: tuple, extra: str = "") -> str:
+    pairs = [f'{key}="{_label_value(value)}"' for key, value in zip(label_names, labels)]
+    if extra:
+        pairs.append(extra)
+    return f"{name}{{{','.join(pairs)}}}" if pairs else name
+
+
+class Counter:
+    """Monotonic counter, one series per label tuple"""
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            return [f"{_series(self.name, self.labels, labels)} {value:g}" for labels, value in self._values.items()]
+
+
+class Histogram:
+    """Cumulative-bucket histogram; observe() is a bisect and three additions"""
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...], labels: Tuple[str, ...] = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [count per bucket..., +Inf count, sum]
+        self._values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = {labels: list(series) for labels, series in self._values.items()}
+        lines = []
+        for labels, series in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                bucket = _series(self.name + "_bucket", self.labels, labels, 'le="' + le + '"')
+                lines.append(f"{bucket} {cumulative}")
+            lines.append(f"{_series(self.name + '_sum', self.labels, labels)} {series[-1]:g}")
+            lines.append(f"{_series(self.name + '_count', self.labels, labels)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """Value read at scrape time from a callback returning {labels: value}"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, read, labels: Tuple[str, ...] = (), kind: str = "gauge"):
+        self.name, self.help, self.labels = name, help, labels
+        self.read = read
+        self.kind = kind
+
+    def samples(self) -> List[str]:
+        return [f"{_series(self.name, self.labels, labels)} {value:g}" for labels, value in self.read().items()]
+
+
+class MetricsRegistry:
+    """In-process metrics rendered in the Prometheus text format by /metrics.
+
+    Everything is per process: with several uvicorn workers each one serves
+    its own numbers. Work done on process-pool workers is recorded here from
+    the timings and stage counts they return.
+    """
+
+    def __init__(self):
+        self._metrics: list = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, buckets: Tuple[float, ...], labels: Tuple[str, ...] = ()) -> Histogram:
+        return self.register(Histogram(name, help, buckets, labels))
+
+    def gauge(self, name: str, help: str, read, labels: Tuple[str, ...] = (), kind: str = "gauge") -> Gauge:
+        return self.register(Gauge(name, help, read, labels, kind))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                logger.warning(f"⚠️ Metric {metric.name} failed: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOCK_WAIT_BUCKETS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0)
+
+metrics = MetricsRegistry()
+stage_seconds = metrics.histogram(
+    "face_api_stage_seconds", "Time spent per pipeline stage",
+    LATENCY_BUCKETS, ("endpoint", "stage")
+)
+queue_wait_seconds = metrics.histogram(
+    "face_api_inference_queue_wait_seconds", "Time a job waited for an inference worker",
+    LATENCY_BUCKETS, ("job",)
+)
+lock_wait_seconds = metrics.histogram(
+    "face_api_lock_wait_seconds", "Time spent waiting for gallery locks",
+    LOCK_WAIT_BUCKETS, ("lock",)
+)
+faces_per_frame = metrics.histogram(
+    "face_api_faces_per_frame", "Faces detected per recognized frame",
+    (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+)
+faces_total = metrics.counter("face_api_faces_total", "Faces reported by /recognize", ("result",))
+detector_fallbacks = metrics.counter(
+    "face_api_detector_fallbacks_total", "Frames where the Haar cascade stood in for RetinaFace", ("reason",)
+)
+frames_total = metrics.counter("face_api_frames_total", "Frames handled by /recognize", ("outcome",))
+# Read at scrape time from the pool and the gallery registry
+metrics.gauge("face_api_inference_queue_depth", "Jobs waiting for an inference worker", lambda: {(): inference_pool.stats()["queue_depth"]})
+metrics.gauge("face_api_inference_running", "Jobs running on inference workers", lambda: {(): inference_pool.stats()["running"]})
+metrics.gauge("face_api_inference_rejected_total", "Jobs rejected because the inference queue was full", lambda: {(): inference_pool.rejected}, kind="counter")
+metrics.gauge("face_api_embedding_batches_total", "ArcFace micro-batches run", lambda: {(): embedding_batcher.stats()["batches"]}, kind="counter")
+metrics.gauge(
+    "face_api_gallery_students", "Students in each loaded gallery",
+    lambda: {(g["gallery_id"],): g["students"] for g in galleries.list(include_stored=False)}, ("gallery_id",)
+)
+metrics.gauge("face_api_gallery_bytes", "Memory held by loaded gallery matrices", lambda: {(): galleries.stats()["bytes"]})
+metrics.gauge(
+    "face_api_quality_level", "Current /recognize quality level (0 = full quality)",
+    lambda: {(QUALITY_LEVELS[quality.level].name,): quality.level}, ("name",)
+)
+metrics.gauge(
+    "face_api_quality_changes_total", "Adaptive quality steps",
+    lambda: {(direction,): count for direction, count in quality.changes.items()}, ("direction",), kind="counter"
+)
+
+
+# ============================================================================
+# GLOBAL STATE
+# ============================================================================
+
+@dataclass(frozen=True)
+class GallerySnapshot:
+    """Immutable, versioned view of one loaded gallery.
+
+    encodings is a read-only contiguous (N, 512) float32 matrix of L2-normalized
+    embeddings (or its float16/int8 QuantizedMatrix); row i belongs to
+    names[i] / ids[i]. Readers grab a reference once per request and never
+    need a lock. Large galleries also carry an IVF index over those rows.
+    """
+    gallery_id: str
+    version: int
+    encodings: GalleryMatrix
+    names: Tuple[str, ...]
+    ids: Tuple[str, ...]
+    index: Optional[IVFIndex] = None
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.encodings.nbytes) + (self.index.nbytes if self.index is not None else 0)
+
+    @property
+    def precision(self) -> str:
+        return self.encodings.precision if isinstance(self.encodings, QuantizedMatrix) else "float32"
+
+    @property
+    def quantization_error(self) -> float:
+        return self.encodings.error if isinstance(self.encodings, QuantizedMatrix) else 0.0
+
+
+class GalleryConflict(Exception):
+    """Raised when a delta is based on a gallery version that is no longer current"""
+
+    def __init__(self, current_version: Optional[int]):
+        super().__init__(f"Gallery is at version {current_version}")
+        self.current_version = current_version
+
+
+class GalleryStore:
+    """Persists gallery snapshots to GALLERY_SNAPSHOT_DIR and maps them back.
+
+    Each gallery is a raw float32 .npy matrix (plus the IVF arrays, if any)
+    named after its version, and a <gallery>.json index with version, names
+    and ids that points at it. Files are written to a temp name and renamed,
+    and the index is replaced last, so a crash never leaves a half-written
+    snapshot visible. Loading uses np.load(mmap_mode="r"): startup costs
+    milliseconds and worker processes mapping the same file share its pages.
+
+    Saves happen on a background thread; bursts of updates to one gallery
+    coalesce into a single write of the latest snapshot. Files of older
+    versions that cannot be deleted yet (Windows refuses while a process still
+    maps them) are retried on the gallery's next save and at startup
+    (cleanup()). registry.hwm holds the highest version ever handed out, so
+    versions stay unique across restarts even for deleted galleries.
+    """
+
+    HIGH_WATER_NAME = "registry.hwm"
+    # Versioned data files: <gallery>.v<version>.npy / .scales.npy / .ivf.npz
+    DATA_FILE = re.compile(r"^(?P<gallery>.+)\.v\d+\.(npy|scales\.npy|ivf\.npz)$")
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._pending: Dict[str, Optional["GallerySnapshot"]] = {}  # None = delete
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self.saves = 0
+        self.errors = 0
+        self.last_save_ms = 0.0
+        self._stale_files: Dict[str, int] = {}
+        self._high_water = 0
+        self._high_water_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _index_name(self, gallery_id: str) -> str:
+        return quote(gallery_id, safe="") + ".json"
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="gallery-store", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Write everything still pending and stop the writer thread"""
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join()
+        self._thread = None
+
+    def save(self, snapshot: "GallerySnapshot"):
+        if not self.enabled:
+            return
+        with self._cond:
+            self._pending[snapshot.gallery_id] = snapshot
+            self._cond.notify()
+
+    def delete(self, gallery_id: str):
+        if not self.enabled:
+            return
+        with self._cond:
+            self._pending[gallery_id] = None
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if not self._pending and self._stopping:
+                    return
+                pending, self._pending = self._pending, {}
+            for gallery_id, snapshot in pending.items():
+                try:
+                    if snapshot is None:
+                        self._remove(gallery_id)
+                    else:
+                        self._write(snapshot)
+                except Exception as e:
+                    self.errors += 1
+                    logger.error(f"❌ Failed to persist gallery '{gallery_id}': {e}")
+
+    def _read_index(self, gallery_id: str) -> Optional[dict]:
+        try:
+            with open(self._path(self._index_name(gallery_id)), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _replace(self, name: str, write):
+        """Write a file through a temp name, fsync it and rename it into place"""
+        tmp = self._path(name + ".tmp")
+        with open(tmp, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path(name))
+
+    def _write(self, snapshot: "GallerySnapshot"):
+        started = time.perf_counter()
+        base = quote(snapshot.gallery_id, safe="") + f".v{snapshot.version}"
+        
+        matrix_name = base + ".npy"
+        scales_name = None
+        if isinstance(snapshot.encodings, QuantizedMatrix):
+            self._replace(matrix_name, lambda f: np.save(f, np.ascontiguousarray(snapshot.encodings.codes)))
+            if snapshot.encodings.scales is not None:
+                scales_name = base + ".scales.npy"
+                self._replace(scales_name, lambda f: np.save(f, np.ascontiguousarray(snapshot.encodings.scales)))
+        else:
+            self._replace(matrix_name, lambda f: np.save(f, np.ascontiguousarray(snapshot.encodings, dtype=np.float32)))
+        index_name = None
+        if snapshot.index is not None:
+            index_name = base + ".ivf.npz"
+            self._replace(index_name, lambda f: np.savez(
+                f,
+                centroids=snapshot.index.centroids,
+                assignments=snapshot.index.assignments,
+                trained_size=np.int64(snapshot.index.trained_size)
+            ))
+        
+        meta = {
+            "gallery_id": snapshot.gallery_id,
+            "version": snapshot.version,
+            "count": len(snapshot),
+            "dim": int(snapshot.encodings.shape[1]),
+            "precision": snapshot.precision,
+            "quantization_error": snapshot.quantization_error,
+            "matrix": matrix_name,
+            "scales": scales_name,
+            "index": index_name,
+            "names": list(snapshot.names),
+            "ids": list(snapshot.ids),
+            "saved_at": datetime.now().isoformat()
+        }
+        self._replace(self._index_name(snapshot.gallery_id), lambda f: f.write(json.dumps(meta).encode("utf-8")))
+        
+        # Old files can go once the index no longer points at them; processes
+        # that still map them keep their pages until they let go
+        self._delete_stale(quote(snapshot.gallery_id, safe=""), self._files(meta))
+        
+        self.saves += 1
+        self.last_save_ms = (time.perf_counter() - started) * 1000.0
+        logger.debug(f"💾 Saved gallery '{snapshot.gallery_id}' v{snapshot.version} ({self.last_save_ms:.0f}ms)")
+
+    def write(self, snapshot: "GallerySnapshot"):
+        """Write a snapshot now, on the caller's thread (shared mode publishes only once it is on disk)"""
+        with self._cond:
+            self._pending.pop(snapshot.gallery_id, None)
+        os.makedirs(self.directory, exist_ok=True)
+        self._write(snapshot)
+
+    def remove_now(self, gallery_id: str):
+        with self._cond:
+            self._pending.pop(gallery_id, None)
+        self._remove(gallery_id)
+
+    def index_mtimes(self, gallery_ids: Optional[List[str]] = None) -> Dict[str, int]:
+        """Modification times (ns) of the gallery index files, by gallery id"""
+        if gallery_ids is not None:
+            names = [self._index_name(gallery_id) for gallery_id in gallery_ids]
+        elif os.path.isdir(self.directory):
+            names = [name for name in os.listdir(self.directory) if name.endswith(".json")]
+        else:
+            names = []
+        mtimes = {}
+        for name in names:
+            try:
+                mtimes[unquote(name[:-len(".json")])] = os.stat(self._path(name)).st_mtime_ns
+            except FileNotFoundError:
+                pass
+        return mtimes
+
+    def _remove(self, gallery_id: str):
+        previous = self._read_index(gallery_id)
+        if previous is None:
+            return
+        os.remove(self._path(self._index_name(gallery_id)))
+        self._delete_stale(quote(gallery_id, safe=""), [])
+
+    def _delete_files(self, names: List[str]) -> int:
+        """Delete data files, returning how many could not be deleted (still mapped on Windows)"""
+        failed = 0
+        for name in names:
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                failed += 1
+                logger.warning(f"⚠️ Could not delete stale gallery file {name} ({e}); retrying on the next save")
+        return failed
+
+    def _delete_stale(self, quoted_id: str, keep: List[str]):
+        """Delete every versioned data file of one gallery except `keep`"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        stale = [name for name in names if name not in keep and self._data_file_gallery(name) == quoted_id]
+        failed = self._delete_files(stale)
+        if failed:
+            self._stale_files[quoted_id] = failed
+        else:
+            self._stale_files.pop(quoted_id, None)
+
+    def _data_file_gallery(self, name: str) -> Optional[str]:
+        match = self.DATA_FILE.match(name)
+        return match.group("gallery") if match else None
+
+    def cleanup(self) -> int:
+        """Delete data files and temp files no index points at (startup); returns how many were deleted"""
+        if not self.enabled or not os.path.isdir(self.directory):
+            return 0
+        referenced = {name for meta in self.indexes() for name in self._files(meta)}
+        names = os.listdir(self.directory)
+        stale = [name for name in names if name.endswith(".tmp") or (self._data_file_gallery(name) and name not in referenced)]
+        failed = self._delete_files(stale)
+        self._stale_files = {"": failed} if failed else {}
+        return len(stale) - failed
+
+    def high_water(self) -> int:
+        """Highest gallery version ever handed out (0 if none was recorded)"""
+        if not self.enabled:
+            return 0
+        try:
+            with open(self._path(self.HIGH_WATER_NAME), encoding="utf-8") as f:
+                recorded = int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+        with self._high_water_lock:
+            self._high_water = max(self._high_water, recorded)
+        return recorded
+
+    def record_version(self, version: int):
+        """Persist version as the high-water mark if it is above the last one recorded"""
+        if not self.enabled:
+            return
+        with self._high_water_lock:
+            if version <= self._high_water:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._replace(self.HIGH_WATER_NAME, lambda f: f.write(str(version).encode("ascii")))
+            self._high_water = version
+
+    @staticmethod
+    def _files(meta: dict) -> List[str]:
+        """Data files an index points at"""
+        return [meta[key] for key in ("matrix", "scales", "index") if meta.get(key)]
+
+    def exists(self, gallery_id: str) -> bool:
+        if not self.enabled:
+            return False
+        with self._cond:
+            if gallery_id in self._pending:
+                return self._pending[gallery_id] is not None
+        return os.path.exists(self._path(self._index_name(gallery_id)))
+
+    def load(self, gallery_id: str) -> Optional["GallerySnapshot"]:
+        """Snapshot saved for gallery_id (memory-mapped), or None"""
+        if not self.enabled:
+            return None
+        with self._cond:
+            if gallery_id in self._pending:
+                return self._pending[gallery_id]
+        meta = self._read_index(gallery_id)
+        if meta is None:
+            return None
+        return self._load(meta)
+
+    def _load(self, meta: dict) -> Optional["GallerySnapshot"]:
+        try:
+            encodings = np.load(self._path(meta["matrix"]), mmap_mode="r")
+            if encodings.shape != (meta["count"], meta["dim"]) or len(meta["names"]) != meta["count"]:
+                raise ValueError(f"matrix shape {encodings.shape} does not match index")
+            precision = meta.get("precision", "float32")
+            if precision != "float32":
+                scales = np.load(self._path(meta["scales"]), mmap_mode="r") if meta.get("scales") else None
+                encodings = QuantizedMatrix(encodings, scales, precision, float(meta.get("quantization_error", 0.0)))
+            index = None
+            if meta.get("index"):
+                with np.load(self._path(meta["index"])) as arrays:
+                    index = IVFIndex(arrays["centroids"], arrays["assignments"], int(arrays["trained_size"]))
+            return GallerySnapshot(
+                gallery_id=meta["gallery_id"],
+                version=int(meta["version"]),
+                encodings=encodings,
+                names=tuple(meta["names"]),
+                ids=tuple(meta["ids"]),
+                index=index
+            )
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"❌ Failed to load gallery snapshot '{meta.get('gallery_id')}': {e}")
+            return None
+
+    def indexes(self) -> List[dict]:
+        """Index metadata (version, count, names, ...) of every persisted gallery"""
+        if not self.enabled or not os.path.isdir(self.directory):
+            return []
+        metas = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(self._path(name), encoding="utf-8") as f:
+                    metas.append(json.load(f))
+            except FileNotFoundError:
+                continue  # removed since listdir
+            except (OSError, ValueError) as e:
+                self.errors += 1
+                logger.error(f"❌ Unreadable gallery index {name}: {e}")
+        return metas
+
+    def load_all(self) -> List["GallerySnapshot"]:
+        snapshots = []
+        for meta in self.indexes():
+            snapshot = self._load(meta)
+            if snapshot is not None:
+                snapshots.append(snapshot)
+        return snapshots
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "directory": self.directory or None,
+            "pending": len(self._pending),
+            "saves": self.saves,
+            "errors": self.errors,
+            "stale_files": sum(self._stale_files.values()),
+            "last_save_ms": self.last_save_ms
+        }
+
+
+class SharedGalleryCounter:
+    """Registry version shared by worker processes through a memory-mapped file.
+
+    A writer holds an exclusive flock on registry.lock while it publishes,
+    takes the next version from the counter and stores it once its snapshot
+    files are on disk. Readers compare the counter with the version they last
+    synced, which is a single 8-byte read.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._map: Optional[mmap.mmap] = None
+        self._lock_fd: Optional[int] = None
+        self._thread_lock = threading.Lock()  # flock does not exclude threads of one process
+        self._open_lock = threading.Lock()
+
+    def _open(self):
+        with self._open_lock:
+            if self._map is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            fd = os.open(os.path.join(self.directory, "registry.version"), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size < 8:
+                    os.ftruncate(fd, 8)
+                self._map = mmap.mmap(fd, 8)
+            finally:
+                os.close(fd)
+            self._lock_fd = os.open(os.path.join(self.directory, "registry.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+
+    def read(self) -> int:
+        if self._map is None:
+            self._open()
+        return struct.unpack_from("<q", self._map, 0)[0]
+
+    def write(self, version: int):
+        struct.pack_into("<q", self._map, 0, version)
+
+    @contextmanager
+    def exclusive(self):
+        """Be the only writer across all worker processes"""
+        if self._map is None:
+            self._open()
+        with self._thread_lock:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+
+class GalleryRegistry:
+    """Named gallery snapshots with LRU/TTL eviction and delta updates.
+
+    Writers are serialized by a writer lock and build the next snapshot (and
+    its ANN index) outside the reader lock, which is only held for the swap.
+    publish() swaps in a new snapshot and takes the
+    next value of a registry-wide version counter, so versions never repeat
+    even when a gallery is evicted and loaded again (or, with a GalleryStore,
+    deleted before a restart: the counter's high-water mark is persisted). Galleries idle for
+    GALLERY_TTL_SECONDS expire, and the least recently used ones are evicted
+    while the total matrix size exceeds GALLERY_MEMORY_BUDGET_MB.
+
+    apply_changes() upserts/removes individual students and records each
+    change in a bounded per-gallery log so clients can pull only the changes
+    since a version they already hold.
+
+    With a GalleryStore every published snapshot is also persisted; restore()
+    maps them back at startup, and a gallery evicted from memory is mapped
+    back from disk the next time it is requested.
+
+    With a SharedGalleryCounter (GALLERY_SHARED) the snapshot files are the
+    gallery: writers publish under the cross-process lock, write the files
+    synchronously and keep the memory-mapped copy, and every reader
+    re-maps the galleries that changed when it sees the counter move
+    (sync()). Change logs stay per process, so a worker that did not make a
+    change answers /changes with a full reload.
+    """
+
+    def __init__(self, budget_bytes: int, ttl_seconds: int, store: Optional[GalleryStore] = None, shared: Optional[SharedGalleryCounter] = None):
+        self.budget_bytes = budget_bytes
+        self.store = store or GalleryStore("")
+        self.shared = shared
+        self._synced = 0
+        self._index_mtimes: Dict[str, int] = {}
+        self.ttl = ttl_seconds
+        self._galleries: "OrderedDict[str, GallerySnapshot]" = OrderedDict()
+        self._last_used: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._version = 0
+        self._changes: Dict[str, deque] = {}
+        # Oldest version the change log can still replay from, per gallery
+        self._changes_floor: Dict[str, int] = {}
+        # remove() calls per gallery, so get() never re-registers a gallery
+        # deleted while it was loading it
+        self._removals: Dict[str, int] = {}
+        self.evictions = 0
+
+    def get(self, gallery_id: str) -> Optional[GallerySnapshot]:
+        """Current snapshot of a gallery (marks it as recently used).
+
+        May read the disk (sync, or mapping a gallery back from the store), so
+        async routes call it through asyncio.to_thread. The store is read
+        outside the lock; the loaded snapshot is only registered if nothing
+        newer arrived and the gallery was not removed meanwhile.
+        """
+        self.sync()
+        started = time.perf_counter()
+        with self._lock:
+            lock_wait_seconds.observe(time.perf_counter() - started, "gallery_read")
+            self._evict()
+            snapshot = self._galleries.get(gallery_id)
+            if snapshot is not None:
+                self._galleries.move_to_end(gallery_id)
+                self._last_used[gallery_id] = time.monotonic()
+                return snapshot
+            removals = self._removals.get(gallery_id, 0)
+        if not self.store.enabled:
+            return None
+        
+        loaded = self.store.load(gallery_id)
+        if loaded is None:
+            return None
+        with self._lock:
+            snapshot = self._galleries.get(gallery_id)
+            if self._removals.get(gallery_id, 0) != removals:
+                return snapshot
+            if snapshot is None or loaded.version > snapshot.version:
+                self._restore(loaded)
+                logger.info(f"💾 Mapped gallery '{gallery_id}' v{loaded.version} back from disk")
+                return loaded
+            self._galleries.move_to_end(gallery_id)
+            self._last_used[gallery_id] = time.monotonic()
+            return snapshot
+
+    def restore(self) -> int:
+        """Map every persisted gallery back into the registry; returns how many.
+
+        Versions resume from the store's high-water mark, not the highest
+        surviving snapshot, so deleted galleries' versions are not reused.
+        Stale files left by earlier runs are deleted first.
+        """
+        with self._writer():
+            removed = self.store.cleanup()
+            if removed:
+                logger.info(f"🧹 Deleted {removed} stale gallery file(s)")
+            high_water = self.store.high_water()
+        if self.shared is not None:
+            self._synced = self.shared.read()
+            self._index_mtimes = self.store.index_mtimes()
+        snapshots = self.store.load_all()
+        with self._lock:
+            for snapshot in snapshots:
+                self._restore(snapshot)
+            self._version = max(self._version, self._synced, high_water)
+        return len(snapshots)
+
+    def sync(self):
+        """Re-map galleries other workers changed since the last sync (no-op if the shared counter has not moved)"""
+        if self.shared is None:
+            return
+        version = self.shared.read()
+        if version == self._synced:
+            return
+        mtimes = self.store.index_mtimes()
+        with self._lock:
+            changed = [gallery_id for gallery_id, mtime in mtimes.items() if self._index_mtimes.get(gallery_id) != mtime]
+            removed = [gallery_id for gallery_id in self._index_mtimes if gallery_id not in mtimes]
+            # Galleries not mapped here are mapped lazily by get() when requested
+            mapped = [gallery_id for gallery_id in changed if gallery_id in self._galleries]
+        # Map the new files outside the lock, then swap in only what is still
+        # newer than the snapshot held by then
+        loaded = [self.store.load(gallery_id) for gallery_id in mapped]
+        snapshots = []
+        with self._lock:
+            for snapshot in loaded:
+                if snapshot is None:
+                    continue
+                current = self._galleries.get(snapshot.gallery_id)
+                if current is not None and snapshot.version > current.version:
+                    self._restore(snapshot)
+                    snapshots.append(snapshot)
+            for gallery_id in removed:
+                if gallery_id in self._galleries:
+                    self._drop(gallery_id, "removed by another worker")
+            self._version = max(self._version, version)
+            self._index_mtimes = mtimes
+            self._synced = max(self._synced, version)
+        if snapshots:
+            logger.info(f"🔄 Synced {len(snapshots)} gallery update(s) from other workers (registry v{version})")
+
+    def _writer(self):
+        """Cross-process writer lock in shared mode, nothing otherwise"""
+        return self.shared.exclusive() if self.shared is not None else nullcontext()
+
+    def _commit(self, snapshot: GallerySnapshot) -> GallerySnapshot:
+        """Persist a new snapshot: queued for the background writer, or in shared
+        mode written now and swapped for its memory-mapped copy before the
+        shared counter announces it"""
+        if self.shared is None:
+            self.store.save(snapshot)
+            return snapshot
+        self.store.write(snapshot)
+        mapped = self.store.load(snapshot.gallery_id) or snapshot
+        with self._lock:
+            if self._galleries.get(snapshot.gallery_id) is snapshot:
+                self._galleries[snapshot.gallery_id] = mapped
+            self._index_mtimes.update(self.store.index_mtimes([snapshot.gallery_id]))
+        self.shared.write(snapshot.version)
+        return mapped
+
+    def _restore(self, snapshot: GallerySnapshot):
+        self._version = max(self._version, snapshot.version)
+        self._store(snapshot)
+        self._changes[snapshot.gallery_id] = deque(maxlen=GALLERY_CHANGELOG_SIZE)
+        self._changes_floor[snapshot.gallery_id] = snapshot.version
+
+    def peek(self, gallery_id: str, from_store: bool = True) -> Optional[GallerySnapshot]:
+        """Current snapshot of a gallery without touching its LRU position.
+
+        A gallery this process has not mapped (evicted, or published by
+        another worker) is read from the store without being registered,
+        unless from_store is False.
+        """
+        with self._lock:
+            snapshot = self._galleries.get(gallery_id)
+        if snapshot is None and from_store and self.store.enabled:
+            snapshot = self.store.load(gallery_id)
+        return snapshot
+
+    def publish(self, gallery_id: str, encodings: np.ndarray, names: List[str], ids: List[str], precision: Optional[str] = None) -> GallerySnapshot:
+        """Atomically swap in a new snapshot for gallery_id and return it.
+
+        encodings is the normalized float32 matrix; it is stored at `precision`
+        (default GALLERY_PRECISION).
+        """
+        encodings.setflags(write=False)
+        started = time.perf_counter()
+        with self._write_lock, self._writer():
+            lock_wait_seconds.observe(time.perf_counter() - started, "gallery_write")
+            index = build_ann_index(encodings)
+            stored = quantize_gallery(encodings, precision or GALLERY_PRECISION)
+            with self._lock:
+                self._version = max(self._version, self.shared.read() if self.shared is not None else 0) + 1
+                snapshot = GallerySnapshot(
+                    gallery_id=gallery_id,
+                    version=self._version,
+                    encodings=stored,
+                    names=tuple(names),
+                    ids=tuple(ids),
+                    index=index
+                )
+                self._store(snapshot)
+                # A full load replaces the history; older versions must reload too
+                self._changes[gallery_id] = deque(maxlen=GALLERY_CHANGELOG_SIZE)
+                self._changes_floor[gallery_id] = snapshot.version
+            self.store.record_version(snapshot.version)
+            snapshot = self._commit(snapshot)
+        return snapshot
+
+    def apply_changes(self, gallery_id: str, upserts: List[Tuple[str, str, np.ndarray]], removals: List[str], base_version: Optional[int] = None) -> Tuple[GallerySnapshot, int, int]:
+        """Publish a new snapshot with students upserted/removed by student id.
+
+        upserts are (student_id, name, normalized embedding). If base_version
+        is given it must equal the current version, otherwise GalleryConflict
+        is raised and nothing changes. Returns (snapshot, upserted, removed).
+        """
+        upserts_by_id = {student_id: (name, emb) for student_id, name, emb in upserts}
+        
+        started = time.perf_counter()
+        with self._write_lock, self._writer():
+            lock_wait_seconds.observe(time.perf_counter() - started, "gallery_write")
+            current = self.get(gallery_id) if self.store.enabled else self.peek(gallery_id)
+            current_version = current.version if current is not None else None
+            if base_version is not None and base_version != (current_version or 0):
+                raise GalleryConflict(current_version)
+            
+            if current is not None:
+                changed = set(upserts_by_id) | set(removals)
+                keep = np.array([i for i, student_id in enumerate(current.ids) if student_id not in changed], dtype=np.int64)
+                removed = sum(1 for student_id in set(removals) if student_id in current.ids)
+                encodings = gallery_floats(current.encodings[keep])
+                names = [current.names[i] for i in keep]
+                ids = [current.ids[i] for i in keep]
+            else:
+                keep = None
+                removed = 0
+                encodings = np.empty((0, EXPECTED_EMBEDDING_DIMS[0]), dtype=np.float32)
+                names = []
+                ids = []
+            
+            if upserts_by_id:
+                encodings = np.vstack([encodings, np.vstack([emb for _, emb in upserts_by_id.values()])])
+                names.extend(name for name, _ in upserts_by_id.values())
+                ids.extend(upserts_by_id)
+            encodings = np.ascontiguousarray(encodings, dtype=np.float32)
+            encodings.setflags(write=False)
+            index = build_ann_index(encodings, current.index if current is not None else None, keep)
+            stored = quantize_gallery(encodings, current.precision if current is not None else GALLERY_PRECISION)
+            if isinstance(stored, QuantizedMatrix) and current is not None:
+                # Kept rows were re-quantized from their dequantized values, so
+                # their error against the original embeddings carries over
+                stored.error = max(stored.error, current.quantization_error)
+            
+            with self._lock:
+                self._version = max(self._version, self.shared.read() if self.shared is not None else 0) + 1
+                snapshot = GallerySnapshot(
+                    gallery_id=gallery_id,
+                    version=self._version,
+                    encodings=stored,
+                    names=tuple(names),
+                    ids=tuple(ids),
+                    index=index
+                )
+                self._store(snapshot)
+                
+                if current is None or gallery_id not in self._changes:
+                    self._changes[gallery_id] = deque(maxlen=GALLERY_CHANGELOG_SIZE)
+                    self._changes_floor[gallery_id] = 0 if current is None else snapshot.version
+                log = self._changes[gallery_id]
+                entries = [(snapshot.version, "remove", student_id, None, None) for student_id in removals if student_id not in upserts_by_id]
+                entries += [(snapshot.version, "upsert", student_id, name, emb) for student_id, (name, emb) in upserts_by_id.items()]
+                for entry in entries:
+                    if len(log) == log.maxlen:
+                        self._changes_floor[gallery_id] = log[0][0]
+                    log.append(entry)
+            self.store.record_version(snapshot.version)
+            snapshot = self._commit(snapshot)
+        
+        return snapshot, len(upserts_by_id), removed
+
+    def changes_since(self, gallery_id: str, since: int) -> Tuple[Optional[int], Optional[List[tuple]]]:
+        """(current version, changes after `since`) or (version, None) if a full reload is needed"""
+        with self._lock:
+            current = self._galleries.get(gallery_id)
+            if current is None:
+                return None, None
+            if since < self._changes_floor.get(gallery_id, current.version):
+                return current.version, None
+            return current.version, [entry for entry in self._changes[gallery_id] if entry[0] > since]
+
+    def _store(self, snapshot: GallerySnapshot):
+        self._galleries[snapshot.gallery_id] = snapshot
+        self._galleries.move_to_end(snapshot.gallery_id)
+        self._last_used[snapshot.gallery_id] = time.monotonic()
+        self._evict(keep=snapshot.gallery_id)
+
+    def remove(self, gallery_id: str) -> bool:
+        """Unload a gallery and delete its persisted snapshot"""
+        with self._write_lock, self._writer():
+            on_disk = self.store.exists(gallery_id)
+            if self.shared is not None:
+                self.store.remove_now(gallery_id)
+                with self._lock:
+                    self._index_mtimes.pop(gallery_id, None)
+                    self._version = max(self._version, self.shared.read()) + 1
+                self.store.record_version(self._version)
+                self.shared.write(self._version)
+            else:
+                self.store.delete(gallery_id)
+            with self._lock:
+                self._removals[gallery_id] = self._removals.get(gallery_id, 0) + 1
+                if gallery_id not in self._galleries:
+                    return on_disk
+                del self._galleries[gallery_id]
+                del self._last_used[gallery_id]
+                self._changes.pop(gallery_id, None)
+                self._changes_floor.pop(gallery_id, None)
+                return True
+
+    def _evict(self, keep: Optional[str] = None):
+        now = time.monotonic()
+        for gallery_id in list(self._galleries):
+            if gallery_id != keep and now - self._last_used[gallery_id] > self.ttl:
+                self._drop(gallery_id, "idle")
+        
+        while len(self._galleries) > 1 and sum(g.nbytes for g in self._galleries.values()) > self.budget_bytes:
+            oldest = next(gallery_id for gallery_id in self._galleries if gallery_id != keep)
+            self._drop(oldest, "memory budget")
+
+    def _drop(self, gallery_id: str, reason: str):
+        snapshot = self._galleries.pop(gallery_id)
+        del self._last_used[gallery_id]
+        self._changes.pop(gallery_id, None)
+        self._changes_floor.pop(gallery_id, None)
+        self.evictions += 1
+        logger.info(f"🗑️ Evicted gallery '{gallery_id}' ({len(snapshot)} students, {reason})")
+
+    def list(self, include_stored: bool = True) -> List[dict]:
+        """Loaded galleries and, with include_stored, persisted ones this process has not mapped (from their index files)"""
+        with self._lock:
+            self._evict()
+            now = time.monotonic()
+            listed = [
+                {
+                    "gallery_id": gallery_id,
+                    "students": len(snapshot),
+                    "version": snapshot.version,
+                    "bytes": snapshot.nbytes,
+                    "precision": snapshot.precision,
+                    "quantization_error": snapshot.quantization_error,
+                    "index": {"type": "ivf", "nlist": snapshot.index.nlist, "trained_size": snapshot.index.trained_size} if snapshot.index is not None else None,
+                    "idle_seconds": round(now - self._last_used[gallery_id], 1),
+                    "mapped": True
+                }
+                for gallery_id, snapshot in self._galleries.items()
+            ]
+        if include_stored and self.store.enabled:
+            mapped = {entry["gallery_id"] for entry in listed}
+            for meta in self.store.indexes():
+                if meta["gallery_id"] in mapped:
+                    continue
+                listed.append({
+                    "gallery_id": meta["gallery_id"],
+                    "students": meta["count"],
+                    "version": meta["version"],
+                    "bytes": 0,
+                    "precision": meta.get("precision", "float32"),
+                    "quantization_error": meta.get("quantization_error", 0.0),
+                    "index": {"type": "ivf"} if meta.get("index") else None,
+                    "idle_seconds": None,
+                    "mapped": False
+                })
+        return listed
+
+    def stats(self) -> dict:
+        with self._lock:
+            galleries = list(self._galleries.values())
+        bytes_by_precision = {precision: 0 for precision in SUPPORTED_PRECISIONS}
+        for g in galleries:
+            bytes_by_precision[g.precision] += g.nbytes
+        return {
+            "count": len(galleries),
+            "students": sum(len(g) for g in galleries),
+            "bytes": sum(g.nbytes for g in galleries),
+            "bytes_by_precision": bytes_by_precision,
+            "float32_equivalent_bytes": sum(len(g) * g.encodings.shape[1] * 4 for g in galleries),
+            "indexed": sum(1 for g in galleries if g.index is not None),
+            "budget_bytes": self.budget_bytes,
+            "evictions": self.evictions,
+            "shared": {"directory": self.shared.directory, "version": self.shared.read(), "synced": self._synced} if self.shared is not None else None
+        }
+
+
+if GALLERY_SHARED and fcntl is None:
+    logger.warning("⚠️ GALLERY_SHARED needs POSIX file locks; galleries stay per process")
+galleries = GalleryRegistry(
+    int(GALLERY_MEMORY_BUDGET_MB * 1024 * 1024),
+    GALLERY_TTL_SECONDS,
+    GalleryStore(GALLERY_SNAPSHOT_DIR),
+    SharedGalleryCounter(GALLERY_SNAPSHOT_DIR) if GALLERY_SHARED and fcntl is not None else None
+)
 
 
 # ============================================================================
@@ -105,14 +1602,36 @@ class LiveRecognitionRequest(BaseModel):
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    lifespan_started = time.perf_counter()
     logger.info("\n" + "="*70)
     logger.info("🚀 \"AURA\"-Automated Unified Recognition for Attendance Face Recognition API v3.0 (ArcFace Edition)")
     logger.info("="*70)
-    logger.info(f"📡 DeepFace Status: {'✅ AVAILABLE' if DEEPFACE_AVAILABLE else '❌ NOT AVAILABLE'}")
+    logger.info(f"🚦 Startup mode: {STARTUP_MODE}")
     logger.info(f"🎯 Threshold (Cosine): {ARCFACE_THRESHOLD} (0-1 scale, higher = stricter)")
     logger.info(f"📊 Expected Embedding Dimensions: {EXPECTED_EMBEDDING_DIMS}-d")
+    logger.info(f"⚙️ Inference: {INFERENCE_EXECUTOR} pool, {INFERENCE_WORKERS} worker(s), queue {INFERENCE_QUEUE_SIZE}")
     logger.info("="*70 + "\n")
+    inference_pool.start()
+    startup_timings["module_setup"] = lifespan_started - _PROCESS_T0
+    
+    if galleries.store.enabled:
+        started = time.perf_counter()
+        restored = galleries.restore()
+        galleries.store.start()
+        startup_timings["gallery_restore"] = time.perf_counter() - started
+        logger.info(f"💾 Restored {restored} gallery snapshot(s) from {GALLERY_SNAPSHOT_DIR} ({startup_timings['gallery_restore'] * 1000:.0f}ms)")
+    
+    if STARTUP_MODE == "eager":
+        await asyncio.get_running_loop().run_in_executor(None, warm_up)
+    elif STARTUP_MODE == "background":
+        threading.Thread(target=warm_up, name="model-warmup", daemon=True).start()
+    else:
+        readiness.set()
+        logger.info("💤 Lazy startup: models load on first request")
+    
     yield
+    inference_pool.shutdown()
+    galleries.store.stop()
     logger.info("👋 API shutdown")
 
 
@@ -138,20 +1657,75 @@ app.add_middleware(
 class TrainingRequest(BaseModel):
     student_id: str
     images: List[str]
+    early_stop: Optional[bool] = None
+    target_faces: Optional[int] = None
+    detection: Optional[str] = None
+    detect_max_side: Optional[int] = None
+    detect_pyramid: Optional[bool] = None
+    detect_tile_size: Optional[int] = None
+    detect_tile_overlap: Optional[float] = None
 
 
-class RecognitionRequest(BaseModel):
-    image: str
+class BulkStudentImages(BaseModel):
+    student_id: str
+    images: List[str]
 
 
-class StudentData(BaseModel):
+class BulkTrainingRequest(TrainingRequest):
+    student_id: str = ""
+    images: List[str] = []
+    students: List[BulkStudentImages] = []
+
+
+class VideoAttendanceRequest(BaseModel):
+    gallery_id: Optional[str] = None
+    sample_fps: Optional[float] = None
+    min_sightings: Optional[int] = None
+    max_side: Optional[int] = None
+    detection: Optional[str] = None
+    detect_max_side: Optional[int] = None
+    detect_pyramid: Optional[bool] = None
+    detect_tile_size: Optional[int] = None
+    detect_tile_overlap: Optional[float] = None
+
+
+class RecognitionRequest(BaseModel):
+    image: str = ""
+    top_k: Optional[int] = None
+    decode_scale: Optional[int] = None
+    session_id: Optional[str] = None
+    track: Optional[bool] = None
+    gallery_id: Optional[str] = None
+    nprobe: Optional[int] = None
+    detection: Optional[str] = None
+    detect_max_side: Optional[int] = None
+    detect_pyramid: Optional[bool] = None
+    detect_tile_size: Optional[int] = None
+    detect_tile_overlap: Optional[float] = None
+    dedup: Optional[bool] = None
+
+
+class StudentData(BaseModel):
     studentId: str
     name: str
     faceEmbeddings: List[float]
 
 
+class StudentUpsert(BaseModel):
+    name: str
+    faceEmbeddings: List[float]
+
+
+class GallerySyncRequest(BaseModel):
+    base_version: Optional[int] = None
+    upserts: List[StudentData] = []
+    removals: List[str] = []
+
+
 class LiveRecognitionRequest(BaseModel):
     students: List[StudentData]
+    gallery_id: Optional[str] = None
+    precision: Optional[str] = None
 
 
 # ============================================================================
@@ -179,11 +1753,113 @@ def decode_base64(b64_str: str) -> Optional[np.ndarray]:
         return None
 
 
+def decode_image_bytes(data: bytes, scale: int = 1) -> Optional[np.ndarray]:
+    """Decode raw JPEG/PNG bytes to RGB straight from the buffer.
+
+    scale > 1 uses libjpeg's reduced-resolution decoding (1/2, 1/4, 1/8), which
+    is much cheaper than decoding at full size and resizing.
+    """
+    try:
+        buf = np.frombuffer(data, dtype=np.uint8)
+        bgr = cv2.imdecode(buf, SUPPORTED_DECODE_SCALES[scale])
+        if bgr is None:
+            logger.error("❌ Decode error: unsupported or corrupt image bytes")
+            return None
+        return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+    except Exception as e:
+        logger.error(f"❌ Decode error: {e}")
+        return None
+
+
+# base64 string, encoded image bytes, or an already-decoded RGB frame (video)
+ImagePayload = Union[str, bytes, np.ndarray]
+
+
+def load_image(image: ImagePayload, scale: int = 1) -> Optional[np.ndarray]:
+    """Decode a base64 string or raw image bytes to RGB at 1/scale resolution"""
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return decode_image_bytes(bytes(image), scale)
+    
+    rgb = image if isinstance(image, np.ndarray) else decode_base64(image)
+    if rgb is not None and scale > 1:
+        h, w = rgb.shape[:2]
+        rgb = cv2.resize(rgb, (max(1, w // scale), max(1, h // scale)), interpolation=cv2.INTER_AREA)
+    return rgb
+
+
+def frame_thumbnail(image: ImagePayload) -> Optional[np.ndarray]:
+    """Small grayscale thumbnail of a frame for duplicate-frame checks.
+
+    JPEGs are decoded at 1/8 resolution (libjpeg DCT scaling), so this costs a
+    fraction of the full decode. Returns None if the image cannot be decoded.
+    """
+    try:
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            gray = cv2.imdecode(np.frombuffer(bytes(image), dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        else:
+            b64_str = image.split(",")[1] if "," in image else image
+            img = Image.open(io.BytesIO(base64.b64decode(b64_str + "=" * (-len(b64_str) % 4))))
+            img.draft("L", (max(1, img.width // 8), max(1, img.height // 8)))
+            gray = np.array(img.convert("L"))
+        if gray is None or gray.size == 0:
+            return None
+        size = (FRAME_THUMBNAIL_SIZE, FRAME_THUMBNAIL_SIZE)
+        return cv2.resize(gray, size, interpolation=cv2.INTER_AREA).astype(np.int16)
+    except Exception as e:
+        logger.debug(f"⚠️ Thumbnail failed: {str(e)[:100]}")
+        return None
+
+
+def scale_box(box: tuple, scale: int) -> tuple:
+    """Map an (x, y, w, h) box from a 1/scale image back to full resolution"""
+    if scale == 1:
+        return box
+    return tuple(int(v * scale) for v in box)
+
+
+def box_iou(a: tuple, b: tuple) -> float:
+    """Intersection-over-union of two (x, y, w, h) boxes"""
+    ix = max(0, min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0]))
+    iy = max(0, min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1]))
+    inter = ix * iy
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union > 0 else 0.0
+
+
+def box_overlap(a: tuple, b: tuple) -> float:
+    """Intersection of two (x, y, w, h) boxes over the smaller one's area"""
+    ix = max(0, min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0]))
+    iy = max(0, min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1]))
+    smaller = min(a[2] * a[3], b[2] * b[3])
+    return ix * iy / smaller if smaller > 0 else 0.0
+
+
+def associate_tracks(boxes: List[tuple], track_boxes: List[tuple], min_iou: float) -> Dict[int, int]:
+    """Greedily pair detections with track boxes by descending IoU.
+
+    Returns {detection index: track index} for pairs with IoU >= min_iou.
+    """
+    pairs = []
+    for d, box in enumerate(boxes):
+        for t, track_box in enumerate(track_boxes):
+            iou = box_iou(box, track_box)
+            if iou >= min_iou:
+                pairs.append((iou, d, t))
+    
+    assigned = {}
+    used_tracks = set()
+    for _, d, t in sorted(pairs, reverse=True):
+        if d not in assigned and t not in used_tracks:
+            assigned[d] = t
+            used_tracks.add(t)
+    return assigned
+
+
 def detect_faces_deepface(rgb_img: np.ndarray) -> List[tuple]:
     """Detect faces using DeepFace with single best detector"""
     results = []
     
-    if not DEEPFACE_AVAILABLE:
+    if not load_deepface():
         return results
     
     try:
@@ -240,7 +1916,7 @@ def detect_faces_opencv(rgb_img: np.ndarray) -> List[tuple]:
         gray = cv2.cvtColor(rgb_img, cv2.COLOR_RGB2GRAY)
         
         # Lenient parameters for detection
-        faces = face_cascade.detectMultiScale(
+        faces = get_face_cascade().detectMultiScale(
             gray,
             scaleFactor=1.05,
             minNeighbors=3,
@@ -263,80 +1939,2432 @@ def detect_faces_opencv(rgb_img: np.ndarray) -> List[tuple]:
         return []
 
 
-def detect_faces(rgb_img: np.ndarray) -> List[tuple]:
+def detect_faces(rgb_img: np.ndarray, stages: Optional[dict] = None) -> List[tuple]:
     """Detect faces with multiple fallbacks"""
-    # Try DeepFace first (better accuracy)
-    faces = detect_faces_deepface(rgb_img)
+    # Try RetinaFace first (better accuracy)
+    faces = detect_faces_retinaface(rgb_img)
+    if faces:
+        return faces
+    
+    # Fallback to OpenCV
+    faces = detect_faces_opencv(rgb_img)
     if faces:
+        if stages is not None:
+            stages["haar_fallbacks"] += 1
         return faces
     
-    # Fallback to OpenCV
-    faces = detect_faces_opencv(rgb_img)
-    if faces:
-        return faces
+    logger.warning("⚠️ No faces detected by any method")
+    return []
+
+
+# Counters reported per detected frame (and summed in /status)
+DETECTION_STAGES = (
+    "frames", "proposals_haar", "proposals_motion", "proposals_track",
+    "static_skips", "static_refreshes", "retinaface_crops", "retinaface_full", "haar_only", "faces",
+    "pyramid_levels", "haar_fallbacks", "tiles"
+)
+
+
+@dataclass(frozen=True)
+class DetectionOptions:
+    """How to detect faces in one frame (picklable, passed to pool jobs)"""
+    mode: str = "full"
+    max_side: int = 0
+    pyramid: bool = False
+    tile_size: int = DETECTION_TILE_SIZE
+    tile_overlap: float = DETECTION_TILE_OVERLAP
+
+
+def retinaface_regions(rgb_img: np.ndarray) -> List[tuple]:
+    """RetinaFace boxes with eye landmarks: (box, left_eye, right_eye), no cropping/alignment"""
+    return get_inference_backend().detect(rgb_img)
+
+
+def detect_faces_retinaface(rgb_img: np.ndarray) -> List[tuple]:
+    """RetinaFace through the active backend as (aligned 224x224 roi, box)"""
+    backend = get_inference_backend()
+    if backend.uses_deepface_detector:
+        return detect_faces_deepface(rgb_img)
+    return [(align_face_crop(rgb_img, box, left_eye, right_eye), box) for box, left_eye, right_eye in backend.detect(rgb_img)]
+
+
+def align_face_crop(rgb_img: np.ndarray, box: tuple, left_eye: Optional[tuple] = None, right_eye: Optional[tuple] = None, size: int = 224) -> np.ndarray:
+    """size x size crop of box, rotated about its centre so the eyes are level.
+
+    One warpAffine straight from the source frame: only the output pixels are
+    computed, so aligning from a 4K frame costs the same as from a small one.
+    """
+    x, y, w, h = box
+    angle = 0.0
+    if left_eye is not None and right_eye is not None:
+        angle = float(np.degrees(np.arctan2(left_eye[1] - right_eye[1], left_eye[0] - right_eye[0])))
+    matrix = cv2.getRotationMatrix2D((x + w / 2.0, y + h / 2.0), angle, 1.0)
+    matrix[:, 2] -= (x, y)
+    matrix[0] *= size / max(w, 1)
+    matrix[1] *= size / max(h, 1)
+    return cv2.warpAffine(rgb_img, matrix, (size, size), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+
+def detect_faces_scaled(rgb_img: np.ndarray, max_side: int, pyramid: bool = False, stages: Optional[dict] = None) -> List[tuple]:
+    """Detect on a downscaled copy (or pyramid), crop and align from the full frame.
+
+    Returns (roi, box) like detect_faces(), with boxes in rgb_img coordinates.
+    The Haar cascade on the same copy is the fallback when RetinaFace finds
+    nothing at any level.
+    """
+    h, w = rgb_img.shape[:2]
+    side = max_side
+    while True:
+        ratio = max(h, w) / side if side and max(h, w) > side else 1.0
+        small = cv2.resize(rgb_img, (round(w / ratio), round(h / ratio)), interpolation=cv2.INTER_AREA) if ratio > 1.0 else rgb_img
+        if stages is not None:
+            stages["pyramid_levels"] += 1
+        regions = retinaface_regions(small)
+        if regions or not pyramid or ratio == 1.0:
+            break
+        side *= 2
+    
+    if not regions:
+        regions = [(box, None, None) for _, box in detect_faces_opencv(small)]
+        if regions and stages is not None:
+            stages["haar_fallbacks"] += 1
+    
+    def up(point):
+        return None if point is None else (point[0] * ratio, point[1] * ratio)
+    
+    faces = []
+    for (x, y, bw, bh), left_eye, right_eye in regions:
+        box = (int(x * ratio), int(y * ratio), int(bw * ratio), int(bh * ratio))
+        faces.append((align_face_crop(rgb_img, box, up(left_eye), up(right_eye)), box))
+    return faces
+
+
+def merge_boxes(boxes: List[tuple]) -> List[tuple]:
+    """Merge overlapping (x, y, w, h) boxes into their bounding boxes"""
+    merged = [list(box) for box in boxes]
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(merged)):
+            for j in range(i + 1, len(merged)):
+                a, b = merged[i], merged[j]
+                if a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]:
+                    x0, y0 = min(a[0], b[0]), min(a[1], b[1])
+                    x1, y1 = max(a[0] + a[2], b[0] + b[2]), max(a[1] + a[3], b[1] + b[3])
+                    merged[i] = [x0, y0, x1 - x0, y1 - y0]
+                    del merged[j]
+                    changed = True
+                    break
+            if changed:
+                break
+    return [tuple(box) for box in merged]
+
+
+def propose_faces(rgb_img: np.ndarray, motion_ref: Optional[np.ndarray], track_boxes: List[tuple], stages: dict) -> Tuple[List[tuple], np.ndarray, bool]:
+    """Cheap proposal pass for the detection cascade.
+
+    Runs the Haar cascade on a grayscale copy at most CASCADE_PROPOSAL_WIDTH
+    wide and, given the previous frame's copy (motion_ref), adds moving blobs;
+    tracked boxes are proposals too. Returns (boxes in rgb_img coordinates,
+    this frame's grayscale copy, whether the frame was compared and found static).
+    """
+    h, w = rgb_img.shape[:2]
+    ratio = max(1.0, w / CASCADE_PROPOSAL_WIDTH)
+    gray = cv2.cvtColor(rgb_img, cv2.COLOR_RGB2GRAY)
+    if ratio > 1.0:
+        gray = cv2.resize(gray, (int(w / ratio), int(h / ratio)), interpolation=cv2.INTER_AREA)
+    
+    proposals = []
+    for (x, y, bw, bh) in get_face_cascade().detectMultiScale(gray, scaleFactor=1.1, minNeighbors=3, minSize=(16, 16)):
+        proposals.append((int(x * ratio), int(y * ratio), int(bw * ratio), int(bh * ratio)))
+    stages["proposals_haar"] += len(proposals)
+    
+    static = False
+    if motion_ref is not None and motion_ref.shape == gray.shape:
+        diff = cv2.absdiff(cv2.GaussianBlur(gray, (5, 5), 0), cv2.GaussianBlur(motion_ref, (5, 5), 0))
+        mask = cv2.dilate((diff > CASCADE_MOTION_THRESHOLD).astype(np.uint8), None, iterations=2)
+        count, _, blobs, _ = cv2.connectedComponentsWithStats(mask)
+        min_area = CASCADE_MOTION_MIN_AREA * gray.size
+        moving = [blob for blob in blobs[1:count] if blob[cv2.CC_STAT_AREA] >= min_area]
+        for x, y, bw, bh, _ in moving:
+            proposals.append((int(x * ratio), int(y * ratio), int(bw * ratio), int(bh * ratio)))
+        stages["proposals_motion"] += len(moving)
+        static = not moving
+    
+    proposals.extend(track_boxes)
+    stages["proposals_track"] += len(track_boxes)
+    return proposals, gray, static
+
+
+def retinaface_faces_in(rgb_img: np.ndarray, region: tuple, max_side: int = 0) -> List[tuple]:
+    """Faces RetinaFace confirms inside region (x, y, w, h) of rgb_img, as (roi, box) in frame coordinates.
+
+    Unlike detect_faces() there is no whole-image or Haar fallback: an empty
+    or false proposal yields no face. The region is downscaled to max_side
+    (if set) for detection and crops are aligned from the full frame.
+    """
+    cx, cy, cw, ch = region
+    crop = rgb_img[cy:cy + ch, cx:cx + cw]
+    ratio = max(cw, ch) / max_side if max_side and max(cw, ch) > max_side else 1.0
+    small = cv2.resize(crop, (round(cw / ratio), round(ch / ratio)), interpolation=cv2.INTER_AREA) if ratio > 1.0 else crop
+    
+    def to_frame(point):
+        return None if point is None else (point[0] * ratio + cx, point[1] * ratio + cy)
+    
+    faces = []
+    for (x, y, bw, bh), left_eye, right_eye in retinaface_regions(small):
+        box = (int(x * ratio) + cx, int(y * ratio) + cy, int(bw * ratio), int(bh * ratio))
+        faces.append((align_face_crop(rgb_img, box, to_frame(left_eye), to_frame(right_eye)), box))
+    return faces
+
+
+def detect_faces_cascade(rgb_img: np.ndarray, motion_ref: Optional[np.ndarray] = None, track_boxes: Optional[List[tuple]] = None, max_side: int = 0, static_frames: int = 0) -> Tuple[List[tuple], dict, np.ndarray]:
+    """Detection cascade: proposals first, RetinaFace (with alignment) only on their crops.
+
+    Only detections RetinaFace confirmed are kept (see retinaface_faces_in),
+    including on the full-frame fallback; without a detector backend the
+    Haar proposals are the detections.
+
+    track_boxes is None without a tracker; static_frames is how many frames
+    in a row were skipped as static before this one. Returns (faces,
+    per-stage counts, grayscale copy to pass as the next frame's motion_ref).
+    Faces are (roi, box) like detect_faces().
+    """
+    stages = {key: 0 for key in DETECTION_STAGES}
+    stages["frames"] = 1
+    proposals, gray, static = propose_faces(rgb_img, motion_ref, track_boxes or [], stages)
+    
+    if not proposals:
+        if static and track_boxes is not None and static_frames + 1 < CASCADE_STATIC_REFRESH_FRAMES:
+            # Nothing moved, nothing tracked and Haar saw nothing: skip the frame
+            stages["static_skips"] += 1
+            return [], stages, gray
+        if static:
+            stages["static_refreshes"] += 1
+        if (motion_ref is None or static) and CASCADE_FULL_FALLBACK:
+            stages["retinaface_full"] += 1
+            h, w = rgb_img.shape[:2]
+            faces = retinaface_faces_in(rgb_img, (0, 0, w, h), max_side)
+            stages["faces"] += len(faces)
+            return faces, stages, gray
+        return [], stages, gray
+    
+    h, w = rgb_img.shape[:2]
+    crops = []
+    for x, y, bw, bh in proposals:
+        mx, my = int(bw * CASCADE_CROP_MARGIN), int(bh * CASCADE_CROP_MARGIN)
+        x0, y0 = max(0, x - mx), max(0, y - my)
+        x1, y1 = min(w, x + bw + mx), min(h, y + bh + my)
+        if x1 > x0 and y1 > y0:
+            crops.append((x0, y0, x1 - x0, y1 - y0))
+    
+    faces = []
+    if get_inference_backend().load():
+        for crop in merge_boxes(crops):
+            stages["retinaface_crops"] += 1
+            for roi, box in retinaface_faces_in(rgb_img, crop, max_side):
+                if all(box_iou(box, other) < 0.5 for _, other in faces):
+                    faces.append((roi, box))
+    else:
+        # No RetinaFace: the Haar proposals are the detections
+        stages["haar_only"] += 1
+        for x, y, bw, bh in proposals[:stages["proposals_haar"]]:
+            roi = rgb_img[y:y + bh, x:x + bw]
+            if roi.size > 0:
+                faces.append((cv2.resize(roi, (224, 224)), (x, y, bw, bh)))
+    
+    stages["faces"] += len(faces)
+    return faces, stages, gray
+
+
+_tile_executor: Optional[Tuple[int, ThreadPoolExecutor]] = None
+_tile_executor_lock = threading.Lock()
+
+
+def get_tile_executor() -> ThreadPoolExecutor:
+    """Threads for the tiles of one frame, created once per process (not inherited across fork)"""
+    global _tile_executor
+    with _tile_executor_lock:
+        if _tile_executor is None or _tile_executor[0] != os.getpid():
+            executor = ThreadPoolExecutor(max_workers=max(1, DETECTION_TILE_WORKERS), thread_name_prefix="tile")
+            _tile_executor = (os.getpid(), executor)
+        return _tile_executor[1]
+
+
+def tile_grid(width: int, height: int, tile_size: int, overlap: float) -> List[tuple]:
+    """(x, y, w, h) tiles of at most tile_size px covering the frame, overlapping by at least `overlap` of a tile"""
+    def starts(length: int) -> List[int]:
+        if length <= tile_size:
+            return [0]
+        step = max(1, int(tile_size * (1.0 - overlap)))
+        count = -(-(length - tile_size) // step) + 1
+        # Spread evenly so the last tile ends on the border
+        return [round(i * (length - tile_size) / (count - 1)) for i in range(count)]
+    
+    return [(x, y, min(tile_size, width - x), min(tile_size, height - y)) for y in starts(height) for x in starts(width)]
+
+
+def tile_regions(rgb_img: np.ndarray, tile: tuple, max_side: int = 0) -> Tuple[List[tuple], float]:
+    """RetinaFace regions of one tile (downscaled to max_side if set) in frame coordinates, and the ms it took"""
+    started = time.perf_counter()
+    x0, y0, w, h = tile
+    crop = rgb_img[y0:y0 + h, x0:x0 + w]
+    ratio = max(w, h) / max_side if max_side and max(w, h) > max_side else 1.0
+    if ratio > 1.0:
+        crop = cv2.resize(crop, (round(w / ratio), round(h / ratio)), interpolation=cv2.INTER_AREA)
+    else:
+        crop = np.ascontiguousarray(crop)
+    
+    def to_frame(point):
+        return None if point is None else (x0 + point[0] * ratio, y0 + point[1] * ratio)
+    
+    regions = []
+    for (x, y, bw, bh), left_eye, right_eye in retinaface_regions(crop):
+        box = (int(x0 + x * ratio), int(y0 + y * ratio), int(bw * ratio), int(bh * ratio))
+        regions.append((box, to_frame(left_eye), to_frame(right_eye)))
+    return regions, (time.perf_counter() - started) * 1000.0
+
+
+def merge_tile_regions(candidates: List[tuple], width: int, height: int) -> List[tuple]:
+    """Non-maximum suppression of (region, tile) pairs across tile seams.
+
+    A face cut by a seam is found whole by the neighbouring tile (or the
+    whole-frame pass) and in part by this one. Boxes touching an inner tile
+    edge rank below complete boxes, larger boxes rank first, and a box that
+    overlaps a kept one by more than DETECTION_TILE_NMS_OVERLAP is dropped.
+    """
+    def score(candidate) -> float:
+        (x, y, w, h), tile = candidate[0][0], candidate[1]
+        tx, ty, tw, th = tile
+        cut = (x <= tx + 1 and tx > 0) or (y <= ty + 1 and ty > 0) \
+            or (x + w >= tx + tw - 1 and tx + tw < width) or (y + h >= ty + th - 1 and ty + th < height)
+        return w * h * (0.25 if cut else 1.0)
+    
+    kept = []
+    for region, _ in sorted(candidates, key=score, reverse=True):
+        if all(box_overlap(region[0], other[0]) <= DETECTION_TILE_NMS_OVERLAP for other in kept):
+            kept.append(region)
+    return kept
+
+
+def detect_faces_tiled(rgb_img: np.ndarray, tile_size: int, overlap: float, stages: Optional[dict] = None, tiles: Optional[list] = None) -> List[tuple]:
+    """Detect on overlapping full-resolution tiles in parallel, merge across seams, align from the frame.
+
+    Small faces stay at native resolution instead of being shrunk with the
+    frame; one extra pass over the whole frame at tile_size catches faces
+    too large for the overlap. Returns (roi, box) like detect_faces(); each
+    tile's (box, is whole-frame pass, faces, ms) is appended to tiles.
+    """
+    h, w = rgb_img.shape[:2]
+    jobs = [(tile, 0) for tile in tile_grid(w, h, tile_size, overlap)]
+    if len(jobs) > 1:
+        jobs.append(((0, 0, w, h), tile_size))
+        results = list(get_tile_executor().map(lambda job: tile_regions(rgb_img, *job), jobs))
+    else:
+        results = [tile_regions(rgb_img, *jobs[0])]
+    
+    candidates = []
+    for (tile, max_side), (regions, ms) in zip(jobs, results):
+        candidates.extend((region, tile) for region in regions)
+        if tiles is not None:
+            tiles.append((tile, max_side > 0, len(regions), ms))
+    if stages is not None:
+        stages["tiles"] += len(jobs)
+    
+    regions = merge_tile_regions(candidates, w, h)
+    if not regions:
+        regions = [(box, None, None) for _, box in detect_faces_opencv(rgb_img)]
+        if regions and stages is not None:
+            stages["haar_fallbacks"] += 1
+    return [(align_face_crop(rgb_img, box, left_eye, right_eye), box) for box, left_eye, right_eye in regions]
+
+
+def detect_faces_haar(rgb_img: np.ndarray, max_side: int = 0) -> List[tuple]:
+    """Haar cascade only (the cheapest detector) on a copy at most max_side px, crops aligned from the full frame"""
+    h, w = rgb_img.shape[:2]
+    ratio = max(h, w) / max_side if max_side and max(h, w) > max_side else 1.0
+    small = cv2.resize(rgb_img, (round(w / ratio), round(h / ratio)), interpolation=cv2.INTER_AREA) if ratio > 1.0 else rgb_img
+    faces = []
+    for _, (x, y, bw, bh) in detect_faces_opencv(small):
+        box = (int(x * ratio), int(y * ratio), int(bw * ratio), int(bh * ratio))
+        faces.append((align_face_crop(rgb_img, box), box))
+    return faces
+
+
+def tile_timings(tiles: List[tuple], scale: int = 1) -> List[dict]:
+    """Per-tile report of detect_faces_tiled, boxes as [x1, y1, x2, y2] in full-resolution coordinates"""
+    report = []
+    for tile, whole_frame, faces, ms in tiles:
+        x, y, w, h = scale_box(tile, scale)
+        report.append({"box": [x, y, x + w, y + h], "whole_frame": whole_frame, "faces": faces, "ms": round(ms, 2)})
+    return report
+
+
+def run_detection(rgb_img: np.ndarray, options: DetectionOptions = DetectionOptions(), motion_ref: Optional[np.ndarray] = None, track_boxes: Optional[List[tuple]] = None, tiles: Optional[list] = None, static_frames: int = 0) -> Tuple[List[tuple], dict, Optional[np.ndarray]]:
+    """Detect faces as configured by options; returns (faces, per-stage counts, motion_ref).
+
+    In tiled mode the per-tile timings are appended to tiles. Mode "haar"
+    is not offered to clients; the adaptive quality controller uses it.
+    """
+    if options.mode == "cascade":
+        return detect_faces_cascade(rgb_img, motion_ref, track_boxes, options.max_side, static_frames)
+    stages = {key: 0 for key in DETECTION_STAGES}
+    if options.mode == "tiled":
+        faces = detect_faces_tiled(rgb_img, options.tile_size, options.tile_overlap, stages, tiles)
+    elif options.mode == "haar":
+        faces = detect_faces_haar(rgb_img, options.max_side)
+    elif options.max_side or options.pyramid:
+        faces = detect_faces_scaled(rgb_img, options.max_side, options.pyramid, stages)
+    else:
+        faces = detect_faces(rgb_img, stages)
+    stages.update(frames=1, retinaface_full=int(options.mode == "full"), faces=len(faces))
+    return faces, stages, None
+
+
+class DetectionStats:
+    """Per-mode totals of the stage counts returned with each detected frame"""
+
+    def __init__(self):
+        self.totals: Dict[str, Dict[str, int]] = {}
+
+    def record(self, mode: str, stages: dict):
+        totals = self.totals.setdefault(mode, {key: 0 for key in DETECTION_STAGES})
+        for key, value in stages.items():
+            totals[key] += value
+        if stages.get("haar_fallbacks"):
+            detector_fallbacks.inc("retinaface_empty", amount=stages["haar_fallbacks"])
+        if stages.get("haar_only"):
+            detector_fallbacks.inc("retinaface_unavailable", amount=stages["haar_only"])
+
+    def stats(self) -> dict:
+        report = {
+            "default_modes": dict(ENDPOINT_DETECTION_MODES),
+            "max_side": DETECTION_MAX_SIDE,
+            "pyramid": DETECTION_PYRAMID,
+            "tile_size": DETECTION_TILE_SIZE,
+            "tile_overlap": DETECTION_TILE_OVERLAP
+        }
+        for mode, totals in self.totals.items():
+            frames = max(totals["frames"], 1)
+            report[mode] = {
+                **totals,
+                "retinaface_full_rate": totals["retinaface_full"] / frames,
+                "retinaface_crops_per_frame": totals["retinaface_crops"] / frames,
+                "static_skip_rate": totals["static_skips"] / frames,
+                "tiles_per_frame": totals["tiles"] / frames
+            }
+        return report
+
+
+detection_stats = DetectionStats()
+
+
+def get_embedding_deepface(face_roi: np.ndarray) -> Optional[np.ndarray]:
+    """Get embedding using DeepFace ArcFace model"""
+    try:
+        if not load_deepface():
+            logger.warning("⚠️ DeepFace not available")
+            return None
+        
+        # ArcFace provides 512-d embeddings with superior accuracy. This is
+        # the call existing galleries were enrolled with, including DeepFace's
+        # default detector pass on the crop; the batched and ONNX paths skip
+        # that pass (export_onnx.py --parity measures the difference)
+        result = DeepFace.represent(
+            face_roi,
+            model_name="ArcFace",
+            enforce_detection=False,
+            normalization="ArcFace"
+        )
+        
+        if result and len(result) > 0:
+            embedding = np.array(result[0]["embedding"], dtype=np.float32)
+            logger.debug(f"✅ ArcFace embedding: {len(embedding)}-d")
+            return embedding
+        
+        logger.warning("⚠️ DeepFace returned empty result")
+        return None
+        
+    except Exception as e:
+        logger.error(f"❌ DeepFace embedding error: {e}")
+        return None
+
+
+_arcface_model = None
+_arcface_model_lock = threading.Lock()
+
+
+def get_arcface_model():
+    """Build (once) and return DeepFace's ArcFace client"""
+    global _arcface_model
+    if _arcface_model is None:
+        with _arcface_model_lock:
+            if _arcface_model is None:
+                _arcface_model = DeepFace.build_model(model_name="ArcFace")
+    return _arcface_model
+
+
+def get_embeddings_deepface_batch(face_rois: List[np.ndarray]) -> np.ndarray:
+    """Get ArcFace embeddings for many aligned crops in one forward pass.
+
+    Mirrors DeepFace.represent preprocessing for an already-cropped face
+    (resize/pad to the model input, ArcFace normalization) but skips its
+    extra detector pass. Returns a (B, 512) float32 matrix.
+    """
+    from deepface.modules import preprocessing
+    
+    client = get_arcface_model()
+    target_h, target_w = client.input_shape
+    
+    batch = []
+    for roi in face_rois:
+        img = roi.astype(np.float32) / 255.0
+        img = preprocessing.resize_image(img=img, target_size=(target_h, target_w))
+        img = preprocessing.normalize_input(img=img, normalization="ArcFace")
+        batch.append(img[0])
+    
+    embeddings = client.model(np.stack(batch), training=False)
+    return np.asarray(embeddings, dtype=np.float32).reshape(len(face_rois), -1)
+
+
+# ============================================================================
+# INFERENCE BACKENDS
+# ============================================================================
+
+class InferenceBackend(ABC):
+    """Face detector + ArcFace embedder behind the recognition pipeline.
+
+    detect() returns RetinaFace regions (box, left_eye, right_eye) in image
+    coordinates; embed() maps aligned RGB uint8 face crops to a (B, 512)
+    float32 matrix and a (B,) bool mask of the rows that are valid (crops
+    that failed get a zero row and False). One instance per process (see
+    get_inference_backend).
+    """
+    name = "base"
+    uses_deepface_detector = True
+    # Why INFERENCE_BACKEND could not be used, when this backend stands in for it
+    fallback_error: Optional[str] = None
+
+    def load(self) -> bool:
+        return True
+
+    @abstractmethod
+    def detect(self, rgb_img: np.ndarray) -> List[tuple]:
+        ...
+
+    @abstractmethod
+    def embed(self, face_rois: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        ...
+
+    def describe(self) -> dict:
+        report = {"name": self.name}
+        if self.fallback_error is not None:
+            report["requested"] = INFERENCE_BACKEND
+            report["fallback_error"] = self.fallback_error
+        return report
+
+
+class DeepFaceBackend(InferenceBackend):
+    """Reference backend: DeepFace RetinaFace and ArcFace on TensorFlow/Keras.
+
+    batched runs ArcFace once per batch (get_embeddings_deepface_batch);
+    otherwise every crop goes through DeepFace.represent like enrolment did.
+    """
+    name = "deepface"
+
+    def __init__(self, batched: bool = EMBEDDING_BATCHING):
+        self.batched = batched
+
+    def load(self) -> bool:
+        return load_deepface()
+
+    def detect(self, rgb_img: np.ndarray) -> List[tuple]:
+        return deepface_regions(rgb_img)
+
+    def embed(self, face_rois: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        if not self.batched:
+            return stack_embeddings([get_embedding_deepface(roi) for roi in face_rois])
+        try:
+            embeddings = get_embeddings_deepface_batch(face_rois)
+            return embeddings, np.ones(len(face_rois), dtype=bool)
+        except Exception as e:
+            # Reference path: one DeepFace.represent call per crop
+            logger.warning(f"⚠️ Batched ArcFace failed ({str(e)[:80]}), embedding {len(face_rois)} crop(s) one by one")
+            return stack_embeddings([get_embedding_deepface(roi) for roi in face_rois])
+
+
+def stack_embeddings(embeddings: List[Optional[np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+    """(B, 512) matrix and validity mask of per-crop embeddings, None for failed crops"""
+    matrix = np.zeros((len(embeddings), EXPECTED_EMBEDDING_DIMS[0]), dtype=np.float32)
+    valid = np.zeros(len(embeddings), dtype=bool)
+    for i, emb in enumerate(embeddings):
+        if emb is not None and emb.size == matrix.shape[1]:
+            matrix[i] = emb
+            valid[i] = True
+    return matrix, valid
+
+
+def embedding_rows(embeddings: np.ndarray, valid: np.ndarray) -> List[Optional[np.ndarray]]:
+    """Per-crop embeddings of an embed() result, None for failed crops"""
+    return [row if ok else None for row, ok in zip(embeddings, valid)]
+
+
+def deepface_regions(rgb_img: np.ndarray) -> List[tuple]:
+    """RetinaFace regions from DeepFace.extract_faces without its crop alignment"""
+    if not load_deepface():
+        return []
+    try:
+        face_objs = DeepFace.extract_faces(
+            img_path=rgb_img,
+            detector_backend='retinaface',
+            enforce_detection=False,
+            align=False
+        )
+    except Exception as e:
+        logger.debug(f"⚠️ RetinaFace failed: {str(e)[:100]}")
+        return []
+    
+    regions = []
+    h, w = rgb_img.shape[:2]
+    for face_obj in face_objs or []:
+        area = face_obj.get('facial_area', {})
+        box = (area.get('x', 0), area.get('y', 0), area.get('w', 0), area.get('h', 0))
+        # enforce_detection=False reports the whole image when nothing was found
+        if box[2] <= 0 or box[3] <= 0 or (box[2] >= w and box[3] >= h):
+            continue
+        regions.append((box, area.get('left_eye'), area.get('right_eye')))
+    return regions
+
+
+class OnnxBackend(InferenceBackend):
+    """ONNX Runtime CPU backend running exported ArcFace (and RetinaFace) models.
+
+    ArcFace gets the same resize/pad and normalization DeepFace applies to an
+    already-detected crop, so embeddings stay comparable with galleries built
+    by the reference backend (check with export_onnx.py --check). RetinaFace
+    expects the Pytorch_Retinaface export layout; without a RetinaFace model,
+    detection goes through DeepFace.
+    """
+    name = "onnx"
+    # Pytorch_Retinaface prior box configuration
+    MIN_SIZES = ((16, 32), (64, 128), (256, 512))
+    STEPS = (8, 16, 32)
+    VARIANCE = (0.1, 0.2)
+
+    def __init__(self, arcface_path: str, retinaface_path: str = "", int8: bool = False):
+        self.arcface_path = arcface_path
+        self.retinaface_path = retinaface_path
+        self.int8 = int8
+        self.uses_deepface_detector = not retinaface_path
+        self._arcface = None
+        self._retinaface = None
+        self._priors: Dict[Tuple[int, int], np.ndarray] = {}
+        self._lock = threading.Lock()
+        self.error: Optional[str] = None
+
+    def _session(self, path: str):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise RuntimeError("onnxruntime is not installed (pip install onnxruntime)")
+        
+        if self.int8:
+            quantized = os.path.splitext(path)[0] + ".int8.onnx"
+            if not os.path.exists(quantized):
+                from onnxruntime.quantization import QuantType, quantize_dynamic
+                logger.info(f"🧮 Quantizing {path} to int8 weights...")
+                quantize_dynamic(path, quantized, weight_type=QuantType.QInt8)
+            path = quantized
+        
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if ONNX_INTRA_OP_THREADS:
+            options.intra_op_num_threads = ONNX_INTRA_OP_THREADS
+        if ONNX_INTER_OP_THREADS:
+            options.inter_op_num_threads = ONNX_INTER_OP_THREADS
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        return ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+
+    def load(self) -> bool:
+        if self._arcface is not None:
+            return True
+        if self.error is not None:
+            return False
+        with self._lock:
+            if self._arcface is None and self.error is None:
+                try:
+                    started = time.perf_counter()
+                    arcface = self._session(self.arcface_path)
+                    if self.retinaface_path:
+                        self._retinaface = self._session(self.retinaface_path)
+                    self._arcface = arcface
+                    startup_timings["onnx_load"] = time.perf_counter() - started
+                    logger.info(f"✅ ONNX Runtime backend loaded ({'int8' if self.int8 else 'float32'} weights)")
+                except Exception as e:
+                    self.error = str(e)
+                    logger.error(f"❌ ONNX backend failed to load: {e}")
+        return self._arcface is not None
+
+    def embed(self, face_rois: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        inp = self._arcface.get_inputs()[0]
+        shape = inp.shape
+        nchw = shape[1] == 3
+        target_h, target_w = (shape[2], shape[3]) if nchw else (shape[1], shape[2])
+        if not isinstance(target_h, int) or not isinstance(target_w, int):
+            target_h, target_w = 112, 112
+        
+        batch = np.stack([self._letterbox(roi.astype(np.float32), target_h, target_w) for roi in face_rois])
+        batch = (batch - 127.5) / 128.0  # DeepFace "ArcFace" normalization
+        if nchw:
+            batch = batch.transpose(0, 3, 1, 2)
+        out = self._arcface.run(None, {inp.name: np.ascontiguousarray(batch)})[0]
+        return np.asarray(out, dtype=np.float32).reshape(len(face_rois), -1), np.ones(len(face_rois), dtype=bool)
+
+    @staticmethod
+    def _letterbox(roi: np.ndarray, target_h: int, target_w: int) -> np.ndarray:
+        """Resize keeping the aspect ratio and zero-pad to the target (as DeepFace does)"""
+        h, w = roi.shape[:2]
+        factor = min(target_h / h, target_w / w)
+        resized = cv2.resize(roi, (max(1, int(w * factor)), max(1, int(h * factor))))
+        dh, dw = target_h - resized.shape[0], target_w - resized.shape[1]
+        padded = np.pad(resized, ((dh // 2, dh - dh // 2), (dw // 2, dw - dw // 2), (0, 0)))
+        return padded if padded.shape[:2] == (target_h, target_w) else cv2.resize(padded, (target_w, target_h))
+
+    def _prior_boxes(self, h: int, w: int) -> np.ndarray:
+        priors = self._priors.get((h, w))
+        if priors is None:
+            rows = []
+            for min_sizes, step in zip(self.MIN_SIZES, self.STEPS):
+                fh, fw = int(np.ceil(h / step)), int(np.ceil(w / step))
+                cy, cx = np.meshgrid((np.arange(fh) + 0.5) * step / h, (np.arange(fw) + 0.5) * step / w, indexing="ij")
+                for cell in zip(cy.ravel(), cx.ravel()):
+                    for size in min_sizes:
+                        rows.append((cell[1], cell[0], size / w, size / h))
+            priors = self._priors[(h, w)] = np.array(rows, dtype=np.float32)
+        return priors
+
+    def detect(self, rgb_img: np.ndarray) -> List[tuple]:
+        if self._retinaface is None:
+            return deepface_regions(rgb_img)
+        
+        inp = self._retinaface.get_inputs()[0]
+        h, w = rgb_img.shape[:2]
+        fixed_h, fixed_w = inp.shape[2], inp.shape[3]
+        ratio = 1.0
+        image = rgb_img
+        if isinstance(fixed_h, int) and isinstance(fixed_w, int):
+            # Fixed-size export: scale to fit and pad bottom/right
+            ratio = min(fixed_h / h, fixed_w / w)
+            resized = cv2.resize(rgb_img, (int(w * ratio), int(h * ratio)))
+            image = np.zeros((fixed_h, fixed_w, 3), dtype=np.uint8)
+            image[:resized.shape[0], :resized.shape[1]] = resized
+        
+        ih, iw = image.shape[:2]
+        blob = image[:, :, ::-1].astype(np.float32) - np.array([104.0, 117.0, 123.0], dtype=np.float32)
+        loc, conf, landms = self._retinaface.run(None, {inp.name: blob.transpose(2, 0, 1)[None]})
+        loc, scores, landms = loc[0], conf[0][:, 1], landms[0]
+        
+        priors = self._prior_boxes(ih, iw)
+        keep = scores >= RETINAFACE_CONFIDENCE
+        if not keep.any():
+            return []
+        priors, loc, scores, landms = priors[keep], loc[keep], scores[keep], landms[keep]
+        
+        centers = priors[:, :2] + loc[:, :2] * self.VARIANCE[0] * priors[:, 2:]
+        sizes = priors[:, 2:] * np.exp(loc[:, 2:] * self.VARIANCE[1])
+        scale = np.array([iw, ih], dtype=np.float32) / ratio
+        top_left = (centers - sizes / 2) * scale
+        box_sizes = sizes * scale
+        points = (priors[:, None, :2] + landms.reshape(-1, 5, 2) * self.VARIANCE[0] * priors[:, None, 2:]) * scale
+        
+        boxes = [[float(x), float(y), float(bw), float(bh)] for (x, y), (bw, bh) in zip(top_left, box_sizes)]
+        regions = []
+        for i in np.array(cv2.dnn.NMSBoxes(boxes, scores.tolist(), RETINAFACE_CONFIDENCE, 0.4)).flatten():
+            x, y, bw, bh = boxes[i]
+            x0, y0 = max(0, int(x)), max(0, int(y))
+            box = (x0, y0, min(w, int(x + bw)) - x0, min(h, int(y + bh)) - y0)
+            if box[2] <= 0 or box[3] <= 0:
+                continue
+            # The person's left eye is the one further right in the image
+            eye_a, eye_b = tuple(map(float, points[i][0])), tuple(map(float, points[i][1]))
+            left_eye, right_eye = (eye_a, eye_b) if eye_a[0] > eye_b[0] else (eye_b, eye_a)
+            regions.append((box, left_eye, right_eye))
+        return regions
+
+    def describe(self) -> dict:
+        return {
+            "name": self.name,
+            "arcface_model": self.arcface_path,
+            "retinaface_model": self.retinaface_path or "deepface",
+            "int8": self.int8,
+            "intra_op_threads": ONNX_INTRA_OP_THREADS,
+            "inter_op_threads": ONNX_INTER_OP_THREADS,
+            "loaded": self._arcface is not None,
+            "error": self.error
+        }
+
+
+_inference_backend: Optional[InferenceBackend] = None
+_inference_backend_lock = threading.Lock()
+
+
+def get_inference_backend() -> InferenceBackend:
+    """This process's inference backend (INFERENCE_BACKEND), falling back to DeepFace if it cannot load"""
+    global _inference_backend
+    if _inference_backend is None:
+        with _inference_backend_lock:
+            if _inference_backend is None:
+                backend = DeepFaceBackend()
+                if INFERENCE_BACKEND == "onnx":
+                    onnx_backend = OnnxBackend(ARCFACE_ONNX_MODEL, RETINAFACE_ONNX_MODEL, ONNX_INT8)
+                    if onnx_backend.load():
+                        backend = onnx_backend
+                    else:
+                        backend.fallback_error = onnx_backend.error
+                        logger.error(f"❌ INFERENCE_BACKEND=onnx unavailable ({onnx_backend.error}), falling back to the DeepFace backend")
+                _inference_backend = backend
+    return _inference_backend
+
+
+class EmbeddingBatcher:
+    """Dynamic micro-batcher for ArcFace forward passes.
+
+    Callers from any thread submit face crops and block on per-crop futures.
+    A single background thread collects crops until EMBEDDING_MAX_BATCH are
+    waiting or EMBEDDING_MAX_WAIT_MS has passed since the first one arrived,
+    runs them through ArcFace together and routes each embedding back.
+    """
+
+    def __init__(self, max_batch: int, max_wait_ms: float):
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._loop, name="embedding-batcher", daemon=True)
+                    self._thread.start()
+
+    def embed_many(self, face_rois: List[np.ndarray]) -> List[Optional[np.ndarray]]:
+        """Embed crops, sharing forward passes with any concurrent callers"""
+        self._ensure_started()
+        futures = []
+        for roi in face_rois:
+            future = Future()
+            self._queue.put((roi, future))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._run(batch)
+
+    def _run(self, batch: List[tuple]):
+        rois = [roi for roi, _ in batch]
+        try:
+            embeddings = embedding_rows(*get_inference_backend().embed(rois))
+        except Exception as e:
+            logger.error(f"❌ Embedding batch failed: {e}")
+            embeddings = [None] * len(rois)
+        
+        self.batches += 1
+        self.items += len(batch)
+        for (_, future), emb in zip(batch, embeddings):
+            future.set_result(emb)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": EMBEDDING_BATCHING,
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "batches": self.batches,
+            "embeddings": self.items,
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0
+        }
+
+
+embedding_batcher = EmbeddingBatcher(EMBEDDING_MAX_BATCH, EMBEDDING_MAX_WAIT_MS)
+
+
+def get_embedding(face_roi: np.ndarray) -> Optional[np.ndarray]:
+    """Get embedding with fallbacks"""
+    emb = get_embeddings([face_roi])[0]
+    if emb is not None:
+        return emb
+    
+    logger.warning("⚠️ Could not generate embedding")
+    return None
+
+
+def get_embeddings(face_rois: List[np.ndarray]) -> List[Optional[np.ndarray]]:
+    """Get embeddings for several crops, batched through ArcFace when enabled"""
+    if not face_rois:
+        return []
+    backend = get_inference_backend()
+    if not backend.load():
+        logger.warning("⚠️ No inference backend available")
+        return [None] * len(face_rois)
+    if EMBEDDING_BATCHING:
+        return embedding_batcher.embed_many(face_rois)
+    try:
+        return embedding_rows(*backend.embed(face_rois))
+    except Exception as e:
+        logger.error(f"❌ Embedding error: {e}")
+        return [None] * len(face_rois)
+
+
+def normalize_embedding(emb: np.ndarray) -> np.ndarray:
+    """L2 normalize embedding"""
+    norm = np.linalg.norm(emb)
+    if norm > 0:
+        return (emb / norm).astype(np.float32)
+    return emb.astype(np.float32)
+
+
+def cosine_similarity(e1: np.ndarray, e2: np.ndarray) -> float:
+    """Compute cosine similarity (0-1, higher = more similar)"""
+    # Normalize for cosine similarity
+    e1_norm = e1 / (np.linalg.norm(e1) + 1e-10)
+    e2_norm = e2 / (np.linalg.norm(e2) + 1e-10)
+    
+    similarity = float(np.dot(e1_norm, e2_norm))
+    
+    # Clamp to [0, 1] range for cosine similarity
+    return max(0.0, min(1.0, similarity))
+
+
+def student_embedding(name: str, face_embeddings: List[float]) -> np.ndarray:
+    """Validate a student's stored embedding and return it L2-normalized (raises ValueError)"""
+    if not face_embeddings or len(face_embeddings) == 0:
+        raise ValueError(f"{name}: No embeddings")
+    
+    # Validate embedding dimension
+    if len(face_embeddings) not in EXPECTED_EMBEDDING_DIMS:
+        raise ValueError(f"{name}: Invalid dimension {len(face_embeddings)}d (expected {EXPECTED_EMBEDDING_DIMS[0]}d)")
+    
+    return normalize_embedding(np.array(face_embeddings, dtype=np.float32))
+
+
+def build_gallery_matrix(embeddings: List[np.ndarray]) -> np.ndarray:
+    """Stack normalized embeddings into a contiguous (N, D) float32 gallery matrix"""
+    if not embeddings:
+        return np.empty((0, EXPECTED_EMBEDDING_DIMS[0]), dtype=np.float32)
+    matrix = np.ascontiguousarray(np.vstack(embeddings), dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+def match_embeddings(queries: np.ndarray, gallery: GalleryMatrix, top_k: int = RECOGNITION_TOP_K) -> Tuple[np.ndarray, np.ndarray]:
+    """Score all query embeddings against the gallery with one matrix product.
+
+    Both inputs must be L2-normalized (the gallery may be quantized). Returns (indices, similarities), each of
+    shape (F, k), sorted best-first per query row.
+    """
+    num_gallery = gallery.shape[0]
+    k = max(1, min(top_k, num_gallery))
+
+    scores = gallery_scores(queries, gallery)  # (F, N) cosine similarities
+
+    if k < num_gallery:
+        top_idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        top_idx = np.broadcast_to(np.arange(num_gallery), scores.shape).copy()
+
+    top_scores = np.take_along_axis(scores, top_idx, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    top_idx = np.take_along_axis(top_idx, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+    # Clamp to [0, 1] range for cosine similarity
+    return top_idx, np.clip(top_scores, 0.0, 1.0)
+
+
+def match_faces(queries: np.ndarray, boxes: List[tuple], gallery: GallerySnapshot, top_k: int = RECOGNITION_TOP_K, nprobe: int = 0) -> List[dict]:
+    """Match a frame's normalized embeddings against a gallery snapshot and build per-face results.
+
+    nprobe > 0 searches the snapshot's IVF index (when it has one) instead of
+    scanning the whole gallery.
+    """
+    if nprobe > 0 and gallery.index is not None:
+        top_idx, top_scores = gallery.index.search(queries, gallery.encodings, top_k, nprobe)
+    else:
+        top_idx, top_scores = match_embeddings(queries, gallery.encodings, top_k)
+    
+    results = []
+    for idx, box in enumerate(boxes):
+        best_idx = int(top_idx[idx, 0])
+        max_similarity = float(top_scores[idx, 0])
+        second_similarity = float(top_scores[idx, 1]) if top_scores.shape[1] > 1 else 0.0
+        
+        # Check against threshold
+        recognized = max_similarity >= ARCFACE_THRESHOLD
+        
+        # Convert to distance for frontend compatibility
+        distance = float(1.0 - max_similarity)
+        
+        candidates = [
+            {
+                "name": gallery.names[int(i)],
+                "student_id": gallery.ids[int(i)],
+                "similarity": float(sim)
+            }
+            for i, sim in zip(top_idx[idx], top_scores[idx])
+        ]
+        
+        results.append({
+            "name": gallery.names[best_idx] if recognized else "Unknown",
+            "student_id": gallery.ids[best_idx] if recognized else "",
+            "similarity": max_similarity,
+            "distance": distance,
+            "recognized": recognized,
+            "confidence": max_similarity if recognized else 0.0,
+            "margin": max_similarity - second_similarity,
+            "candidates": candidates,
+            "box": [int(box[0]), int(box[1]), int(box[0] + box[2]), int(box[1] + box[3])]
+        })
+        
+        if recognized:
+            logger.info(f"✅ Face {idx+1}: {gallery.names[best_idx]} (similarity: {max_similarity:.3f})")
+        else:
+            logger.debug(f"ℹ️ Face {idx+1}: No match (best={gallery.names[best_idx]}, {max_similarity:.3f})")
+    
+    return results
+
+
+# ============================================================================
+# INFERENCE JOBS (run on the inference pool, must stay module-level/picklable)
+# ============================================================================
+
+@dataclass
+class FrameFaces:
+    """Faces found in one frame, in full-resolution coordinates.
+
+    embeddings holds one L2-normalized row per face with embedded[i] True, in
+    face order; faces with embedded[i] False reuse track_ids[i]'s identity.
+    """
+    boxes: List[tuple]
+    embeddings: np.ndarray
+    embedded: List[bool]
+    track_ids: List[Optional[int]]
+    stages: dict = field(default_factory=dict)
+    motion_ref: Optional[np.ndarray] = None
+    timings_ms: dict = field(default_factory=dict)
+    tiles: List[dict] = field(default_factory=list)
+
+
+def extract_face_embeddings(image: ImagePayload, scale: int = 1, track_hints: Optional[List[tuple]] = None, detection: DetectionOptions = DetectionOptions(), motion_ref: Optional[np.ndarray] = None, static_frames: int = 0) -> Optional[FrameFaces]:
+    """Decode, detect and embed the faces in one frame.
+
+    track_hints are (track_id, last_box, embedded_box, reusable) tuples from a
+    session's FaceTracker; a detection that continues a reusable track and has
+    not moved away from where it was last embedded is not embedded again.
+    In cascade mode the tracked boxes and the previous frame (motion_ref)
+    feed the proposal pass; static_frames counts the static frames skipped
+    in a row before this one. Returns None if the image could not be decoded.
+    """
+    started = time.perf_counter()
+    rgb = load_image(image, scale)
+    if rgb is None:
+        return None
+    timings_ms = {"decode": (time.perf_counter() - started) * 1000.0}
+    
+    logger.debug(f"✅ Image decoded: {rgb.shape}")
+    
+    started = time.perf_counter()
+    track_boxes = [tuple(int(v / scale) for v in hint[1]) for hint in track_hints] if track_hints is not None else None
+    tiles = []
+    faces, stages, motion_ref = run_detection(rgb, detection, motion_ref, track_boxes, tiles, static_frames)
+    timings_ms["detect"] = (time.perf_counter() - started) * 1000.0
+    boxes = [scale_box(box, scale) for _, box in faces]
+    
+    track_ids = [None] * len(faces)
+    reuse = [False] * len(faces)
+    if track_hints:
+        assigned = associate_tracks(boxes, [hint[1] for hint in track_hints], TRACK_MATCH_IOU)
+        for d, t in assigned.items():
+            track_id, _, embedded_box, reusable = track_hints[t]
+            track_ids[d] = track_id
+            reuse[d] = reusable and box_iou(boxes[d], embedded_box) >= TRACK_MOVE_IOU
+    
+    started = time.perf_counter()
+    to_embed = [i for i in range(len(faces)) if not reuse[i]]
+    embeddings = get_embeddings([faces[i][0] for i in to_embed])
+    timings_ms["embed"] = (time.perf_counter() - started) * 1000.0
+    
+    failed = set()
+    queries = []
+    for i, emb in zip(to_embed, embeddings):
+        if emb is None:
+            logger.debug(f"Face {i+1}: Failed to get embedding")
+            failed.add(i)
+            continue
+        queries.append(normalize_embedding(emb))
+    
+    keep = [i for i in range(len(faces)) if i not in failed]
+    return FrameFaces(
+        boxes=[boxes[i] for i in keep],
+        embeddings=np.vstack(queries) if queries else np.empty((0, EXPECTED_EMBEDDING_DIMS[0]), dtype=np.float32),
+        embedded=[not reuse[i] for i in keep],
+        track_ids=[track_ids[i] for i in keep],
+        stages=stages,
+        motion_ref=motion_ref,
+        timings_ms=timings_ms,
+        tiles=tile_timings(tiles, scale)
+    )
+
+
+def detect_face_boxes(image: ImagePayload, scale: int = 1, detection: DetectionOptions = DetectionOptions()) -> Optional[Tuple[List[tuple], dict, List[dict]]]:
+    """Decode and detect faces, returning (full-resolution boxes, stage counts, tile timings) or None if decode failed"""
+    rgb = load_image(image, scale)
+    if rgb is None:
+        return None
+    
+    logger.info(f"✅ Image decoded: {rgb.shape}")
+    tiles = []
+    faces, stages, _ = run_detection(rgb, detection, tiles=tiles)
+    return [scale_box(box, scale) for _, box in faces], stages, tile_timings(tiles, scale)
+
+
+@dataclass
+class TrainingSample:
+    """Result of processing one training image (None embedding = skipped for `reason`)"""
+    embedding: Optional[np.ndarray]
+    reason: str = ""
+    good_quality: bool = False
+    decode_ms: float = 0.0
+    detect_ms: float = 0.0
+    embed_ms: float = 0.0
+    stages: dict = field(default_factory=dict)
+
+
+def extract_training_sample(image: ImagePayload, detection: DetectionOptions = DetectionOptions()) -> TrainingSample:
+    """Decode one training image and embed its first face, timing each stage"""
+    sample = TrainingSample(embedding=None)
+    started = time.perf_counter()
+    try:
+        rgb = load_image(image)
+        sample.decode_ms = (time.perf_counter() - started) * 1000.0
+        if rgb is None:
+            sample.reason = "decode_failed"
+            return sample
+        
+        started = time.perf_counter()
+        faces, sample.stages, _ = run_detection(rgb, detection)
+        sample.detect_ms = (time.perf_counter() - started) * 1000.0
+        if not faces:
+            sample.reason = "no_face"
+            return sample
+        
+        # Use the first face
+        roi, (_, _, w, h) = faces[0]
+        sharpness = cv2.Laplacian(cv2.cvtColor(roi, cv2.COLOR_RGB2GRAY), cv2.CV_64F).var()
+        sample.good_quality = min(w, h) >= TRAIN_MIN_FACE_SIZE and sharpness >= TRAIN_MIN_SHARPNESS
+        
+        started = time.perf_counter()
+        emb = get_embedding(roi)
+        sample.embed_ms = (time.perf_counter() - started) * 1000.0
+        if emb is None:
+            sample.reason = "embedding_failed"
+            return sample
+        sample.embedding = normalize_embedding(emb)
+    except Exception as e:
+        logger.debug(f"Training image error: {str(e)[:30]}")
+        sample.reason = "error"
+    return sample
+
+
+# ============================================================================
+# INFERENCE POOL
+# ============================================================================
+
+class InferencePoolFull(Exception):
+    """Raised when the inference pool has no free worker or queue slot"""
+
+
+def _timed_job(fn, submitted_at: float, *args):
+    """Run fn(*args) on a worker and report how long the job queued (wall clock, so it works across processes)"""
+    return time.time() - submitted_at, fn(*args)
+
+
+class InferencePool:
+    """Bounded executor that keeps blocking model calls off the event loop.
+
+    At most `workers` jobs run at once and at most `queue_size` more may wait;
+    anything beyond that is rejected immediately with InferencePoolFull so
+    callers can shed load instead of queueing without limit.
+    """
+
+    def __init__(self, kind: str, workers: int, queue_size: int):
+        self.kind = kind
+        self.workers = max(1, workers)
+        self.queue_size = max(0, queue_size)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._started_at = time.monotonic()
+        self._last_change = self._started_at
+        self._busy_seconds = 0.0
+        self.completed = 0
+        self.rejected = 0
+
+    def start(self):
+        with self._lock:
+            if self._executor is not None:
+                return
+            if self.kind == "process":
+                # spawn: TensorFlow does not survive fork() once initialised
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=None if STARTUP_MODE == "lazy" else warm_models
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix="inference"
+                )
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def warm(self, fn, timeout: float = 600.0) -> dict:
+        """Run fn on every worker process until each has answered; returns {pid: result}"""
+        results = {}
+        deadline = time.monotonic() + timeout
+        while len(results) < self.workers and time.monotonic() < deadline:
+            executor = self._executor
+            if executor is None:  # shut down while warming
+                break
+            futures = [executor.submit(fn) for _ in range(self.workers - len(results))]
+            for future in futures:
+                pid, result = future.result(timeout=max(deadline - time.monotonic(), 0.1))
+                results[pid] = result
+            time.sleep(0.05)
+        return results
+
+    def _account(self, now: float):
+        # Integrate busy worker-seconds; the executor runs jobs FIFO so the
+        # number running is min(pending, workers)
+        self._busy_seconds += min(self._pending, self.workers) * (now - self._last_change)
+        self._last_change = now
+
+    async def run(self, fn, *args):
+        """Run fn(*args) on the pool, raising InferencePoolFull if saturated"""
+        if self._executor is None:
+            self.start()
+        
+        with self._lock:
+            if self._pending >= self.workers + self.queue_size:
+                self.rejected += 1
+                raise InferencePoolFull()
+            self._account(time.monotonic())
+            self._pending += 1
+        
+        try:
+            loop = asyncio.get_running_loop()
+            waited, result = await loop.run_in_executor(self._executor, _timed_job, fn, time.time(), *args)
+            queue_wait_seconds.observe(max(waited, 0.0), fn.__name__)
+            return result
+        finally:
+            with self._lock:
+                self._account(time.monotonic())
+                self._pending -= 1
+                self.completed += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            self._account(now)
+            elapsed = max(now - self._started_at, 1e-9)
+            running = min(self._pending, self.workers)
+            return {
+                "executor": self.kind,
+                "workers": self.workers,
+                "queue_capacity": self.queue_size,
+                "running": running,
+                "queue_depth": self._pending - running,
+                "utilization": running / self.workers,
+                "avg_utilization": self._busy_seconds / (elapsed * self.workers),
+                "completed": self.completed,
+                "rejected": self.rejected
+            }
+
+
+inference_pool = InferencePool(INFERENCE_EXECUTOR, INFERENCE_WORKERS, INFERENCE_QUEUE_SIZE)
+
+
+readiness = threading.Event()
+# Last warm-up failure; cleared once a warm-up attempt succeeds
+warmup_error: Optional[str] = None
+
+
+def warm_models() -> Tuple[int, dict]:
+    """Load the cascade and the inference backend, then build RetinaFace and ArcFace by running them once.
+
+    Raises RuntimeError if the backend cannot load or INFERENCE_BACKEND had to
+    fall back to another one: the service could not compute the embeddings
+    its galleries expect.
+    """
+    get_face_cascade()
+    
+    backend = get_inference_backend()
+    if not backend.load():
+        raise RuntimeError(f"{backend.name} backend failed to load: {getattr(backend, 'error', None) or DEEPFACE_ERROR or 'unknown error'}")
+    if backend.fallback_error is not None:
+        raise RuntimeError(f"INFERENCE_BACKEND={INFERENCE_BACKEND} unavailable: {backend.fallback_error}")
+    
+    blank = np.zeros((224, 224, 3), dtype=np.uint8)
+    
+    started = time.perf_counter()
+    detect_faces_retinaface(blank)
+    startup_timings["retinaface_warmup"] = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    backend.embed([blank])
+    startup_timings["arcface_warmup"] = time.perf_counter() - started
+    
+    return os.getpid(), dict(startup_timings)
+
+
+def warm_up():
+    """Warm every model replica, mark the service ready and log the startup breakdown.
+
+    Retries up to WARMUP_ATTEMPTS times; if every attempt fails the service
+    stays unready and /ready reports the error.
+    """
+    global warmup_error
+    started = time.perf_counter()
+    for attempt in range(1, WARMUP_ATTEMPTS + 1):
+        try:
+            if inference_pool.kind == "process":
+                for pid, timings in inference_pool.warm(warm_models).items():
+                    for step, seconds in timings.items():
+                        startup_timings[f"worker_{pid}_{step}"] = seconds
+            else:
+                warm_models()
+            warmup_error = None
+            break
+        except Exception as e:
+            warmup_error = f"{type(e).__name__}: {e}"
+            logger.error(f"❌ Model warm-up failed (attempt {attempt}/{WARMUP_ATTEMPTS}): {e}")
+            if attempt < WARMUP_ATTEMPTS:
+                time.sleep(WARMUP_RETRY_SECONDS)
+    startup_timings["warmup_total"] = time.perf_counter() - started
+    
+    if warmup_error is not None:
+        logger.error(f"❌ Models not warm after {WARMUP_ATTEMPTS} attempt(s); /ready stays 503")
+        return
+    readiness.set()
+    logger.info(f"🔥 Models warm, ready after {time.perf_counter() - _PROCESS_T0:.2f}s")
+    for step, seconds in startup_timings.items():
+        logger.info(f"   ⏱️ {step}: {seconds * 1000:.0f} ms")
+
+
+# ============================================================================
+# REQUEST PARSING
+# ============================================================================
+
+RAW_IMAGE_TYPES = {"image/jpeg", "image/jpg", "image/png", "image/webp", "application/octet-stream"}
+
+
+def _content_type(request: Request) -> str:
+    return request.headers.get("content-type", "").split(";")[0].strip().lower()
+
+
+def _parse_model(model, data: dict):
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=422, detail="JSON body must be an object")
+    try:
+        return model(**data)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+async def _read_json(request: Request, error: str):
+    """Decoded JSON body; malformed or non-UTF-8 JSON is a 400 with `error`"""
+    try:
+        return await request.json()
+    except ValueError:  # JSONDecodeError and UnicodeDecodeError
+        raise HTTPException(400, error)
+
+
+async def read_image_request(request: Request) -> Tuple[ImagePayload, RecognitionRequest]:
+    """Read an image request as base64 JSON, a raw JPEG/PNG body or a multipart upload.
+
+    Raw and multipart bodies are returned as bytes and never go through base64;
+    their options (top_k, decode_scale, ...) come from query params or form
+    fields. Returns (image payload, parsed options).
+    """
+    content_type = _content_type(request)
+    
+    if content_type == "multipart/form-data":
+        form = await request.form()
+        upload = form.get("image")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(400, "Multipart body needs an 'image' file field")
+        fields = {k: v for k, v in form.items() if isinstance(v, str)}
+        fields.update(request.query_params)
+        req = _parse_model(RecognitionRequest, fields)
+        image = await upload.read()
+    elif content_type in RAW_IMAGE_TYPES:
+        req = _parse_model(RecognitionRequest, dict(request.query_params))
+        image = await request.body()
+    else:
+        data = await _read_json(request, "Body must be JSON, a raw image or multipart/form-data")
+        req = _parse_model(RecognitionRequest, data)
+        image = req.image
+    
+    if not image:
+        raise HTTPException(400, "No image provided")
+    return image, req
+
+
+async def read_training_request(request: Request) -> Tuple[str, List[ImagePayload], TrainingRequest]:
+    """Read a training request as base64 JSON or multipart (student_id + 'images' files).
+
+    Returns (student_id, images, request model); for multipart the model
+    carries only the options from form fields / query params.
+    """
+    if _content_type(request) == "multipart/form-data":
+        form = await request.form()
+        fields = {k: v for k, v in form.items() if isinstance(v, str)}
+        fields.update(request.query_params)
+        if not fields.get("student_id"):
+            raise HTTPException(400, "Multipart body needs a 'student_id' field")
+        options = _parse_model(TrainingRequest, {**fields, "images": []})
+        images = [await upload.read() for upload in form.getlist("images") if not isinstance(upload, str)]
+        return options.student_id, images, options
+    
+    data = await _read_json(request, "Body must be JSON or multipart/form-data")
+    req = _parse_model(TrainingRequest, data)
+    return req.student_id, list(req.images), req
+
+
+class BulkStudents:
+    """Students of a /train/bulk job as (student_id, images) pairs.
+
+    Images from a zip archive are read from a temporary copy of the upload
+    only when that student is trained; close() deletes the copy.
+    """
+
+    def __init__(self):
+        self.entries: List[Tuple[str, list]] = []
+        self.ignored: List[str] = []
+        self._archive: Optional[zipfile.ZipFile] = None
+        self._archive_file = None
+
+    def add(self, student_id: str, images: list):
+        for sid, existing in self.entries:
+            if sid == student_id:
+                existing.extend(images)
+                return
+        self.entries.append((student_id, list(images)))
+
+    def open_archive(self, fileobj):
+        """Index a zip archive laid out as <student_id>/<image> (any depth below the first folder).
+
+        Rejects archives over BULK_TRAIN_MAX_UPLOAD_MB or with more than
+        BULK_TRAIN_MAX_FILES members (413); members over
+        BULK_TRAIN_MAX_IMAGE_MB uncompressed are ignored.
+        """
+        limit = int(BULK_TRAIN_MAX_UPLOAD_MB * 1024 * 1024)
+        self._archive_file = tempfile.TemporaryFile()
+        copied = 0
+        while True:
+            chunk = fileobj.read(1024 * 1024)
+            if not chunk:
+                break
+            copied += len(chunk)
+            if copied > limit:
+                raise HTTPException(413, f"Archive larger than {BULK_TRAIN_MAX_UPLOAD_MB:g} MB")
+            self._archive_file.write(chunk)
+        self._archive_file.seek(0)
+        try:
+            self._archive = zipfile.ZipFile(self._archive_file)
+        except zipfile.BadZipFile:
+            raise HTTPException(400, "archive is not a valid zip file")
+        members = self._archive.infolist()
+        if len(members) > BULK_TRAIN_MAX_FILES:
+            raise HTTPException(413, f"Archive has more than {BULK_TRAIN_MAX_FILES} files")
+        max_image = BULK_TRAIN_MAX_IMAGE_MB * 1024 * 1024
+        for info in members:
+            parts = [p for p in info.filename.split("/") if p]
+            if info.is_dir() or not parts:
+                continue
+            if len(parts) < 2 or parts[0].startswith((".", "__MACOSX")) or parts[-1].startswith(".") \
+                    or not parts[-1].lower().endswith(IMAGE_EXTENSIONS) or info.file_size > max_image:
+                self.ignored.append(info.filename)
+                continue
+            self.add(parts[0], [info])
+
+    def images(self, items: list) -> List[ImagePayload]:
+        """Image payloads for one student's entries (zip members are read now)"""
+        return [self._read_member(item) if isinstance(item, zipfile.ZipInfo) else item for item in items]
+
+    def _read_member(self, info: zipfile.ZipInfo) -> bytes:
+        # file_size comes from the archive; never decompress past the image cap
+        # even if it lies
+        limit = int(BULK_TRAIN_MAX_IMAGE_MB * 1024 * 1024)
+        with self._archive.open(info) as member:
+            data = member.read(limit + 1)
+        if len(data) > limit:
+            raise HTTPException(413, f"{info.filename} is larger than {BULK_TRAIN_MAX_IMAGE_MB:g} MB uncompressed")
+        return data
+
+    def close(self):
+        if self._archive is not None:
+            self._archive.close()
+        if self._archive_file is not None:
+            self._archive_file.close()
+
+
+async def read_bulk_training_request(request: Request) -> Tuple[BulkStudents, BulkTrainingRequest]:
+    """Read a /train/bulk job: JSON, a zip body, or multipart with a zip 'archive' and/or per-student files.
+
+    JSON: {"students": [{"student_id", "images": [base64, ...]}], options}.
+    Zip archives hold one folder per student id. In multipart, every file
+    field other than 'archive' is an image of the student named by the
+    field. Options come from JSON, form fields or query params.
+    """
+    students = BulkStudents()
+    content_type = _content_type(request)
+    try:
+        if content_type == "multipart/form-data":
+            form = await request.form(max_files=BULK_TRAIN_MAX_FILES)
+            fields = {k: v for k, v in form.items() if isinstance(v, str)}
+            fields.update(request.query_params)
+            req = _parse_model(BulkTrainingRequest, fields)
+            for key, value in form.multi_items():
+                if isinstance(value, str):
+                    continue
+                if key == "archive":
+                    await asyncio.to_thread(students.open_archive, value.file)
+                else:
+                    students.add(key, [await value.read()])
+        elif content_type in ("application/zip", "application/x-zip-compressed"):
+            req = _parse_model(BulkTrainingRequest, dict(request.query_params))
+            limit = BULK_TRAIN_MAX_UPLOAD_MB * 1024 * 1024
+            received = 0
+            with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as spooled:
+                # Written from a worker thread so disk writes don't block the event loop
+                async for chunk in request.stream():
+                    received += len(chunk)
+                    if received > limit:
+                        raise HTTPException(413, f"Archive larger than {BULK_TRAIN_MAX_UPLOAD_MB:g} MB")
+                    await asyncio.to_thread(spooled.write, chunk)
+                spooled.seek(0)
+                await asyncio.to_thread(students.open_archive, spooled)
+        else:
+            data = await _read_json(request, "Body must be JSON, a zip archive or multipart/form-data")
+            req = _parse_model(BulkTrainingRequest, data)
+            for student in req.students:
+                students.add(student.student_id, student.images)
+    except Exception:
+        students.close()
+        raise
+    
+    if not students.entries:
+        students.close()
+        raise HTTPException(400, "No students found in the request")
+    if len(students.entries) > BULK_TRAIN_MAX_STUDENTS:
+        students.close()
+        raise HTTPException(413, f"At most {BULK_TRAIN_MAX_STUDENTS} students per job")
+    return students, req
+
+
+def resolve_detection(req: Union[RecognitionRequest, TrainingRequest, VideoAttendanceRequest], endpoint: str) -> DetectionOptions:
+    """Detection options for a request: its own fields or the endpoint defaults"""
+    mode = req.detection or ENDPOINT_DETECTION_MODES[endpoint]
+    if mode not in SUPPORTED_DETECTION_MODES:
+        raise HTTPException(400, f"detection must be one of {', '.join(SUPPORTED_DETECTION_MODES)}")
+    max_side = req.detect_max_side if req.detect_max_side is not None else DETECTION_MAX_SIDE
+    if max_side < 0 or 0 < max_side < 64:
+        raise HTTPException(400, "detect_max_side must be 0 (off) or at least 64")
+    pyramid = req.detect_pyramid if req.detect_pyramid is not None else DETECTION_PYRAMID
+    tile_size = req.detect_tile_size if req.detect_tile_size is not None else DETECTION_TILE_SIZE
+    if tile_size < 128:
+        raise HTTPException(400, "detect_tile_size must be at least 128")
+    tile_overlap = req.detect_tile_overlap if req.detect_tile_overlap is not None else DETECTION_TILE_OVERLAP
+    if not 0.0 <= tile_overlap <= 0.5:
+        raise HTTPException(400, "detect_tile_overlap must be between 0 and 0.5")
+    return DetectionOptions(mode=mode, max_side=max_side, pyramid=pyramid, tile_size=tile_size, tile_overlap=tile_overlap)
+
+
+def resolve_decode_scale(req: RecognitionRequest) -> int:
+    scale = req.decode_scale or DECODE_SCALE
+    if scale not in SUPPORTED_DECODE_SCALES:
+        raise HTTPException(400, f"decode_scale must be one of {sorted(SUPPORTED_DECODE_SCALES)}")
+    return scale
+
+
+class LatestFrame:
+    """Single-slot mailbox for streaming sessions: a new frame replaces any
+    frame that has not been picked up yet (latest-frame-wins)"""
+
+    def __init__(self):
+        self._frame = None
+        self._event = asyncio.Event()
+        self.dropped = 0
+
+    def put(self, frame):
+        if self._frame is not None:
+            self.dropped += 1
+        self._frame = frame
+        self._event.set()
+
+    async def take(self):
+        await self._event.wait()
+        self._event.clear()
+        frame, self._frame = self._frame, None
+        return frame
+
+
+def overloaded() -> HTTPException:
+    """503 with Retry-After for requests shed because the inference pool is full"""
+    return HTTPException(
+        status_code=503,
+        detail="Inference queue full, retry shortly",
+        headers={"Retry-After": str(INFERENCE_RETRY_AFTER)}
+    )
+
+
+# ============================================================================
+# LIVE SESSIONS & TRACKING
+# ============================================================================
+
+class FaceTrack:
+    """One face followed across frames with the identity it was last matched to"""
+
+    def __init__(self, track_id: int, box: tuple, result: dict, frame: int):
+        self.track_id = track_id
+        self.box = box
+        self.embedded_box = box
+        self.result = result
+        self.embedded_frame = frame
+        self.last_seen = frame
+
+
+class FaceTracker:
+    """Per-session IoU tracker that lets recognition skip redundant embeddings.
+
+    A face is re-embedded only when its track is new, it has moved away from
+    where it was last embedded, or its identity is older than
+    TRACK_REFRESH_FRAMES (unknown faces refresh 5x as often) or was matched
+    against an older gallery version.
+    """
+
+    def __init__(self):
+        self.tracks: Dict[int, FaceTrack] = {}
+        self.frame = 0
+        self.gallery_version = None
+        self._next_id = 1
+        self.embedded = 0
+        self.reused = 0
+
+    def hints(self, gallery_version: int, new_faces_only: bool = False) -> List[tuple]:
+        """(track_id, last_box, embedded_box, reusable) for every live track.
+
+        With new_faces_only (degraded quality) every track of the current
+        gallery is reusable and only has to stay close to its last box.
+        """
+        unknown_refresh = max(1, TRACK_REFRESH_FRAMES // 5)
+        hints = []
+        for track in self.tracks.values():
+            if new_faces_only:
+                hints.append((track.track_id, track.box, track.box, gallery_version == self.gallery_version))
+                continue
+            refresh = TRACK_REFRESH_FRAMES if track.result.get("recognized") else unknown_refresh
+            reusable = (
+                gallery_version == self.gallery_version
+                and self.frame + 1 - track.embedded_frame < refresh
+            )
+            hints.append((track.track_id, track.box, track.embedded_box, reusable))
+        return hints
+
+    def reuse(self, track_id: int) -> Optional[dict]:
+        track = self.tracks.get(track_id)
+        return dict(track.result) if track is not None else None
+
+    def update(self, faces: List[tuple], gallery_version: int) -> List[dict]:
+        """Advance one frame with (track_id, box, result, embedded) per face.
+
+        Returns the results annotated with their track ids.
+        """
+        self.frame += 1
+        self.gallery_version = gallery_version
+        
+        annotated = []
+        for track_id, box, result, embedded in faces:
+            track = self.tracks.get(track_id) if track_id is not None else None
+            if track is None:
+                track = FaceTrack(self._next_id, box, result, self.frame)
+                self.tracks[track.track_id] = track
+                self._next_id += 1
+            
+            track.box = box
+            track.last_seen = self.frame
+            if embedded:
+                track.result = {k: v for k, v in result.items() if k not in ("box", "track_id", "tracked")}
+                track.embedded_box = box
+                track.embedded_frame = self.frame
+                self.embedded += 1
+            else:
+                self.reused += 1
+            
+            annotated.append({**result, "track_id": track.track_id, "tracked": not embedded})
+        
+        for track_id in [t for t, track in self.tracks.items() if self.frame - track.last_seen > TRACK_MAX_MISSED]:
+            del self.tracks[track_id]
+        
+        return annotated
+
+
+@dataclass
+class FrameCache:
+    """A session's last computed result and the thumbnail of the frame behind it"""
+    thumbnail: np.ndarray
+    key: tuple
+    result: dict
+    computed_at: float = field(default_factory=time.monotonic)
+
+    def lookup(self, thumbnail: np.ndarray, key: tuple) -> Optional[dict]:
+        """The cached result if the frame is a near-duplicate under the same options"""
+        age_ms = (time.monotonic() - self.computed_at) * 1000
+        if key != self.key or age_ms > FRAME_CACHE_MAX_AGE_MS:
+            return None
+        if np.abs(thumbnail - self.thumbnail).max() > FRAME_DEDUP_THRESHOLD:
+            return None
+        return {**self.result, "cached": True, "cache_age_ms": round(age_ms, 1)}
+
+
+@dataclass
+class LiveSession:
+    """Per-session state shared by the frames of one live classroom.
+
+    Frames of one session are recognized one at a time (lock), so the
+    tracker, motion_ref and frame cache always see frames in order.
+    """
+    session_id: str
+    tracker: FaceTracker = field(default_factory=FaceTracker)
+    # Grayscale copy of the last frame, for the cascade's motion mask
+    motion_ref: Optional[np.ndarray] = None
+    # Static frames the cascade skipped in a row
+    static_frames: int = 0
+    frame_cache: Optional[FrameCache] = None
+    frames_checked: int = 0
+    frames_cached: int = 0
+    last_used: float = field(default_factory=time.monotonic)
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+
+class SessionRegistry:
+    """Live sessions by id, expired after SESSION_TTL_SECONDS of inactivity"""
+
+    def __init__(self, ttl_seconds: int):
+        self.ttl = ttl_seconds
+        self._sessions: Dict[str, LiveSession] = {}
+
+    def get(self, session_id: str) -> LiveSession:
+        now = time.monotonic()
+        for sid in [sid for sid, sess in self._sessions.items() if now - sess.last_used > self.ttl]:
+            del self._sessions[sid]
+        
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = self._sessions[session_id] = LiveSession(session_id)
+        session.last_used = now
+        return session
+
+    def stats(self) -> dict:
+        embedded = sum(sess.tracker.embedded for sess in self._sessions.values())
+        reused = sum(sess.tracker.reused for sess in self._sessions.values())
+        checked = sum(sess.frames_checked for sess in self._sessions.values())
+        cached = sum(sess.frames_cached for sess in self._sessions.values())
+        return {
+            "active_sessions": len(self._sessions),
+            "faces_embedded": embedded,
+            "faces_reused": reused,
+            "reuse_rate": reused / (embedded + reused) if embedded + reused else 0.0,
+            "frames_checked": checked,
+            "frames_cached": cached,
+            "frame_cache_hit_rate": cached / checked if checked else 0.0
+        }
+
+
+sessions = SessionRegistry(SESSION_TTL_SECONDS)
+
+
+# ============================================================================
+# ADAPTIVE QUALITY
+# ============================================================================
+
+@dataclass(frozen=True)
+class QualityLevel:
+    """One rung of the degradation ladder applied to /recognize under load"""
+    name: str
+    max_side: int = 0           # cap on the detector input (0 = as requested)
+    new_faces_only: bool = False  # reuse every tracked face's identity (sessions)
+    haar: bool = False          # Haar cascade instead of RetinaFace
+
+
+QUALITY_LEVELS = (
+    QualityLevel("full"),
+    QualityLevel("reduced_input", max_side=QUALITY_REDUCED_SIDE),
+    QualityLevel("new_faces_only", max_side=QUALITY_REDUCED_SIDE, new_faces_only=True),
+    QualityLevel("haar", max_side=QUALITY_REDUCED_SIDE, new_faces_only=True, haar=True)
+)
+
+
+class QualityController:
+    """Steps /recognize quality down when recent p95 latency or queue depth breaks the budget.
+
+    One level per QUALITY_COOLDOWN_SECONDS at most, and the latency window
+    starts over after every step so each level is judged on its own requests.
+    Per process: every uvicorn worker adapts to its own load.
+    """
+
+    def __init__(self, slo_ms: float, max_level: int):
+        self.slo_ms = slo_ms
+        self.max_level = max(0, min(max_level, len(QUALITY_LEVELS) - 1))
+        self.level = 0
+        self.changes = {"down": 0, "up": 0}
+        self._latencies_ms = deque(maxlen=max(1, QUALITY_WINDOW))
+        self._changed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.slo_ms > 0
+
+    def current(self) -> Tuple[int, QualityLevel]:
+        level = self.level
+        return level, QUALITY_LEVELS[level]
+
+    def apply(self, detection: DetectionOptions, level: QualityLevel) -> DetectionOptions:
+        """Detection options of a request at the given quality level"""
+        if level.haar:
+            return replace(detection, mode="haar", max_side=level.max_side)
+        if level.max_side and not 0 < detection.max_side <= level.max_side:
+            # Tiling exists to keep full resolution; a reduced level drops it
+            mode = "full" if detection.mode == "tiled" else detection.mode
+            return replace(detection, mode=mode, max_side=level.max_side, pyramid=False)
+        return detection
+
+    def record(self, latency_ms: Optional[float]):
+        """Feed one finished request (None = rejected with 503) and adjust the level"""
+        if not self.enabled:
+            return
+        queue_depth = inference_pool.stats()["queue_depth"]
+        with self._lock:
+            if latency_ms is not None:
+                self._latencies_ms.append(latency_ms)
+            now = time.monotonic()
+            if now - self._changed_at < QUALITY_COOLDOWN_SECONDS:
+                return
+            overloaded = latency_ms is None or queue_depth >= QUALITY_QUEUE_HIGH
+            if len(self._latencies_ms) < QUALITY_MIN_SAMPLES and not overloaded:
+                return
+            p95 = float(np.percentile(self._latencies_ms, 95)) if self._latencies_ms else 0.0
+            if (overloaded or p95 > self.slo_ms) and self.level < self.max_level:
+                self._step(1, now)
+                logger.warning(f"🐢 Quality down to '{QUALITY_LEVELS[self.level].name}' (p95 {p95:.0f}ms, budget {self.slo_ms:.0f}ms, queue {queue_depth})")
+            elif not overloaded and queue_depth == 0 and p95 < self.slo_ms * QUALITY_RECOVER_RATIO and self.level > 0:
+                self._step(-1, now)
+                logger.info(f"🐇 Quality up to '{QUALITY_LEVELS[self.level].name}' (p95 {p95:.0f}ms, budget {self.slo_ms:.0f}ms)")
+
+    def _step(self, delta: int, now: float):
+        self.level += delta
+        self.changes["down" if delta > 0 else "up"] += 1
+        self._latencies_ms.clear()
+        self._changed_at = now
+
+    def stats(self) -> dict:
+        with self._lock:
+            latencies = list(self._latencies_ms)
+        return {
+            "enabled": self.enabled,
+            "latency_slo_ms": self.slo_ms,
+            "level": self.level,
+            "name": QUALITY_LEVELS[self.level].name,
+            "max_level": self.max_level,
+            "window_p95_ms": round(float(np.percentile(latencies, 95)), 1) if latencies else None,
+            "window_requests": len(latencies),
+            "changes": dict(self.changes)
+        }
+
+
+quality = QualityController(LATENCY_SLO_MS, QUALITY_MAX_LEVEL)
+
+
+# ============================================================================
+# RECOGNITION PIPELINE
+# ============================================================================
+
+async def run_recognition(image: ImagePayload, req: RecognitionRequest, session: Optional[LiveSession] = None) -> dict:
+    """Recognize every face in one frame against the current gallery.
+
+    Shared by /recognize and /ws/recognize; raises InferencePoolFull when the
+    pool is saturated and HTTPException for invalid options. With a session
+    (and tracking on) faces are tracked across frames and only re-embedded
+    when needed, and near-duplicate frames get the session's last result back
+    (see FrameCache). Stage latencies and face counts go to /metrics. Under
+    a latency budget the QualityController may degrade detection and
+    embedding; the level used is reported as "quality". Concurrent frames of
+    one session wait for each other.
+    """
+    if session is None and req.session_id:
+        session = sessions.get(req.session_id)
+    if session is None:
+        return await recognize_frame(image, req, None)
+    async with session.lock:
+        return await recognize_frame(image, req, session)
+
+
+async def recognize_frame(image: ImagePayload, req: RecognitionRequest, session: Optional[LiveSession]) -> dict:
+    """run_recognition() for one frame, holding the session's lock if there is a session"""
+    request_started = time.perf_counter()
+    scale = resolve_decode_scale(req)
+    level_no, level = quality.current()
+    detection = quality.apply(resolve_detection(req, "recognize"), level)
+    quality_report = {"level": level_no, "name": level.name}
+    tracker = session.tracker if session is not None and FACE_TRACKING and req.track is not False else None
+    
+    # Pin the gallery for the whole request; a concurrent /load-students
+    # publishes a new snapshot without affecting this one
+    gallery_id = req.gallery_id or DEFAULT_GALLERY
+    gallery = await asyncio.to_thread(galleries.get, gallery_id)
+    
+    if gallery is None or len(gallery) == 0:
+        logger.warning(f"⚠️ No students loaded in gallery '{gallery_id}'")
+        return {
+            "success": True,
+            "faces": [],
+            "loaded_students": 0,
+            "gallery_id": gallery_id,
+            "gallery_version": gallery.version if gallery is not None else None,
+            "quality": quality_report,
+            "note": "No trained students loaded"
+        }
+    
+    top_k = req.top_k if req.top_k and req.top_k > 0 else RECOGNITION_TOP_K
+    nprobe = req.nprobe if req.nprobe is not None else ANN_NPROBE
+    
+    # Duplicate-frame suppression: a still room keeps sending the same frame
+    thumbnail = None
+    if session is not None and FRAME_DEDUP and req.dedup is not False:
+        cache_key = (gallery_id, gallery.version, top_k, nprobe, scale, detection)
+        thumbnail = await asyncio.to_thread(frame_thumbnail, image)
+        if thumbnail is not None:
+            session.frames_checked += 1
+            cached = session.frame_cache.lookup(thumbnail, cache_key) if session.frame_cache is not None else None
+            if cached is not None:
+                session.frames_cached += 1
+                frames_total.inc("cached")
+                logger.debug(f"♻️ Near-duplicate frame, reusing result from {cached['cache_age_ms']}ms ago")
+                return cached
+    
+    logger.info(f"🔍 Recognition request (gallery '{gallery_id}' v{gallery.version}: {len(gallery)} students)")
+    
+    # Decode, detect and embed off the event loop
+    hints = tracker.hints(gallery.version, level.new_faces_only) if tracker is not None else None
+    motion_ref = session.motion_ref if session is not None else None
+    static_frames = session.static_frames if session is not None else 0
+    try:
+        frame = await inference_pool.run(extract_face_embeddings, image, scale, hints, detection, motion_ref, static_frames)
+    except InferencePoolFull:
+        quality.record(None)
+        raise
+    if frame is None:
+        frames_total.inc("decode_failed")
+        logger.error("❌ Failed to decode image")
+        return {"success": False, "faces": [], "error": "Decode failed", "quality": quality_report}
+    
+    for stage, ms in frame.timings_ms.items():
+        stage_seconds.observe(ms / 1000.0, "recognize", stage)
+    for tile in frame.tiles:
+        stage_seconds.observe(tile["ms"] / 1000.0, "recognize", "tile")
+    faces_per_frame.observe(len(frame.boxes))
+    
+    def remember(result: dict) -> dict:
+        frames_total.inc("computed")
+        elapsed = time.perf_counter() - request_started
+        stage_seconds.observe(elapsed, "recognize", "total")
+        quality.record(elapsed * 1000.0)
+        result["quality"] = quality_report
+        if frame.tiles:
+            result["tiles"] = frame.tiles
+        if thumbnail is None:
+            return result
+        session.frame_cache = FrameCache(thumbnail, cache_key, result)
+        return {**result, "cached": False}
+    
+    detection_stats.record(detection.mode, frame.stages)
+    if session is not None:
+        session.motion_ref = frame.motion_ref
+        session.static_frames = session.static_frames + 1 if frame.stages.get("static_skips") else 0
+    
+    if not frame.boxes:
+        if tracker is not None:
+            tracker.update([], gallery.version)
+        logger.debug("ℹ️ No faces detected")
+        return remember({
+            "success": True,
+            "faces": [],
+            "loaded_students": len(gallery),
+            "gallery_id": gallery_id,
+            "gallery_version": gallery.version,
+            "note": "No faces detected in image"
+        })
+    
+    logger.info(f"👤 Detected {len(frame.boxes)} face(s), embedded {len(frame.embeddings)}")
+    search = "ivf" if nprobe > 0 and gallery.index is not None else "exact"
+    
+    started = time.perf_counter()
+    embedded_boxes = [box for box, embedded in zip(frame.boxes, frame.embedded) if embedded]
+    matched = iter(match_faces(frame.embeddings, embedded_boxes, gallery, top_k, nprobe) if embedded_boxes else [])
+    stage_seconds.observe(time.perf_counter() - started, "recognize", "match")
+    
+    faces = []
+    for box, embedded, track_id in zip(frame.boxes, frame.embedded, frame.track_ids):
+        result = next(matched) if embedded else tracker.reuse(track_id)
+        if result is None:
+            continue
+        result["box"] = [int(box[0]), int(box[1]), int(box[0] + box[2]), int(box[1] + box[3])]
+        faces.append((track_id, box, result, embedded))
     
-    logger.warning("⚠️ No faces detected by any method")
-    return []
+    if tracker is not None:
+        results = tracker.update(faces, gallery.version)
+    else:
+        results = [result for _, _, result, _ in faces]
+    for result in results:
+        faces_total.inc("recognized" if result.get("recognized") else "unknown")
+    
+    return remember({
+        "success": True,
+        "faces": results,
+        "timestamp": datetime.now().isoformat(),
+        "loaded_students": len(gallery),
+        "gallery_id": gallery_id,
+        "gallery_version": gallery.version,
+        "search": search
+    })
 
 
-def get_embedding_deepface(face_roi: np.ndarray) -> Optional[np.ndarray]:
-    """Get embedding using DeepFace ArcFace model"""
-    try:
-        if not DEEPFACE_AVAILABLE:
-            logger.warning("⚠️ DeepFace not available")
-            return None
-        
-        # ArcFace provides 512-d embeddings with superior accuracy
-        result = DeepFace.represent(
-            face_roi,
-            model_name="ArcFace",
-            enforce_detection=False,
-            normalization="ArcFace"
-        )
-        
-        if result and len(result) > 0:
-            embedding = np.array(result[0]["embedding"], dtype=np.float32)
-            logger.debug(f"✅ ArcFace embedding: {len(embedding)}-d")
-            return embedding
+# ============================================================================
+# TRAINING PIPELINE
+# ============================================================================
+
+def consistent_faces(embeddings: List[np.ndarray]) -> List[int]:
+    """Indices of the embeddings within TRAIN_CONSISTENCY of their mean"""
+    if not embeddings:
+        return []
+    matrix = np.vstack(embeddings)
+    sims = matrix @ normalize_embedding(matrix.mean(axis=0))
+    return [i for i, sim in enumerate(sims) if sim >= TRAIN_CONSISTENCY]
+
+
+async def run_training(images: List[ImagePayload], early_stop: bool = False, target_faces: int = TRAIN_TARGET_FACES, detection: DetectionOptions = DetectionOptions()) -> dict:
+    """Embed training images concurrently on the inference pool.
+
+    Up to TRAIN_CONCURRENCY images are in flight at once (their ArcFace passes
+    share micro-batches). With early_stop, no new images are started once
+    target_faces good-quality embeddings agree with their mean, and the
+    template is the mean of those; otherwise it is the mean of every face.
+    When the pool queue fills up, the images that did not fit are retried
+    with fewer in flight; InferencePoolFull is raised only if none fit.
+    """
+    started = time.perf_counter()
+    pending = list(reversed(images))
+    in_flight: Dict[asyncio.Future, ImagePayload] = {}
+    limit = TRAIN_CONCURRENCY
+    samples: List[TrainingSample] = []
+    good: List[np.ndarray] = []
+    stopped_early = False
+    
+    while pending or in_flight:
+        while pending and len(in_flight) < limit and not stopped_early:
+            image = pending.pop()
+            in_flight[asyncio.ensure_future(inference_pool.run(extract_training_sample, image, detection))] = image
         
-        logger.warning("⚠️ DeepFace returned empty result")
-        return None
+        if not in_flight:
+            break
+        done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            image = in_flight.pop(task)
+            try:
+                sample = task.result()
+            except InferencePoolFull:
+                pending.append(image)
+                if not in_flight and limit == 1:
+                    raise
+                limit = max(1, len(in_flight))
+                continue
+            samples.append(sample)
+            stage_seconds.observe(sample.decode_ms / 1000.0, "train", "decode")
+            if sample.detect_ms:
+                stage_seconds.observe(sample.detect_ms / 1000.0, "train", "detect")
+            if sample.embed_ms:
+                stage_seconds.observe(sample.embed_ms / 1000.0, "train", "embed")
+            if sample.stages:
+                detection_stats.record(detection.mode, sample.stages)
+            if sample.embedding is not None and sample.good_quality:
+                good.append(sample.embedding)
         
-    except Exception as e:
-        logger.error(f"❌ DeepFace embedding error: {e}")
-        return None
+        if early_stop and not stopped_early and len(consistent_faces(good)) >= target_faces:
+            stopped_early = True
+            logger.info(f"⏹️ Early stop: {target_faces} consistent faces after {len(samples)} images")
+    
+    embeddings = [sample.embedding for sample in samples if sample.embedding is not None]
+    consistent = consistent_faces(good)
+    if stopped_early:
+        template_from = [good[i] for i in consistent]
+    else:
+        template_from = embeddings
+    
+    skipped = {"decode_failed": 0, "no_face": 0, "embedding_failed": 0, "error": 0}
+    for sample in samples:
+        if sample.reason:
+            skipped[sample.reason] += 1
+    skipped["not_processed"] = len(images) - len(samples)
+    wall = time.perf_counter() - started
+    stage_seconds.observe(wall, "train", "total")
+    
+    return {
+        "embeddings": embeddings,
+        "template_from": template_from,
+        "report": {
+            "images_received": len(images),
+            "images_processed": len(samples),
+            "faces_embedded": len(embeddings),
+            "good_quality_faces": len(good),
+            "consistent_faces": len(consistent),
+            "early_stopped": stopped_early,
+            "skipped": skipped,
+            "timings_ms": {
+                "decode": sum(sample.decode_ms for sample in samples),
+                "detect": sum(sample.detect_ms for sample in samples),
+                "embed": sum(sample.embed_ms for sample in samples),
+                "wall": wall * 1000.0
+            }
+        }
+    }
 
 
-def get_embedding(face_roi: np.ndarray) -> Optional[np.ndarray]:
-    """Get embedding with fallbacks"""
-    emb = get_embedding_deepface(face_roi)
-    if emb is not None:
-        return emb
-    
-    logger.warning("⚠️ Could not generate embedding")
-    return None
+async def train_student(student_id: str, images: List[ImagePayload], options: TrainingRequest, detection: DetectionOptions) -> dict:
+    """Train one student: embed their images and average them into a template.
 
+    Raises HTTPException(400) for too few images or faces and InferencePoolFull
+    when the pool cannot take any of the images.
+    """
+    logger.info(f"🎓 Training {student_id} with {len(images)} images")
+    
+    if len(images) < 3:
+        raise HTTPException(400, "Minimum 3 images required for training")
+    
+    early_stop = options.early_stop if options.early_stop is not None else TRAIN_EARLY_STOP
+    target_faces = max(3, options.target_faces or TRAIN_TARGET_FACES)
+    outcome = await run_training(images[:TRAIN_MAX_IMAGES], early_stop, target_faces, detection)
+    embeddings = outcome["embeddings"]
+    report = outcome["report"]
+    
+    if len(embeddings) < 3:
+        logger.error(f"❌ Only {len(embeddings)} valid faces from {len(images)} images")
+        raise HTTPException(400, f"Need at least 3 valid faces, got {len(embeddings)}")
+    
+    # Average embeddings
+    avg_emb = np.mean(outcome["template_from"], axis=0).astype(np.float32)
+    avg_emb = normalize_embedding(avg_emb)
+    
+    timings = report["timings_ms"]
+    logger.info(
+        f"✅ Training complete: {len(embeddings)} faces processed in {timings['wall']:.0f}ms "
+        f"(decode {timings['decode']:.0f} / detect {timings['detect']:.0f} / embed {timings['embed']:.0f}ms)"
+    )
+    
+    return {
+        "success": True,
+        "embedding": avg_emb.tolist(),
+        "faces_processed": len(embeddings),
+        "embedding_dimension": len(avg_emb),
+        "faces_used": len(outcome["template_from"]),
+        **report
+    }
 
-def normalize_embedding(emb: np.ndarray) -> np.ndarray:
-    """L2 normalize embedding"""
-    norm = np.linalg.norm(emb)
-    if norm > 0:
-        return (emb / norm).astype(np.float32)
-    return emb.astype(np.float32)
 
+async def run_bulk_training(students: BulkStudents, options: BulkTrainingRequest, detection: DetectionOptions):
+    """Train a cohort, yielding one NDJSON line per student as each finishes.
 
-def cosine_similarity(e1: np.ndarray, e2: np.ndarray) -> float:
-    """Compute cosine similarity (0-1, higher = more similar)"""
-    # Normalize for cosine similarity
-    e1_norm = e1 / (np.linalg.norm(e1) + 1e-10)
-    e2_norm = e2 / (np.linalg.norm(e2) + 1e-10)
+    Up to BULK_TRAIN_CONCURRENCY students are trained at once; their images
+    share the inference pool and the embedding micro-batches. A student that
+    fails (too few faces, unreadable images, queue full after
+    BULK_TRAIN_RETRIES attempts) gets an error line and the job goes on.
+    The first line announces the job and the last one summarizes it.
+    """
+    started = time.perf_counter()
+    total_images = sum(len(items) for _, items in students.entries)
+    yield json.dumps({"type": "start", "students": len(students.entries), "images": total_images, "ignored_files": students.ignored}) + "\n"
     
-    similarity = float(np.dot(e1_norm, e2_norm))
+    attempts = max(1, BULK_TRAIN_RETRIES)
     
-    # Clamp to [0, 1] range for cosine similarity
-    return max(0.0, min(1.0, similarity))
+    async def train_one(student_id: str, items: list) -> dict:
+        error = "Inference queue full"
+        for attempt in range(1, attempts + 1):
+            try:
+                images = await asyncio.to_thread(students.images, items)
+                result = await train_student(student_id, images, options, detection)
+                return {"type": "student", "student_id": student_id, **result}
+            except InferencePoolFull:
+                if attempt == attempts:
+                    break
+                await asyncio.sleep(INFERENCE_RETRY_AFTER * attempt)
+            except HTTPException as e:
+                error = e.detail
+                break
+            except Exception as e:
+                logger.error(f"❌ Bulk training error for {student_id}: {e}")
+                error = str(e)
+                break
+        return {"type": "student", "student_id": student_id, "success": False, "error": error}
+    
+    pending = list(reversed(students.entries))
+    in_flight = set()
+    succeeded = failed = 0
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < max(1, BULK_TRAIN_CONCURRENCY):
+                student_id, items = pending.pop()
+                in_flight.add(asyncio.ensure_future(train_one(student_id, items)))
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                line = task.result()
+                if line["success"]:
+                    succeeded += 1
+                else:
+                    failed += 1
+                yield json.dumps(line) + "\n"
+    finally:
+        for task in in_flight:
+            task.cancel()
+        students.close()
+    
+    logger.info(f"🎓 Bulk training done: {succeeded} enrolled, {failed} failed in {time.perf_counter() - started:.1f}s")
+    yield json.dumps({
+        "type": "summary",
+        "students": len(students.entries),
+        "succeeded": succeeded,
+        "failed": failed,
+        "wall_ms": (time.perf_counter() - started) * 1000.0
+    }) + "\n"
+
+
+# ============================================================================
+# VIDEO ATTENDANCE
+# ============================================================================
+
+def read_video_frames(path: str, sample_fps: float, max_side: int, frames: "queue.Queue", stop: threading.Event) -> dict:
+    """Decode a video file, putting (timestamp_s, RGB frame) for every sampled frame on `frames`.
+
+    Skipped frames are only grabbed (demuxed), not decoded. The bounded
+    queue blocks the reader while the pool is behind, which bounds memory
+    whatever the video length. Puts None when done and returns video info.
+    """
+    capture = cv2.VideoCapture(path)
+    info = {"fps": 0.0, "frames_total": 0, "frames_sampled": 0, "duration_s": 0.0, "error": None}
+    try:
+        if not capture.isOpened():
+            info["error"] = "Could not open video"
+            return info
+        fps = capture.get(cv2.CAP_PROP_FPS) or 0.0
+        if not 0 < fps < 1000:
+            fps = 25.0
+        info["fps"] = fps
+        step = max(1, round(fps / sample_fps)) if sample_fps > 0 else 1
+        index = 0
+        while not stop.is_set() and capture.grab():
+            if index % step == 0:
+                ok, bgr = capture.retrieve()
+                if ok:
+                    h, w = bgr.shape[:2]
+                    if max_side and max(h, w) > max_side:
+                        ratio = max_side / max(h, w)
+                        bgr = cv2.resize(bgr, (round(w * ratio), round(h * ratio)), interpolation=cv2.INTER_AREA)
+                    item = (index / fps, cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB))
+                    while not stop.is_set():
+                        try:
+                            frames.put(item, timeout=0.5)
+                            break
+                        except queue.Full:
+                            continue
+                    info["frames_sampled"] += 1
+            index += 1
+        info["frames_total"] = index
+        info["duration_s"] = index / fps
+        return info
+    finally:
+        capture.release()
+        frames.put(None)
+
+
+class AttendanceLedger:
+    """Per-student sightings over a whole recording: bounded by the roster, not the video"""
+
+    def __init__(self):
+        self.students: Dict[str, dict] = {}
+        self.unknown_faces = 0
+        self.faces = 0
+
+    def add(self, timestamp: float, results: List[dict]):
+        for result in results:
+            self.faces += 1
+            if not result.get("recognized"):
+                self.unknown_faces += 1
+                continue
+            entry = self.students.get(result["student_id"])
+            if entry is None:
+                entry = self.students[result["student_id"]] = {
+                    "student_id": result["student_id"],
+                    "name": result["name"],
+                    "first_seen_s": timestamp,
+                    "last_seen_s": timestamp,
+                    "sightings": 0,
+                    "best_similarity": 0.0
+                }
+            entry["first_seen_s"] = min(entry["first_seen_s"], timestamp)
+            entry["last_seen_s"] = max(entry["last_seen_s"], timestamp)
+            entry["sightings"] += 1
+            entry["best_similarity"] = max(entry["best_similarity"], float(result.get("similarity", 0.0)))
+
+    def attendance(self, min_sightings: int) -> Tuple[List[dict], List[dict]]:
+        """(present, seen fewer than min_sightings times), each ordered by first sighting"""
+        entries = sorted(self.students.values(), key=lambda e: e["first_seen_s"])
+        present = [e for e in entries if e["sightings"] >= min_sightings]
+        uncertain = [e for e in entries if e["sightings"] < min_sightings]
+        return present, uncertain
+
 
+async def run_video_attendance(path: str, gallery: GallerySnapshot, req: VideoAttendanceRequest) -> dict:
+    """Attendance for a recorded lecture against one pinned gallery snapshot.
 
+    A reader thread stream-decodes sampled frames into a small queue; up to
+    VIDEO_CONCURRENCY frames are detected and embedded on the inference pool
+    at once (fewer while the pool reports it is full), and each frame's
+    faces are matched and folded into an AttendanceLedger as it completes.
+    """
+    started = time.perf_counter()
+    sample_fps = req.sample_fps if req.sample_fps and req.sample_fps > 0 else VIDEO_SAMPLE_FPS
+    min_sightings = max(1, req.min_sightings or VIDEO_MIN_SIGHTINGS)
+    max_side = req.max_side if req.max_side is not None else VIDEO_MAX_SIDE
+    detection = resolve_detection(req, "recognize")
+    
+    frames: "queue.Queue" = queue.Queue(maxsize=max(2, VIDEO_CONCURRENCY * 2))
+    stop = threading.Event()
+    reader = asyncio.ensure_future(asyncio.to_thread(read_video_frames, path, sample_fps, max_side, frames, stop))
+    
+    ledger = AttendanceLedger()
+    in_flight: Dict[asyncio.Future, tuple] = {}
+    retry: List[tuple] = []
+    limit = max(1, VIDEO_CONCURRENCY)
+    processed = failed = 0
+    exhausted = False
+    try:
+        while not exhausted or retry or in_flight:
+            while len(in_flight) < limit and (retry or not exhausted):
+                if retry:
+                    item = retry.pop()
+                else:
+                    item = await asyncio.to_thread(frames.get)
+                    if item is None:
+                        exhausted = True
+                        break
+                timestamp, rgb = item
+                job = inference_pool.run(extract_face_embeddings, rgb, 1, None, detection, None)
+                in_flight[asyncio.ensure_future(job)] = item
+            if not in_flight:
+                if retry:
+                    await asyncio.sleep(INFERENCE_RETRY_AFTER)
+                continue
+            
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                item = in_flight.pop(task)
+                try:
+                    frame = task.result()
+                except InferencePoolFull:
+                    retry.append(item)
+                    limit = max(1, len(in_flight))
+                    continue
+                limit = min(max(1, VIDEO_CONCURRENCY), limit + 1)
+                processed += 1
+                if frame is None:
+                    failed += 1
+                    continue
+                detection_stats.record(detection.mode, frame.stages)
+                for stage, ms in frame.timings_ms.items():
+                    stage_seconds.observe(ms / 1000.0, "video", stage)
+                for tile in frame.tiles:
+                    stage_seconds.observe(tile["ms"] / 1000.0, "video", "tile")
+                if frame.boxes:
+                    ledger.add(item[0], match_faces(frame.embeddings, frame.boxes, gallery, 1))
+            if retry and not in_flight:
+                await asyncio.sleep(0.05)
+    finally:
+        stop.set()
+        for task in in_flight:
+            task.cancel()
+        # Unblock the reader if it is waiting on a full queue
+        while not reader.done():
+            try:
+                frames.get_nowait()
+            except queue.Empty:
+                await asyncio.sleep(0.01)
+        info = await reader
+    
+    if info["error"]:
+        raise HTTPException(400, info["error"])
+    
+    present, uncertain = ledger.attendance(min_sightings)
+    wall = time.perf_counter() - started
+    stage_seconds.observe(wall, "video", "total")
+    logger.info(f"🎬 Video attendance: {len(present)} present from {processed} frames in {wall:.1f}s")
+    return {
+        "success": True,
+        "gallery_id": gallery.gallery_id,
+        "gallery_version": gallery.version,
+        "attendance": present,
+        "below_min_sightings": uncertain,
+        "min_sightings": min_sightings,
+        "unknown_faces": ledger.unknown_faces,
+        "faces_matched": ledger.faces,
+        "video": {
+            "duration_s": round(info["duration_s"], 2),
+            "fps": info["fps"],
+            "frames_total": info["frames_total"],
+            "frames_sampled": info["frames_sampled"],
+            "frames_processed": processed,
+            "frames_failed": failed,
+            "sample_fps": sample_fps
+        },
+        "wall_ms": wall * 1000.0
+    }
 
 
 # ============================================================================
@@ -345,153 +4373,298 @@ def cosine_similarity(e1: np.ndarray, e2: np.ndarray) -> float:
 
 @app.get("/health")
 async def health():
-    """Health check endpoint"""
+    """Health check endpoint (in-memory state only: no disk reads per probe)"""
+    default_gallery = galleries.peek(DEFAULT_GALLERY, from_store=False)
     return {
         "status": "OK",
-        "model": "ArcFace (DeepFace)" if DEEPFACE_AVAILABLE else "OpenCV (Fallback)",
+        "model": "OpenCV (Fallback)" if DEEPFACE_AVAILABLE is False else "ArcFace (DeepFace)",
+        "ready": readiness.is_set(),
+        "warmup_error": warmup_error,
         "deepface_available": DEEPFACE_AVAILABLE,
         "deepface_error": DEEPFACE_ERROR,
-        "loaded_students": len(known_face_names),
+        "loaded_students": len(default_gallery) if default_gallery is not None else 0,
+        "gallery_version": default_gallery.version if default_gallery is not None else None,
+        "galleries": len(galleries.list(include_stored=False)),
         "embedding_dimension": 512,
+        "inference": inference_pool.stats(),
         "version": "3.0"
     }
 
 
+@app.get("/ready")
+async def ready():
+    """Readiness probe: 503 until the models are warm (or if warm-up failed), then 200"""
+    body = {
+        "ready": readiness.is_set(),
+        "error": warmup_error,
+        "startup_mode": STARTUP_MODE,
+        "deepface_available": DEEPFACE_AVAILABLE,
+        "startup_timings_ms": {step: round(seconds * 1000, 1) for step, seconds in startup_timings.items()}
+    }
+    if not readiness.is_set():
+        return JSONResponse(status_code=503, content=body)
+    return body
+
+
 @app.get("/status")
-async def status():
-    """Get detailed status including loaded students"""
-    with lock:
-        faces = []
-        for i in range(len(known_face_names)):
-            faces.append({
-                "id": i,
-                "name": known_face_names[i],
-                "student_id": known_face_ids[i] if i < len(known_face_ids) else "",
-                "embedding_dim": len(known_face_encodings[i]) if i < len(known_face_encodings) else 0
-            })
-        
-        return {
-            "status": "ready" if known_face_names else "empty",
-            "students_loaded": len(known_face_names),
-            "embedding_dimension": 512,
-            "threshold": ARCFACE_THRESHOLD,
-            "faces": faces,
-            "deepface_status": "✅ Available" if DEEPFACE_AVAILABLE else "❌ Not Available"
-        }
+async def status(gallery_id: str = DEFAULT_GALLERY):
+    """Get detailed status including the students loaded in one gallery"""
+    # Syncing and reading an unmapped gallery touch the disk
+    await asyncio.to_thread(galleries.sync)
+    gallery = await asyncio.to_thread(galleries.peek, gallery_id) or GallerySnapshot(
+        gallery_id=gallery_id,
+        version=0,
+        encodings=np.empty((0, EXPECTED_EMBEDDING_DIMS[0]), dtype=np.float32),
+        names=(),
+        ids=()
+    )
+    faces = []
+    for i in range(len(gallery)):
+        faces.append({
+            "id": i,
+            "name": gallery.names[i],
+            "student_id": gallery.ids[i],
+            "embedding_dim": int(gallery.encodings.shape[1])
+        })
+    
+    return {
+        "status": "ready" if len(gallery) else "empty",
+        "students_loaded": len(gallery),
+        "gallery_id": gallery_id,
+        "gallery_version": gallery.version,
+        "embedding_dimension": 512,
+        "threshold": ARCFACE_THRESHOLD,
+        "faces": faces,
+        "galleries": galleries.stats(),
+        "gallery_store": galleries.store.stats(),
+        "inference": inference_pool.stats(),
+        "embedding_batcher": embedding_batcher.stats(),
+        "detection": detection_stats.stats(),
+        "inference_backend": get_inference_backend().describe(),
+        "tracking": sessions.stats(),
+        "quality": quality.stats(),
+        "deepface_status": "⏳ Not loaded yet" if DEEPFACE_AVAILABLE is None else ("✅ Available" if DEEPFACE_AVAILABLE else "❌ Not Available")
+    }
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus metrics: per-stage latency histograms, face counters, queue and gallery gauges"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.post("/load-students")
 async def load_students(req: LiveRecognitionRequest):
-    """Load student embeddings into memory"""
-    global known_face_encodings, known_face_names, known_face_ids
+    """Load student embeddings into memory (replaces the whole named gallery)"""
+    precision = req.precision or GALLERY_PRECISION
+    if precision not in SUPPORTED_PRECISIONS:
+        raise HTTPException(400, f"precision must be one of {', '.join(SUPPORTED_PRECISIONS)}")
     
     try:
-        with lock:
-            known_face_encodings.clear()
-            known_face_names.clear()
-            known_face_ids.clear()
-            
-            logger.info(f"📥 Loading {len(req.students)} students...")
-            
-            loaded = 0
-            skipped = 0
-            errors = []
-            
-            for student in req.students:
-                try:
-                    if not student.faceEmbeddings or len(student.faceEmbeddings) == 0:
-                        skipped += 1
-                        errors.append(f"{student.name}: No embeddings")
-                        continue
-                    
-                    # Validate embedding dimension
-                    if len(student.faceEmbeddings) not in EXPECTED_EMBEDDING_DIMS:
-                        skipped += 1
-                        errors.append(f"{student.name}: Invalid dimension {len(student.faceEmbeddings)}d (expected {EXPECTED_EMBEDDING_DIMS[0]}d)")
-                        continue
-                    
-                    emb = np.array(student.faceEmbeddings, dtype=np.float32)
-                    emb = normalize_embedding(emb)
-                    
-                    known_face_encodings.append(emb)
-                    known_face_names.append(student.name)
-                    known_face_ids.append(student.studentId)
-                    loaded += 1
-                    
-                except Exception as e:
-                    skipped += 1
-                    errors.append(f"{student.name}: {str(e)[:50]}")
-            
-            logger.info(f"✅ Loaded {loaded} students, skipped {skipped}")
-            if errors and len(errors) <= 5:
-                for err in errors[:5]:
-                    logger.debug(f"   - {err}")
-            
-            return {
-                "success": True,
-                "loaded_count": loaded,
-                "skipped_count": skipped,
-                "total_requested": len(req.students),
-                "errors": errors[:10] if errors else []
-            }
-    except Exception as e:
-        logger.error(f"❌ Load students error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
-
-
-@app.post("/train")
-async def train(req: TrainingRequest):
-    """Train: Extract embeddings from images (sequential, stable processing)"""
-    try:
-        logger.info(f"🎓 Training {req.student_id} with {len(req.images)} images")
+        gallery_id = req.gallery_id or DEFAULT_GALLERY
+        logger.info(f"📥 Loading {len(req.students)} students into gallery '{gallery_id}'...")
         
-        if len(req.images) < 3:
-            raise HTTPException(400, "Minimum 3 images required for training")
+        new_encodings = []
+        new_names = []
+        new_ids = []
+        loaded = 0
+        skipped = 0
+        errors = []
         
-        embeddings = []
-        
-        # Process images sequentially for maximum stability
-        for idx, img_b64 in enumerate(req.images[:50]):
+        for student in req.students:
             try:
-                rgb = decode_base64(img_b64)
-                if rgb is None:
-                    logger.debug(f"Image {idx+1}: Failed to decode")
-                    continue
+                emb = student_embedding(student.name, student.faceEmbeddings)
                 
-                # Detect face
-                faces = detect_faces(rgb)
-                if not faces:
-                    logger.debug(f"Image {idx+1}: No faces detected")
-                    continue
+                new_encodings.append(emb)
+                new_names.append(student.name)
+                new_ids.append(student.studentId)
+                loaded += 1
                 
-                # Get embedding from first face
-                emb = get_embedding(faces[0][0])
-                if emb is not None:
-                    embeddings.append(normalize_embedding(emb))
-                else:
-                    logger.debug(f"Image {idx+1}: Failed to get embedding")
-                    
+            except ValueError as e:
+                skipped += 1
+                errors.append(str(e))
             except Exception as e:
-                logger.debug(f"Image {idx+1} error: {str(e)[:30]}")
-                continue
+                skipped += 1
+                errors.append(f"{student.name}: {str(e)[:50]}")
         
-        if len(embeddings) < 3:
-            logger.error(f"❌ Only {len(embeddings)} valid faces from {len(req.images)} images")
-            raise HTTPException(400, f"Need at least 3 valid faces, got {len(embeddings)}")
+        # Normalize once here so matching is a single matrix product, then
+        # publish; in-flight recognitions keep the snapshot they started with.
+        # Large galleries train an ANN index here, so keep it off the event loop
+        snapshot = await asyncio.to_thread(galleries.publish, gallery_id, build_gallery_matrix(new_encodings), new_names, new_ids, precision)
         
-        # Average embeddings
-        avg_emb = np.mean(embeddings, axis=0).astype(np.float32)
-        avg_emb = normalize_embedding(avg_emb)
-        
-        logger.info(f"✅ Training complete: {len(embeddings)} faces processed")
+        logger.info(f"✅ Loaded {loaded} students, skipped {skipped} (gallery '{gallery_id}' v{snapshot.version}, {precision})")
+        if snapshot.quantization_error > QUANT_MAX_ERROR:
+            logger.warning(
+                f"⚠️ {precision} gallery '{gallery_id}': similarities may differ from float32 by up to "
+                f"{snapshot.quantization_error:.4f}, decisions that close to {ARCFACE_THRESHOLD} can flip"
+            )
+        if errors and len(errors) <= 5:
+            for err in errors[:5]:
+                logger.debug(f"   - {err}")
         
         return {
             "success": True,
-            "embedding": avg_emb.tolist(),
-            "faces_processed": len(embeddings),
-            "embedding_dimension": len(avg_emb)
+            "loaded_count": loaded,
+            "skipped_count": skipped,
+            "total_requested": len(req.students),
+            "gallery_id": gallery_id,
+            "gallery_version": snapshot.version,
+            "precision": snapshot.precision,
+            "quantization_error": snapshot.quantization_error,
+            "errors": errors[:10] if errors else []
+        }
+    except Exception as e:
+        logger.error(f"❌ Load students error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/galleries")
+async def list_galleries():
+    """List loaded and persisted galleries with their size, version and idle time"""
+    # Persisted galleries come from their index files: read them off the event loop
+    await asyncio.to_thread(galleries.sync)
+    listed = await asyncio.to_thread(galleries.list)
+    return {
+        "success": True,
+        "galleries": listed,
+        **galleries.stats()
+    }
+
+
+@app.delete("/galleries/{gallery_id}")
+async def delete_gallery(gallery_id: str):
+    """Unload a gallery (e.g. when a lecture ends)"""
+    if not galleries.remove(gallery_id):
+        raise HTTPException(404, f"Gallery '{gallery_id}' not loaded")
+    logger.info(f"🗑️ Unloaded gallery '{gallery_id}'")
+    return {"success": True, "gallery_id": gallery_id}
+
+
+def gallery_conflict(gallery_id: str, e: GalleryConflict) -> HTTPException:
+    """409 telling the client its base version is stale and a full reload is needed"""
+    return HTTPException(
+        status_code=409,
+        detail={
+            "error": "Gallery version mismatch, reload with /load-students",
+            "gallery_id": gallery_id,
+            "gallery_version": e.current_version
         }
+    )
+
+
+@app.put("/galleries/{gallery_id}/students/{student_id}")
+async def upsert_student(gallery_id: str, student_id: str, req: StudentUpsert, base_version: Optional[int] = None):
+    """Add or replace one student's embedding without reloading the gallery"""
+    try:
+        emb = student_embedding(req.name, req.faceEmbeddings)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    
+    try:
+        snapshot, _, _ = await asyncio.to_thread(galleries.apply_changes, gallery_id, [(student_id, req.name, emb)], [], base_version)
+    except GalleryConflict as e:
+        raise gallery_conflict(gallery_id, e)
+    
+    logger.info(f"✏️ Upserted {req.name} into gallery '{gallery_id}' (v{snapshot.version})")
+    return {
+        "success": True,
+        "gallery_id": gallery_id,
+        "gallery_version": snapshot.version,
+        "students_loaded": len(snapshot)
+    }
+
+
+@app.delete("/galleries/{gallery_id}/students/{student_id}")
+async def remove_student(gallery_id: str, student_id: str, base_version: Optional[int] = None):
+    """Remove one student from a gallery"""
+    gallery = await asyncio.to_thread(galleries.get, gallery_id)
+    if gallery is None or student_id not in gallery.ids:
+        raise HTTPException(404, f"Student '{student_id}' not in gallery '{gallery_id}'")
+    
+    try:
+        snapshot, _, _ = await asyncio.to_thread(galleries.apply_changes, gallery_id, [], [student_id], base_version)
+    except GalleryConflict as e:
+        raise gallery_conflict(gallery_id, e)
+    
+    logger.info(f"➖ Removed {student_id} from gallery '{gallery_id}' (v{snapshot.version})")
+    return {
+        "success": True,
+        "gallery_id": gallery_id,
+        "gallery_version": snapshot.version,
+        "students_loaded": len(snapshot)
+    }
+
+
+@app.post("/galleries/{gallery_id}/sync")
+async def sync_gallery(gallery_id: str, req: GallerySyncRequest):
+    """Apply the upserts/removals made since base_version in one step.
+
+    Returns 409 with the current version if base_version is stale, in which
+    case the client should fall back to a full /load-students.
+    """
+    upserts = []
+    errors = []
+    for student in req.upserts:
+        try:
+            upserts.append((student.studentId, student.name, student_embedding(student.name, student.faceEmbeddings)))
+        except ValueError as e:
+            errors.append(str(e))
+    
+    try:
+        snapshot, upserted, removed = await asyncio.to_thread(galleries.apply_changes, gallery_id, upserts, req.removals, req.base_version)
+    except GalleryConflict as e:
+        raise gallery_conflict(gallery_id, e)
+    
+    logger.info(f"🔄 Synced gallery '{gallery_id}' to v{snapshot.version}: +{upserted} / -{removed}")
+    return {
+        "success": True,
+        "gallery_id": gallery_id,
+        "gallery_version": snapshot.version,
+        "upserted_count": upserted,
+        "removed_count": removed,
+        "skipped_count": len(errors),
+        "students_loaded": len(snapshot),
+        "errors": errors[:10]
+    }
+
+
+@app.get("/galleries/{gallery_id}/changes")
+async def gallery_changes(gallery_id: str, since: int = 0):
+    """Changes made to a gallery after version `since` (for clients pulling deltas)"""
+    version, changes = galleries.changes_since(gallery_id, since)
+    if version is None:
+        raise HTTPException(404, f"Gallery '{gallery_id}' not loaded")
+    if changes is None:
+        return {"success": True, "gallery_id": gallery_id, "gallery_version": version, "full_reload_required": True, "changes": []}
+    
+    return {
+        "success": True,
+        "gallery_id": gallery_id,
+        "gallery_version": version,
+        "full_reload_required": False,
+        "changes": [
+            {
+                "version": change_version,
+                "op": op,
+                "studentId": student_id,
+                "name": name,
+                "faceEmbeddings": emb.tolist() if emb is not None else None
+            }
+            for change_version, op, student_id, name, emb in changes
+        ]
+    }
+
+
+@app.post("/train")
+async def train(request: Request):
+    """Train: Extract embeddings from images (base64 JSON or multipart uploads)"""
+    try:
+        student_id, images, options = await read_training_request(request)
+        detection = resolve_detection(options, "train")
+        return await train_student(student_id, images, options, detection)
         
+    except InferencePoolFull:
+        raise overloaded()
     except HTTPException:
         raise
     except Exception as e:
@@ -499,131 +4672,181 @@ async def train(req: TrainingRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/train/bulk")
+async def train_bulk(request: Request):
+    """Train many students in one job, streaming one NDJSON result line per student"""
+    students, options = await read_bulk_training_request(request)
+    try:
+        detection = resolve_detection(options, "train")
+    except HTTPException:
+        students.close()
+        raise
+    logger.info(f"🎓 Bulk training job: {len(students.entries)} students")
+    return StreamingResponse(run_bulk_training(students, options, detection), media_type="application/x-ndjson")
+
+
+@app.post("/attendance/video")
+async def video_attendance(request: Request):
+    """Attendance list from a recorded lecture (multipart 'video' file or raw video body)"""
+    if _content_type(request) == "multipart/form-data":
+        form = await request.form()
+        upload = form.get("video")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(400, "Multipart body needs a 'video' file field")
+        fields = {k: v for k, v in form.items() if isinstance(v, str)}
+        fields.update(request.query_params)
+        source, suffix = upload.file, os.path.splitext(upload.filename or "")[1]
+    else:
+        fields = dict(request.query_params)
+        source, suffix = None, ""
+    req = _parse_model(VideoAttendanceRequest, fields)
+    
+    gallery_id = req.gallery_id or DEFAULT_GALLERY
+    gallery = await asyncio.to_thread(galleries.get, gallery_id)
+    if gallery is None or len(gallery) == 0:
+        raise HTTPException(404, f"No students loaded in gallery '{gallery_id}'")
+    
+    # OpenCV reads from a path, so the upload goes to a temporary file first
+    # (written from a worker thread so disk writes don't block the event loop)
+    with tempfile.NamedTemporaryFile(suffix=suffix or ".mp4", delete=False) as tmp:
+        path = tmp.name
+        try:
+            if source is not None:
+                await asyncio.to_thread(shutil.copyfileobj, source, tmp)
+            else:
+                async for chunk in request.stream():
+                    await asyncio.to_thread(tmp.write, chunk)
+        except BaseException:
+            tmp.close()
+            os.remove(path)
+            raise
+    try:
+        logger.info(f"🎬 Video attendance for gallery '{gallery_id}' ({os.path.getsize(path) / 1e6:.1f} MB)")
+        return await run_video_attendance(path, gallery, req)
+    except InferencePoolFull:
+        raise overloaded()
+    finally:
+        os.remove(path)
+
+
 @app.post("/recognize")
-async def recognize(req: RecognitionRequest):
-    """Recognize faces in image"""
+async def recognize(request: Request):
+    """Recognize faces in image (base64 JSON, raw JPEG/PNG body or multipart upload)"""
     try:
-        logger.info(f"🔍 Recognition request (loaded: {len(known_face_names)} students)")
-        
-        with lock:
-            if not known_face_encodings:
-                logger.warning("⚠️ No students loaded in memory")
-                return {
-                    "success": True,
-                    "faces": [],
-                    "loaded_students": 0,
-                    "note": "No trained students loaded"
-                }
-            
-            # Decode image
-            rgb = decode_base64(req.image)
-            if rgb is None:
-                logger.error("❌ Failed to decode image")
-                return {"success": False, "faces": [], "error": "Decode failed"}
-            
-            logger.debug(f"✅ Image decoded: {rgb.shape}")
-            
-            # Detect faces
-            faces = detect_faces(rgb)
-            if not faces:
-                logger.debug("ℹ️ No faces detected")
-                return {
-                    "success": True,
-                    "faces": [],
-                    "loaded_students": len(known_face_names),
-                    "note": "No faces detected in image"
-                }
-            
-            logger.info(f"👤 Detected {len(faces)} face(s)")
-            results = []
-            
-            # Process each face
-            for idx, (face_roi, box) in enumerate(faces):
-                try:
-                    # Get embedding
-                    emb = get_embedding(face_roi)
-                    if emb is None:
-                        logger.debug(f"Face {idx+1}: Failed to get embedding")
-                        continue
-                    
-                    emb = normalize_embedding(emb)
-                    
-                    # Find best match
-                    max_similarity = -1.0
-                    best_idx = -1
-                    
-                    for i, known_emb in enumerate(known_face_encodings):
-                        similarity = cosine_similarity(emb, known_emb)
-                        if similarity > max_similarity:
-                            max_similarity = similarity
-                            best_idx = i
-                    
-                    # Check against threshold
-                    recognized = max_similarity >= ARCFACE_THRESHOLD
-                    
-                    # Convert to distance for frontend compatibility
-                    distance = float(1.0 - max_similarity)
-                    
-                    result = {
-                        "name": known_face_names[best_idx] if recognized else "Unknown",
-                        "student_id": known_face_ids[best_idx] if recognized else "",
-                        "similarity": float(max_similarity),
-                        "distance": distance,
-                        "recognized": recognized,
-                        "confidence": float(max_similarity) if recognized else 0.0,
-                        "box": [int(box[0]), int(box[1]), int(box[0] + box[2]), int(box[1] + box[3])]
-                    }
-                    
-                    results.append(result)
-                    
-                    if recognized:
-                        logger.info(f"✅ Face {idx+1}: {known_face_names[best_idx]} (similarity: {max_similarity:.3f})")
-                    else:
-                        logger.debug(f"ℹ️ Face {idx+1}: No match (best={known_face_names[best_idx]}, {max_similarity:.3f})")
-                        
-                except Exception as e:
-                    logger.error(f"Face {idx+1}: {e}")
-                    continue
-            
-            return {
-                "success": True,
-                "faces": results,
-                "timestamp": datetime.now().isoformat(),
-                "loaded_students": len(known_face_names)
-            }
+        image, req = await read_image_request(request)
+        return await run_recognition(image, req)
             
+    except InferencePoolFull:
+        raise overloaded()
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Recognition error: {e}")
         return {"success": False, "faces": [], "error": str(e)}
 
 
+@app.websocket("/ws/recognize")
+async def ws_recognize(websocket: WebSocket):
+    """Stream recognition for a live session over one connection.
+
+    Send frames as binary JPEG/PNG messages (or JSON text messages shaped like
+    a /recognize body); query params set the session defaults (top_k,
+    decode_scale, session_id, track). Results come back as JSON as soon as
+    each frame finishes; faces are tracked across the connection's frames.
+    Only the newest unprocessed frame is kept: frames that arrive while one is
+    in flight replace each other and are counted in dropped_frames.
+    """
+    await websocket.accept()
+    defaults = dict(websocket.query_params)
+    session = sessions.get(defaults.get("session_id") or f"ws-{uuid.uuid4().hex[:12]}")
+    mailbox = LatestFrame()
+    logger.info(f"🔌 Streaming recognition session {session.session_id} opened")
+    
+    async def process_frames():
+        while True:
+            seq, image, req = await mailbox.take()
+            try:
+                result = await run_recognition(image, req, session)
+            except InferencePoolFull:
+                result = {"success": False, "faces": [], "error": "Inference queue full", "retry_after": INFERENCE_RETRY_AFTER}
+            except HTTPException as e:
+                result = {"success": False, "faces": [], "error": str(e.detail)}
+            except Exception as e:
+                logger.error(f"❌ Streaming recognition error: {e}")
+                result = {"success": False, "faces": [], "error": str(e)}
+            
+            result["frame"] = seq
+            result["dropped_frames"] = mailbox.dropped
+            await websocket.send_json(result)
+    
+    worker = asyncio.create_task(process_frames())
+    seq = 0
+    try:
+        while not worker.done():
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            
+            seq += 1
+            try:
+                if message.get("bytes") is not None:
+                    req = _parse_model(RecognitionRequest, defaults)
+                    image = message["bytes"]
+                else:
+                    payload = json.loads(message.get("text") or "{}")
+                    if not isinstance(payload, dict):
+                        raise HTTPException(422, "JSON message must be an object")
+                    req = _parse_model(RecognitionRequest, {**defaults, **payload})
+                    image = req.image
+                if not image:
+                    raise HTTPException(400, "No image provided")
+                resolve_decode_scale(req)
+                resolve_detection(req, "recognize")
+            except (HTTPException, ValueError) as e:
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                await websocket.send_json({"success": False, "faces": [], "error": detail, "frame": seq})
+                continue
+            
+            mailbox.put((seq, image, req))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        worker.cancel()
+        logger.info(f"🔌 Streaming session closed ({seq} frames received, {mailbox.dropped} dropped)")
+
+
 @app.post("/test-detection")
-async def test_detection(req: RecognitionRequest):
-    """Test face detection only"""
+async def test_detection(request: Request):
+    """Test face detection only (base64 JSON, raw JPEG/PNG body or multipart upload)"""
     try:
         logger.info("🧪 Testing face detection...")
+        image, req = await read_image_request(request)
+        scale = resolve_decode_scale(req)
+        detection = resolve_detection(req, "test")
         
-        rgb = decode_base64(req.image)
-        if rgb is None:
+        # Decode and detect off the event loop
+        detected = await inference_pool.run(detect_face_boxes, image, scale, detection)
+        if detected is None:
             return {"success": False, "error": "Failed to decode image"}
-        
-        logger.info(f"✅ Image decoded: {rgb.shape}")
-        
-        # Detect faces
-        faces = detect_faces(rgb)
+        faces, stages, tiles = detected
+        detection_stats.record(detection.mode, stages)
         
         if not faces:
             logger.warning("⚠️ No faces detected")
             return {
                 "success": True,
                 "faces_detected": 0,
+                "detection": detection.mode,
+                "detect_max_side": detection.max_side,
+                "stages": stages,
+                "tiles": tiles,
                 "message": "No faces detected. Try: better lighting, face camera directly, adjust distance"
             }
         
         logger.info(f"✅ Detected {len(faces)} face(s)")
         
         face_boxes = []
-        for idx, (roi, box) in enumerate(faces):
+        for idx, box in enumerate(faces):
             x, y, w, h = box
             face_boxes.append({
                 "index": idx,
@@ -635,9 +4858,17 @@ async def test_detection(req: RecognitionRequest):
             "success": True,
             "faces_detected": len(faces),
             "faces": face_boxes,
+            "detection": detection.mode,
+            "detect_max_side": detection.max_side,
+            "stages": stages,
+            "tiles": tiles,
             "message": f"Successfully detected {len(faces)} face(s)"
         }
         
+    except InferencePoolFull:
+        raise overloaded()
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Detection test error: {e}")
         return {"success": False, "error": str(e)}
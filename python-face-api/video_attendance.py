@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Attendance from a recorded lecture video, without running the API server
+
+    python video_attendance.py lecture.mp4 --students roster.json
+    python video_attendance.py lecture.mp4 --gallery-dir /var/lib/face-api --gallery-id cs101 --sample-fps 0.5
+
+The roster is either a JSON file in the /load-students format ({"students":
+[{"studentId", "name", "faceEmbeddings"}]} or just the list) or a gallery
+persisted by the API (GALLERY_SNAPSHOT_DIR). Frames go through the same
+pipeline as POST /attendance/video. Tune parallelism with INFERENCE_WORKERS /
+INFERENCE_EXECUTOR / VIDEO_CONCURRENCY.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+
+import main
+
+
+def load_gallery(args) -> "main.GallerySnapshot":
+    if args.students:
+        with open(args.students, encoding="utf-8") as f:
+            data = json.load(f)
+        students = data["students"] if isinstance(data, dict) else data
+        rows, names, ids = [], [], []
+        for student in students:
+            try:
+                rows.append(main.student_embedding(student["name"], student["faceEmbeddings"]))
+            except (KeyError, ValueError) as e:
+                print(f"⚠️ Skipping student: {e}", file=sys.stderr)
+                continue
+            names.append(student["name"])
+            ids.append(student["studentId"])
+        if not rows:
+            raise SystemExit("❌ No valid students in the roster")
+        return main.galleries.publish(args.gallery_id, main.build_gallery_matrix(rows), names, ids)
+
+    snapshot = main.GalleryStore(args.gallery_dir).load(args.gallery_id)
+    if snapshot is None:
+        raise SystemExit(f"❌ No gallery '{args.gallery_id}' in {args.gallery_dir}")
+    return snapshot
+
+
+async def run(args) -> dict:
+    gallery = load_gallery(args)
+    req = main.VideoAttendanceRequest(
+        gallery_id=args.gallery_id,
+        sample_fps=args.sample_fps,
+        min_sightings=args.min_sightings,
+        max_side=args.max_side,
+        detection=args.detection
+    )
+    main.inference_pool.start()
+    try:
+        return await main.run_video_attendance(args.video, gallery, req)
+    finally:
+        main.inference_pool.shutdown()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("video")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--students", help="roster JSON in the /load-students format")
+    source.add_argument("--gallery-dir", help="GALLERY_SNAPSHOT_DIR of the API")
+    parser.add_argument("--gallery-id", default=main.DEFAULT_GALLERY)
+    parser.add_argument("--sample-fps", type=float, default=None)
+    parser.add_argument("--min-sightings", type=int, default=None)
+    parser.add_argument("--max-side", type=int, default=None)
+    parser.add_argument("--detection", choices=main.SUPPORTED_DETECTION_MODES, default=None)
+    parser.add_argument("--output", help="write the JSON result here instead of stdout")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    print(f"✅ {len(result['attendance'])} present, {len(result['below_min_sightings'])} below {result['min_sightings']} sightings", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main_cli()